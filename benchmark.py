@@ -0,0 +1,383 @@
+#
+# benchmark.py
+#
+# Rough timing benchmarks for the crypto hot paths in onions.py.
+# Run it from the command line:
+#
+#     python3 ./benchmark.py
+#     python3 ./benchmark.py keygen     # keypairs/second by key size
+#     python3 ./benchmark.py keysize    # throughput and expansion by key size
+#
+# The full suite times every hot path (encrypt/decrypt, wrap/peel, the onion
+# text format, certificate (de)serialization and key generation) across a
+# matrix of message sizes, layer counts and key sizes, reporting p50/p99
+# latency, throughput and peak memory.  Save the results as JSON, and compare
+# two saved runs to flag regressions:
+#
+#     python3 ./benchmark.py suite [--quick] [--save results.json]
+#     python3 ./benchmark.py compare old.json new.json [--threshold 0.10]
+#
+# Nothing here talks to the network or touches your certificate files:
+# it makes a throwaway keypair and times peeling onions locally.
+#
+
+import json
+import math
+import os
+import platform
+import time
+import tracemalloc
+
+import rsa
+
+from onions import InsecureRSABC, Certificate, Onion
+from keyfactory import KeyFactory
+
+CONST_BENCH_LAYERS = [1, 3, 5]
+CONST_BENCH_MESSAGE = "Hi!"
+CONST_BENCH_REPEAT = 3
+CONST_BENCH_KEY_SIZES = [127, 512, 1024, 2048]
+CONST_BENCH_KEY_COUNT = 8
+CONST_BENCH_PAYLOAD = 16384
+
+# The suite's matrix (see run_suite) and how long each case is timed for.
+CONST_SUITE_SIZES = [64, 1024, 16384]
+CONST_SUITE_LAYERS = [1, 3]
+CONST_SUITE_KEY_SIZES = [127, 1024]
+CONST_SUITE_VERSIONS = [1, 2]
+CONST_SUITE_MIN_TIME = 0.5      # seconds per case, at least...
+CONST_SUITE_MIN_REPS = 5        # ...and at least this many runs
+CONST_SUITE_MAX_REPS = 2000
+
+# compare() flags a case whose p50 got this much slower (0.10 = 10%).
+CONST_REGRESSION_THRESHOLD = 0.10
+
+
+def best_of(fn, repeat=CONST_BENCH_REPEAT):
+    """Runs fn() repeat times and returns (best seconds, last result).
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_decrypt_layers(layers, message=CONST_BENCH_MESSAGE):
+    """Wraps message in `layers` legacy layers, then times peeling all of them
+    with rsa.decrypt per block (decrypt_payload) and with the batch engine
+    (decrypt_payload_batch).  Both must produce identical plaintext.
+    """
+    pubcert, seccert = Certificate.MakePair("bench", "bench")
+
+    # build the onion once, remembering every layer's payload
+    payloads = []
+    s = message
+    for _ in range(layers):
+        o = Onion("bench", s)
+        o.wrap(pubcert)
+        payloads.append(o._payload)
+        s = o.toString()
+    payloads.reverse()
+
+    def peel_all(decrypt):
+        return [decrypt(ct, seccert._key) for ct in payloads]
+
+    t_single, out_single = best_of(lambda: peel_all(InsecureRSABC.decrypt_payload))
+    t_batch, out_batch = best_of(lambda: peel_all(InsecureRSABC.decrypt_payload_batch))
+    if out_single != out_batch:
+        raise AssertionError("batch decryption output differs from rsa.decrypt output")
+
+    return {
+        "layers": layers,
+        "outer_bytes": len(payloads[0]),
+        "per_block_s": t_single,
+        "batch_s": t_batch,
+        "speedup": t_single / t_batch if t_batch > 0 else float("inf"),
+    }
+
+
+def bench_keygen(key_size, count=CONST_BENCH_KEY_COUNT, factory=None):
+    """Times making count keypairs of key_size bits one after another
+    (rsa.newkeys) and on the KeyFactory's process pool.
+    """
+    factory = factory or KeyFactory(fname=os.devnull)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        rsa.newkeys(key_size)
+    t_serial = time.perf_counter() - start
+
+    factory.generate(key_size, 2)   # start the worker processes before timing
+    start = time.perf_counter()
+    factory.generate(key_size, count)
+    t_pool = time.perf_counter() - start
+
+    return {
+        "key_size": key_size,
+        "count": count,
+        "serial_pairs_s": count / t_serial,
+        "pool_pairs_s": count / t_pool,
+    }
+
+
+def run_keygen(key_sizes=CONST_BENCH_KEY_SIZES, count=CONST_BENCH_KEY_COUNT):
+    factory = KeyFactory(fname=os.devnull)
+    print(f'{"bits":>6} {"pairs":>6} {"serial pairs/s":>15} {"pool pairs/s":>13}')
+    try:
+        for size in key_sizes:
+            r = bench_keygen(size, count, factory)
+            print(f'{r["key_size"]:>6} {r["count"]:>6} {r["serial_pairs_s"]:>15.2f} '
+                  f'{r["pool_pairs_s"]:>13.2f}')
+    finally:
+        factory.close()
+
+
+def bench_key_size(key_size, payload_size=CONST_BENCH_PAYLOAD):
+    """Times encrypting and decrypting payload_size random bytes with a
+    key_size-bit key, with the legacy (version 1, RSA on every segment) and
+    hybrid (version 2) ciphers, and measures how much each grows the payload.
+    """
+    pubcert, seccert = Certificate.MakePair("bench", "bench", key_size)
+    pub, sec = pubcert._key, seccert._key
+    msg = os.urandom(payload_size)
+
+    result = {
+        "key_size": key_size,
+        "segment": InsecureRSABC.segment_size(pub),
+        "block": InsecureRSABC.block_size(pub),
+    }
+    ciphers = {
+        "v1": (InsecureRSABC.encrypt_bytes, InsecureRSABC.decrypt_bytes),
+        "v2": (InsecureRSABC.encrypt_hybrid_bytes, InsecureRSABC.decrypt_hybrid_bytes),
+    }
+    for name, (encrypt, decrypt) in ciphers.items():
+        t_enc, ct = best_of(lambda: encrypt(msg, pub))
+        t_dec, pt = best_of(lambda: decrypt(ct, sec))
+        if pt != msg:
+            raise AssertionError(f"{name} round trip failed with a {key_size}-bit key")
+        result[name + "_enc_mb_s"] = payload_size / t_enc / 1e6
+        result[name + "_dec_mb_s"] = payload_size / t_dec / 1e6
+        result[name + "_expansion"] = len(ct) / payload_size
+    return result
+
+
+def run_key_sizes(key_sizes=CONST_BENCH_KEY_SIZES, payload_size=CONST_BENCH_PAYLOAD):
+    print(f"{payload_size}-byte payload; throughput in MB/s, expansion = ciphertext / plaintext")
+    print(f'{"bits":>6} {"seg/blk":>8} {"v1 enc":>8} {"v1 dec":>8} {"v1 x":>7} '
+          f'{"v2 enc":>8} {"v2 dec":>8} {"v2 x":>7}')
+    for size in key_sizes:
+        r = bench_key_size(size, payload_size)
+        print(f'{r["key_size"]:>6} {r["segment"]:>4}/{r["block"]:<3} '
+              f'{r["v1_enc_mb_s"]:>8.3f} {r["v1_dec_mb_s"]:>8.3f} {r["v1_expansion"]:>6.2f}x '
+              f'{r["v2_enc_mb_s"]:>8.3f} {r["v2_dec_mb_s"]:>8.3f} {r["v2_expansion"]:>6.2f}x')
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile (q between 0 and 1) of an already sorted list.
+    """
+    i = max(0, math.ceil(q * len(sorted_values)) - 1)
+    return sorted_values[i]
+
+
+def measure(fn, nbytes=None, min_time=CONST_SUITE_MIN_TIME, min_reps=CONST_SUITE_MIN_REPS,
+            max_reps=CONST_SUITE_MAX_REPS):
+    """Calls fn() repeatedly (for min_time seconds, at least min_reps times)
+    and once more under tracemalloc to find its peak memory use.
+
+    @param nbytes: bytes handled per call, to report throughput in MB/s
+    @return a dict of timings (seconds), calls/s, MB/s and peak KiB
+    """
+    times = []
+    begin = time.perf_counter()
+    while len(times) < min_reps or (time.perf_counter() - begin < min_time and len(times) < max_reps):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    mean = sum(times) / len(times)
+    result = {
+        "runs": len(times),
+        "p50_s": percentile(times, 0.50),
+        "p99_s": percentile(times, 0.99),
+        "mean_s": mean,
+        "ops_s": 1 / mean if mean > 0 else float("inf"),
+        "peak_kib": peak / 1024,
+    }
+    if nbytes is not None:
+        result["mb_s"] = nbytes / mean / 1e6 if mean > 0 else float("inf")
+    return result
+
+
+def _message(size):
+    """A printable str message of size bytes (the text API takes str)."""
+    return ("The quick brown fox jumps over the lazy dog. " * (size // 45 + 1))[:size]
+
+
+def _build(message, layers, pubcert, version):
+    """Wraps message in `layers` text onion layers; returns the outer onion."""
+    s = message
+    for _ in range(layers):
+        o = Onion("bench", s, version)
+        o.wrap(pubcert)
+        s = o.toString()
+    return s
+
+
+def _peelAll(onion_text, layers, seccert):
+    s = onion_text
+    for _ in range(layers):
+        s = Onion.FromString(s).peel(seccert)
+    return s
+
+
+def suite_cases(sizes=CONST_SUITE_SIZES, layer_counts=CONST_SUITE_LAYERS,
+                key_sizes=CONST_SUITE_KEY_SIZES, versions=CONST_SUITE_VERSIONS):
+    """Yields (bench name, params, fn, bytes per call) for every case in the matrix.
+    """
+    for key_size in key_sizes:
+        pubcert, seccert = Certificate.MakePair("bench", "bench", key_size)
+        pub, sec = pubcert._key, seccert._key
+
+        yield ("Certificate.MakePair", {"key_size": key_size},
+               lambda k=key_size: Certificate.MakePair("bench", "bench", k), None)
+        for cert, kind in ((pubcert, "public"), (seccert, "secret")):
+            blob = cert.asJSON()
+            yield ("Certificate.KeyAsPEM", {"key_size": key_size, "cert": kind}, cert.KeyAsPEM, None)
+            yield ("Certificate.FromJSON", {"key_size": key_size, "cert": kind},
+                   lambda b=blob: Certificate.FromJSON(b), len(blob))
+
+        for size in sizes:
+            msg = _message(size)
+            ct = InsecureRSABC.encrypt_payload(msg, pub)
+            yield ("InsecureRSABC.encrypt_payload", {"key_size": key_size, "size": size},
+                   lambda m=msg: InsecureRSABC.encrypt_payload(m, pub), size)
+            yield ("InsecureRSABC.decrypt_payload", {"key_size": key_size, "size": size},
+                   lambda c=ct: InsecureRSABC.decrypt_payload(c, sec), size)
+
+            for version in versions:
+                for layers in layer_counts:
+                    params = {"key_size": key_size, "size": size, "layers": layers, "version": version}
+                    outer = _build(msg, layers, pubcert, version)
+                    onion = Onion.FromString(outer)
+                    yield ("Onion.wrap", params,
+                           lambda m=msg, n=layers, v=version: _build(m, n, pubcert, v), size)
+                    yield ("Onion.peel", params,
+                           lambda o=outer, n=layers: _peelAll(o, n, seccert), size)
+                    yield ("Onion.toString", params, onion.toString, len(outer))
+                    yield ("Onion.FromString", params, lambda o=outer: Onion.FromString(o), len(outer))
+                    yield ("Onion.isOnion", params, lambda o=outer: Onion.isOnion(o), len(outer))
+
+
+def run_suite(quick=False, save=None, **matrix):
+    """Runs every case in the matrix, prints a table, and optionally saves
+    the results as JSON (for compare()).
+
+    @param quick: time each case briefly (a smoke test, not for comparing)
+    @return the results document
+    """
+    min_time = 0.05 if quick else CONST_SUITE_MIN_TIME
+    min_reps = 2 if quick else CONST_SUITE_MIN_REPS
+
+    results = []
+    print(f'{"benchmark":<30} {"params":<44} {"p50 ms":>9} {"p99 ms":>9} {"MB/s":>8} {"peak KiB":>9}')
+    for name, params, fn, nbytes in suite_cases(**matrix):
+        r = measure(fn, nbytes, min_time=min_time, min_reps=min_reps)
+        results.append({"bench": name, "params": params, **r})
+        p = " ".join(f"{k}={v}" for k, v in params.items())
+        mbs = f'{r["mb_s"]:>8.3f}' if "mb_s" in r else f'{"":>8}'
+        print(f'{name:<30} {p:<44} {r["p50_s"] * 1e3:>9.3f} {r["p99_s"] * 1e3:>9.3f} {mbs} '
+              f'{r["peak_kib"]:>9.1f}')
+
+    doc = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpus": os.cpu_count(), "quick": quick},
+        "results": results,
+    }
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(doc, f, indent=1)
+        print(f"Saved results to {save}")
+    return doc
+
+
+def _caseKey(r):
+    return (r["bench"], json.dumps(r["params"], sort_keys=True))
+
+
+def compare(old, new, threshold=CONST_REGRESSION_THRESHOLD):
+    """Compares two saved suite runs, case by case.
+
+    @param old, new: results documents (as saved by run_suite)
+    @param threshold: how much slower (p50) counts as a regression
+    @return a list of (bench, params, old p50, new p50, ratio, regressed)
+    """
+    before = {_caseKey(r): r for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        o = before.get(_caseKey(r))
+        if o is None:
+            continue
+        ratio = r["p50_s"] / o["p50_s"] if o["p50_s"] > 0 else float("inf")
+        rows.append((r["bench"], r["params"], o["p50_s"], r["p50_s"], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def run_compare(old_file, new_file, threshold=CONST_REGRESSION_THRESHOLD):
+    """Prints a comparison of two saved runs.
+
+    @return True if nothing regressed
+    """
+    with open(old_file, 'r') as f:
+        old = json.load(f)
+    with open(new_file, 'r') as f:
+        new = json.load(f)
+
+    rows = compare(old, new, threshold)
+    print(f'{"benchmark":<30} {"params":<44} {"old ms":>9} {"new ms":>9} {"change":>8}')
+    for name, params, o, n, ratio, regressed in rows:
+        p = " ".join(f"{k}={v}" for k, v in params.items())
+        flag = "  REGRESSION" if regressed else ""
+        print(f'{name:<30} {p:<44} {o * 1e3:>9.3f} {n * 1e3:>9.3f} {(ratio - 1) * 100:>+7.1f}%{flag}')
+
+    bad = sum(1 for row in rows if row[5])
+    print(f"{len(rows)} cases compared, {bad} slower than {threshold:.0%}.")
+    return bad == 0
+
+
+def run(layer_counts=CONST_BENCH_LAYERS):
+    print(f'{"layers":>6} {"outer bytes":>12} {"rsa.decrypt s":>14} {"batch s":>10} {"speedup":>8}')
+    for n in layer_counts:
+        r = bench_decrypt_layers(n)
+        print(f'{r["layers"]:>6} {r["outer_bytes"]:>12} {r["per_block_s"]:>14.4f} '
+              f'{r["batch_s"]:>10.4f} {r["speedup"]:>7.2f}x')
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    if len(argv) > 1 and argv[1] == "keygen":
+        run_keygen()
+    elif len(argv) > 1 and argv[1] == "keysize":
+        run_key_sizes()
+    elif len(argv) > 1 and argv[1] == "suite":
+        save = argv[argv.index("--save") + 1] if "--save" in argv else None
+        run_suite(quick="--quick" in argv, save=save)
+    elif len(argv) > 3 and argv[1] == "compare":
+        threshold = float(argv[argv.index("--threshold") + 1]) if "--threshold" in argv \
+                    else CONST_REGRESSION_THRESHOLD
+        exit(0 if run_compare(argv[2], argv[3], threshold) else 1)
+    else:
+        run()
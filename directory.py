@@ -0,0 +1,317 @@
+#
+# directory.py
+#
+# A local cache of the keyserver's directory: who has which public key, and
+# which IP address (and port) their Onion Node is at.
+#
+# DirectoryCache:
+# Fills itself with one bulk /v2/keys or /v2/nodes request instead of one
+# keyserver round trip per hop, and re-polls cheaply with ETags.  Entries
+# expire after a TTL, the least recently used ones are evicted when the cache
+# is full, and names the keyserver doesn't know are remembered for a while too
+# (a "negative cache") so we don't keep asking.
+# It can be seeded from the keys-downloaded.json file made by keymanager.py.
+#
+
+import collections
+import json
+import logging
+import threading
+import time
+
+import rsa
+
+from onions import Certificate, DirectoryClient, CONST_NODE_PORT
+from transport import Transport
+
+# Seconds before a cached key / node address must be fetched again.
+CONST_DIRECTORY_TTL = 300
+
+# Seconds to remember that the keyserver doesn't know a name.
+CONST_NEGATIVE_TTL = 30
+
+# Most usernames kept in the cache.
+CONST_DIRECTORY_SIZE = 1024
+
+
+class DirectoryEntry:
+    """What we know about one username.  Keys and addresses are fetched
+    separately, so each has its own timestamp.
+    """
+    def __init__(self, uname):
+        self.uname = uname
+        self.cert = None
+        self.cert_time = None
+        self.ip = None
+        self.ip_time = None
+        self.lastseen = None
+        self.port = None
+
+
+class DirectoryCache:
+    """Caches uname -> (ip, public key certificate) from the keyserver.
+
+    Sample usage:
+    >     d = DirectoryCache.Default()
+    >     d.seedFromFile("keys-downloaded.json")
+    >     cert = d.getCert("alice")   # None if the keyserver doesn't know alice
+    >     ip = d.getIP("alice")       # None if alice's node isn't online
+    >     ip, port = d.getAddress("alice")    # (or None, likewise)
+    >     d.invalidate("alice")       # e.g., after a failed forward to alice
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, transport=None, ttl=CONST_DIRECTORY_TTL,
+                 negative_ttl=CONST_NEGATIVE_TTL, max_entries=CONST_DIRECTORY_SIZE):
+        self._transport = transport
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._negative = {}             # (kind, uname) -> time we learned it's unknown
+        self._etags = {}                # "keys"/"nodes" -> ETag of the last full listing
+        self._listed = {}               # "keys"/"nodes" -> time of the last full listing
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    def Default():
+        """Returns the shared DirectoryCache for this process (made on first use).
+        """
+        with DirectoryCache._default_lock:
+            if DirectoryCache._default is None:
+                DirectoryCache._default = DirectoryCache()
+            return DirectoryCache._default
+
+    def SetDefault(directory):
+        """Replaces the shared DirectoryCache.
+        """
+        with DirectoryCache._default_lock:
+            DirectoryCache._default = directory
+
+    def _getTransport(self):
+        return self._transport or Transport.Default()
+
+    def _entry(self, uname):
+        """Returns (and marks as recently used) the entry for uname, making one
+        if needed.  Call with self._lock held.
+        """
+        e = self._entries.get(uname)
+        if e is None:
+            e = DirectoryEntry(uname)
+            self._entries[uname] = e
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(uname)
+        return e
+
+    def _fresh(self, stamp, ttl):
+        return stamp is not None and time.monotonic() - stamp < ttl
+
+    def addKeys(self, rows):
+        """Adds rows of (uname, name, pubkey PEM) -- the /KEYS format -- to the cache.
+        """
+        certs = {}
+        for uname, name, pem in rows:
+            try:
+                key = rsa.PublicKey.load_pkcs1(pem.encode('utf-8'), format='PEM')
+            except Exception as e:
+                logging.warning("Skipping unreadable key for %s: %s", uname, e)
+                continue
+            certs[uname] = Certificate(name, uname, key)
+        self.addCerts(certs)
+
+    def addCerts(self, certs):
+        """Adds {uname: public Certificate} to the cache.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for uname, cert in certs.items():
+                entry = self._entry(uname)
+                entry.cert = cert
+                entry.cert_time = now
+                self._negative.pop(("key", uname), None)
+
+    def addNodes(self, nodes):
+        """Adds {uname: (ip, lastseen, port)} to the cache.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for uname, (ip, lastseen, port) in nodes.items():
+                entry = self._entry(uname)
+                entry.ip = ip
+                entry.ip_time = now
+                entry.lastseen = lastseen
+                entry.port = port
+                self._negative.pop(("ip", uname), None)
+
+    def _touch(self, attr, stamp_attr):
+        """Marks every cached value of one kind as fresh (the listing didn't change).
+        """
+        now = time.monotonic()
+        with self._lock:
+            for entry in self._entries.values():
+                if getattr(entry, attr) is not None:
+                    setattr(entry, stamp_attr, now)
+
+    def _missing(self, uname, attr):
+        with self._lock:
+            e = self._entries.get(uname)
+            return e is None or getattr(e, attr) is None
+
+    def seedFromFile(self, fname):
+        """Seeds the key cache from a file saved by keymanager.downloadFromServer.
+
+        @return the number of keys loaded (0 if the file can't be read)
+        """
+        try:
+            with open(fname, 'r') as f:
+                rows = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.info("Not seeding directory from %s: %s", fname, e)
+            return 0
+        self.addKeys(rows)
+        return len(rows)
+
+    def refreshKeys(self, uname=None):
+        """Fetches every key from the keyserver in one request (a cheap 304 if
+        nothing changed).  If the listing didn't change but uname isn't cached
+        (e.g., it was evicted), uname's key is fetched on its own.
+        """
+        with self._refresh_lock:
+            certs, etag = DirectoryClient.FetchKeys(etag=self._etags.get("keys"),
+                                                    transport=self._getTransport())
+            self._etags["keys"] = etag
+            self._listed["keys"] = time.monotonic()
+            if certs is None:
+                self._touch("cert", "cert_time")
+                if uname is not None and self._missing(uname, "cert"):
+                    certs, _ = DirectoryClient.FetchKeys(uname=uname, transport=self._getTransport())
+        if certs:
+            self.addCerts(certs)
+
+    def refreshNodes(self, uname=None):
+        """Fetches every online node from the keyserver in one request (a cheap
+        304 if nothing changed).  Nodes that are no longer listed lose their
+        cached address.  As with refreshKeys, uname is fetched on its own if
+        the listing didn't change but we have no address for it.
+        """
+        with self._refresh_lock:
+            nodes, etag = DirectoryClient.FetchNodes(etag=self._etags.get("nodes"),
+                                                     transport=self._getTransport())
+            self._etags["nodes"] = etag
+            self._listed["nodes"] = time.monotonic()
+            if nodes is None:
+                self._touch("ip", "ip_time")
+                if uname is not None and self._missing(uname, "ip"):
+                    nodes, _ = DirectoryClient.FetchNodes(uname=uname, transport=self._getTransport())
+                if nodes:
+                    self.addNodes(nodes)
+                return
+
+        with self._lock:
+            for name, entry in self._entries.items():
+                if name not in nodes:
+                    entry.ip = None
+                    entry.ip_time = None
+                    entry.lastseen = None
+                    entry.port = None
+        self.addNodes(nodes)
+
+    def _lookup(self, kind, uname, refresh):
+        attr, stamp_attr = ("cert", "cert_time") if kind == "key" else ("ip", "ip_time")
+
+        with self._lock:
+            e = self._entries.get(uname)
+            if e is not None and self._fresh(getattr(e, stamp_attr), self._ttl):
+                self._entries.move_to_end(uname)
+                return getattr(e, attr)
+            if self._fresh(self._negative.get((kind, uname)), self._negative_ttl):
+                return None
+
+        refresh(uname)
+
+        with self._lock:
+            e = self._entries.get(uname)
+            if e is not None and getattr(e, attr) is not None:
+                return getattr(e, attr)
+            self._negative[(kind, uname)] = time.monotonic()
+            return None
+
+    def getCert(self, uname):
+        """Returns the public key Certificate for uname, or None if unknown.
+        """
+        return self._lookup("key", uname, self.refreshKeys)
+
+    def getCerts(self, unames):
+        """Returns the public key Certificates for several usernames (e.g., every
+        hop of a circuit), asking the keyserver at most once for all of the
+        ones that aren't cached.
+
+        @return {uname: Certificate, or None if unknown}
+        """
+        certs = {}
+        missing = []
+        with self._lock:
+            for uname in unames:
+                e = self._entries.get(uname)
+                if e is not None and self._fresh(e.cert_time, self._ttl):
+                    self._entries.move_to_end(uname)
+                    certs[uname] = e.cert
+                elif self._fresh(self._negative.get(("key", uname)), self._negative_ttl):
+                    certs[uname] = None
+                else:
+                    missing.append(uname)
+        if not missing:
+            return certs
+
+        self.refreshKeys(missing[0])
+
+        for uname in missing:
+            with self._lock:
+                e = self._entries.get(uname)
+                cert = e.cert if e is not None else None
+            # Only names evicted while the listing stayed the same miss here.
+            certs[uname] = cert if cert is not None else self.getCert(uname)
+        return certs
+
+    def getIP(self, uname):
+        """Returns the IP address of uname's Onion Node, or None if it's not online.
+        """
+        return self._lookup("ip", uname, self.refreshNodes)
+
+    def getAddress(self, uname):
+        """Returns (ip, port) of uname's Onion Node, or None if it's not online.
+        """
+        ip = self.getIP(uname)
+        if ip is None:
+            return None
+        with self._lock:
+            e = self._entries.get(uname)
+            port = e.port if e is not None else None
+        return ip, port or CONST_NODE_PORT
+
+    def getNodes(self):
+        """Returns every online node, re-reading the listing if it is older
+        than the TTL.
+
+        @return {uname: (ip, lastseen)}
+        """
+        if not self._fresh(self._listed.get("nodes"), self._ttl):
+            self.refreshNodes()
+        with self._lock:
+            return {uname: (e.ip, e.lastseen) for uname, e in self._entries.items()
+                    if e.ip is not None}
+
+    def invalidate(self, uname):
+        """Forgets the cached address for uname (e.g., a forward to it failed),
+        so the next getIP() asks the keyserver again.
+        """
+        with self._lock:
+            e = self._entries.get(uname)
+            if e is not None:
+                e.ip = None
+                e.ip_time = None
+            self._negative.pop(("ip", uname), None)
@@ -0,0 +1,225 @@
+#
+# eventlog.py
+#
+# Cheap structured logging for the Onion Node and the keyserver.
+#
+# Instead of whole message bodies, the servers log small events: a category,
+# an event name, and a few fields (sizes, hashes, timings):
+#
+#     2024-03-01 12:00:00,123 INFO onion.received wire=binary bytes=52311 sha256=9f2c41d07ab3e1c4 sample=0.01
+#
+# Each category is sampled at its own rate (see CONST_LOG_SAMPLING), so busy
+# categories (one event per request) can be kept to a trickle while errors are
+# always logged.  An event that isn't sampled costs one random number; fields
+# given as callables (e.g., a hash of the body) are only worked out for events
+# that are kept.
+#
+# EventLog.Start() sends every log record (not just events) through a queue to
+# a background thread, so formatting and writing log lines never happens on a
+# request thread.  If the queue fills up, records are dropped (and counted in
+# /METRICS as log_records_dropped) rather than making requests wait.
+#
+
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+
+from metrics import MetricsRegistry
+
+# Fraction of events kept, per category (categories not listed: all kept).
+CONST_LOG_SAMPLING = {
+    "access": 0.01,     # one line per HTTP request (BaseHTTPRequestHandler's log)
+    "request": 0.01,    # a request arrived (path, sizes)
+    "onion": 0.01,      # an onion was received / peeled / forwarded
+    "message": 1.0,     # a message was delivered to this node
+    "cert": 1.0,        # certificates were stored
+    "error": 1.0,       # something went wrong
+}
+
+# Log records waiting to be written, at most (see EventLog.Start).
+CONST_LOG_QUEUE_SIZE = 10000
+
+# Most characters of a delivered message included in its event.
+CONST_LOG_PREVIEW = 1024
+
+CONST_LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+# Hex digits of SHA-256 kept by digest().
+CONST_DIGEST_LENGTH = 16
+
+
+def digest(data):
+    """A short hash of some bytes, to tell bodies apart in logs without
+    logging them.
+    """
+    return hashlib.sha256(data).hexdigest()[:CONST_DIGEST_LENGTH]
+
+
+def _value(v):
+    """Renders one field value (quoted if it has spaces or quotes in it).
+    """
+    if isinstance(v, float):
+        v = f"{v:.6g}"
+    text = str(v)
+    if not text or any(c in text for c in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats events as "category.event key=value ...", and other records
+    as usual.
+    """
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={_value(v)}" for k, v in fields.items())
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue as they are (no formatting on the caller's
+    thread), and drops them if the queue is full.
+    """
+    def prepare(self, record):
+        # the listener formats it; make sure the message can be built later
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            MetricsRegistry.Default().counter("log_records_dropped",
+                                              "Log records dropped because the log queue was full").inc()
+
+
+class EventLog:
+    """Sampled structured events, written through the logging module.
+
+    Sample usage:
+    >     EventLog.Start()                          # at startup (see run())
+    >     log = EventLog.Default()
+    >     log.event("onion", "received", bytes=len(body), sha256=lambda: digest(body))
+    >     log.event("error", "bad_onion", level=logging.WARNING, error=str(e))
+    >     ...
+    >     EventLog.Stop()                           # at shutdown: writes what's queued
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+    _listener = None
+
+    def __init__(self, sampling=None, logger="onion", rng=None):
+        self._sampling = dict(CONST_LOG_SAMPLING)
+        self._sampling.update(sampling or {})
+        self._logger = logging.getLogger(logger)
+        self._random = (rng or random.Random()).random
+
+    def Default():
+        """Returns the shared EventLog for this process (made on first use).
+        """
+        with EventLog._default_lock:
+            if EventLog._default is None:
+                EventLog._default = EventLog()
+            return EventLog._default
+
+    def SetDefault(log):
+        """Replaces the shared EventLog.
+        """
+        with EventLog._default_lock:
+            EventLog._default = log
+
+    def ParseRates(text):
+        """Reads sampling rates written as "onion=0.1,access=0".
+
+        @return {category: rate}
+        @raise ValueError if a rate isn't a number between 0 and 1
+        """
+        rates = {}
+        for item in text.split(","):
+            if not item.strip():
+                continue
+            category, rate = item.split("=", 1)
+            rate = float(rate)
+            if not 0 <= rate <= 1:
+                raise ValueError(f"sampling rate for {category} must be between 0 and 1")
+            rates[category.strip()] = rate
+        return rates
+
+    def Start(level=logging.INFO, stream=None, queue_size=CONST_LOG_QUEUE_SIZE):
+        """Sets up logging for a server: every record goes through a queue to
+        a background thread, which formats it and writes it to stream
+        (default: stderr).  Replaces logging.basicConfig.
+        """
+        if EventLog._listener is not None:
+            return
+        q = queue.Queue(maxsize=queue_size)
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(StructuredFormatter(CONST_LOG_FORMAT))
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(_DroppingQueueHandler(q))
+        EventLog._listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+        EventLog._listener.start()
+
+    def Stop():
+        """Writes any queued records and stops the background thread.
+        """
+        if EventLog._listener is not None:
+            EventLog._listener.stop()
+            EventLog._listener = None
+
+    def rate(self, category):
+        """Returns the fraction of category's events that are kept.
+        """
+        return self._sampling.get(category, 1.0)
+
+    def sampled(self, category):
+        """Decides whether to keep one event of category.
+        """
+        rate = self._sampling.get(category, 1.0)
+        return rate >= 1.0 or (rate > 0.0 and self._random() < rate)
+
+    def event(self, category, name, level=logging.INFO, **fields):
+        """Logs an event (if it's sampled).  Fields that are callables are
+        only called if the event is kept.
+
+        @return True if the event was kept
+        """
+        if not self._logger.isEnabledFor(level) or not self.sampled(category):
+            return False
+        fields = {k: v() if callable(v) else v for k, v in fields.items()}
+        rate = self.rate(category)
+        if rate < 1.0:
+            fields["sample"] = rate
+        self._logger.log(level, "%s.%s", category, name, extra={"fields": fields})
+        return True
+
+
+class HTTPLogMixin:
+    """For BaseHTTPRequestHandler subclasses: sends the access log (a line
+    per request) and HTTP errors through the event log, instead of writing
+    them to stderr on the request thread.  Timeouts and 4xx answers go to
+    the (sampled) access log; 5xx answers are logged as errors.
+    """
+    def log_message(self, format, *args):
+        EventLog.Default().event("access", "http", client=self.client_address[0],
+                                 line=lambda: format % args)
+
+    def log_error(self, format, *args):
+        # BaseHTTPRequestHandler also calls this for idle keep-alive
+        # connections timing out and for answering 4xx; only a 5xx (from
+        # send_error) is a real failure, the rest is sampled like the access log.
+        failed = format.startswith("code ") and args and isinstance(args[0], int) and args[0] >= 500
+        category, level = ("error", logging.WARNING) if failed else ("access", logging.INFO)
+        EventLog.Default().event(category, "http", level=level, client=self.client_address[0],
+                                 line=lambda: format % args)
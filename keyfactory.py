@@ -0,0 +1,216 @@
+#
+# keyfactory.py
+#
+# Makes RSA keypairs ahead of time and in bulk.
+#
+# rsa.newkeys has to search for big primes, which gets slow (seconds per pair)
+# as keys get bigger.  KeyFactory makes pairs on a process pool (one pair per
+# worker at a time), and keeps a pool of ready pairs for each key size in a
+# file, so "new key please" is usually instant.
+#
+# Command line:
+#
+#     python3 ./keyfactory.py fill <key_size> <count>
+#         adds count pairs of key_size bits to the ready pool
+#     python3 ./keyfactory.py provision <users.json> [key_size] [outdir]
+#         makes a keypair for every {"name":..., "username":...} in users.json
+#         and writes outdir/<username>/pubcert.json and secretcert.json
+#     python3 ./keyfactory.py status
+#         shows how many ready pairs there are of each key size
+#
+# NOTE: the pool file holds SECRET keys.  Keep it private!
+#
+
+import atexit
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+
+import rsa
+
+from onions import Certificate, mp_context, CONST_KEY_SIZE
+
+# File the ready pairs are kept in.
+KEYPOOLFILE = "keypool.json"
+
+
+def _newkeys(key_size):
+    """Makes one keypair (runs in a worker process)."""
+    return rsa.newkeys(key_size)
+
+
+class KeyFactory:
+    """Makes keypairs on a process pool, and keeps a file-backed pool of
+    ready pairs per key size.
+
+    Sample usage:
+    >     kf = KeyFactory.Default()
+    >     kf.fill(1024, 20)                       # make 20 spare 1024-bit pairs
+    >     pub, sec = kf.makePair("Alice", "alice", 1024)   # instant: from the pool
+    >     certs = kf.provision([("Bob", "bob"), ("Carol", "carol")], 1024)
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, fname=KEYPOOLFILE, workers=None):
+        self._fname = fname
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._ready = self._load()      # key size -> [(pubkey, seckey), ...]
+
+    def Default():
+        """Returns the shared KeyFactory for this process (made on first use).
+        """
+        with KeyFactory._default_lock:
+            if KeyFactory._default is None:
+                KeyFactory._default = KeyFactory()
+                atexit.register(KeyFactory._default.close)
+            return KeyFactory._default
+
+    def _load(self):
+        """Reads the ready pairs from the pool file (none if it can't be read).
+        """
+        try:
+            with open(self._fname, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.info("No ready keypairs loaded from %s: %s", self._fname, e)
+            return {}
+        ready = {}
+        for size, pairs in saved.items():
+            ready[int(size)] = [(rsa.PublicKey.load_pkcs1(pub.encode('utf-8'), format='PEM'),
+                                 rsa.PrivateKey.load_pkcs1(sec.encode('utf-8'), format='PEM'))
+                                for pub, sec in pairs]
+        return ready
+
+    def _save(self):
+        """Writes the ready pairs to the pool file.  Call with self._lock held.
+        """
+        saved = {str(size): [[pub.save_pkcs1(format='PEM').decode('utf-8'),
+                              sec.save_pkcs1(format='PEM').decode('utf-8')]
+                             for pub, sec in pairs]
+                 for size, pairs in self._ready.items()}
+        tmp = self._fname + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, self._fname)
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                                    mp_context=mp_context())
+        return self._executor
+
+    def generate(self, key_size=CONST_KEY_SIZE, count=1):
+        """Makes count new keypairs on the process pool (skips the ready pool).
+
+        @return a list of (pubkey, seckey)
+        """
+        if count <= 0:
+            return []
+        if count == 1:
+            return [_newkeys(key_size)]
+        return list(self._pool().map(_newkeys, [key_size] * count))
+
+    def fill(self, key_size=CONST_KEY_SIZE, count=1):
+        """Adds count new keypairs of key_size bits to the ready pool.
+        """
+        pairs = self.generate(key_size, count)
+        with self._lock:
+            self._ready.setdefault(key_size, []).extend(pairs)
+            self._save()
+
+    def ready(self, key_size=None):
+        """Returns how many ready pairs there are of key_size bits (or, with
+        no key_size, {key size: count}).
+        """
+        with self._lock:
+            if key_size is None:
+                return {size: len(pairs) for size, pairs in self._ready.items()}
+            return len(self._ready.get(key_size, []))
+
+    def takeKeys(self, key_size=CONST_KEY_SIZE, count=1):
+        """Returns count keypairs, taking ready ones first and making the rest.
+        Pairs taken from the pool are removed from it (and from the file).
+
+        @return a list of (pubkey, seckey)
+        """
+        with self._lock:
+            ready = self._ready.get(key_size, [])
+            taken, self._ready[key_size] = ready[:count], ready[count:]
+            if taken:
+                self._save()
+        return taken + self.generate(key_size, count - len(taken))
+
+    def makePair(self, name, uname, key_size=CONST_KEY_SIZE):
+        """Like Certificate.MakePair, but uses a ready pair if there is one.
+
+        @return (public Certificate, secret Certificate)
+        """
+        return self.provision([(name, uname)], key_size)[0]
+
+    def provision(self, users, key_size=CONST_KEY_SIZE):
+        """Makes certificates for many users at once.
+
+        @param users: a list of (name, uname)
+        @return a list of (public Certificate, secret Certificate), in order
+        """
+        keys = self.takeKeys(key_size, len(users))
+        return [(Certificate(name, uname, pub), Certificate(name, uname, sec))
+                for (name, uname), (pub, sec) in zip(users, keys)]
+
+    def close(self):
+        """Stops the worker processes.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def provisionToDirectory(users, key_size=CONST_KEY_SIZE, outdir="provisioned", factory=None):
+    """Makes keypairs for users and writes each one's pubcert.json and
+    secretcert.json into outdir/<username>/.
+
+    @param users: a list of (name, uname)
+    @return the list of (public Certificate, secret Certificate)
+    """
+    factory = factory or KeyFactory.Default()
+    certs = factory.provision(users, key_size)
+    for pub, sec in certs:
+        d = os.path.join(outdir, pub._uname)
+        os.makedirs(d, exist_ok=True)
+        pub.writeToFile(os.path.join(d, "pubcert.json"))
+        sec.writeToFile(os.path.join(d, "secretcert.json"))
+    return certs
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    kf = KeyFactory.Default()
+    cmd = argv[1] if len(argv) > 1 else "status"
+
+    if cmd == "fill":
+        size, count = int(argv[2]), int(argv[3])
+        kf.fill(size, count)
+        print(f"{kf.ready(size)} ready {size}-bit keypairs.")
+
+    elif cmd == "provision":
+        with open(argv[2], 'r') as f:
+            users = [(u["name"], u["username"]) for u in json.load(f)]
+        size = int(argv[3]) if len(argv) > 3 else CONST_KEY_SIZE
+        outdir = argv[4] if len(argv) > 4 else "provisioned"
+        provisionToDirectory(users, size, outdir, kf)
+        print(f"Wrote {len(users)} keypairs to {outdir}/.")
+
+    elif cmd == "status":
+        for size, n in sorted(kf.ready().items()):
+            print(f"{size:>6} bits: {n} ready")
+
+    else:
+        print("usage: keyfactory.py fill <key_size> <count> | provision <users.json> [key_size] [outdir] | status")
@@ -8,11 +8,16 @@
 # (c) 2024 Sid Stamm <stammsl@rose-hulman.edu>
 # 
 
+import glob
 import json
-import urllib.request
+import os
 import urllib.parse
 
-from onions import Certificate, CONST_KEYSERVER_URL
+import requests
+
+from transport import Transport
+from onions import Certificate, CONST_KEY_SIZE
+from keyfactory import KeyFactory
 
 def postToServer(cert):
     """
@@ -30,33 +35,72 @@ def postToServer(cert):
     data = urllib.parse.quote(cert.asJSON())
     data = data.encode("ascii")
     try:
-        with urllib.request.urlopen(f'{CONST_KEYSERVER_URL}/', data) as f:
-            return f.read().decode('utf-8')
-    except urllib.error.URLError as e:
+        response = Transport.Default().keyserverPost('/', data)
+        response.raise_for_status()
+        return response.text
+    except requests.exceptions.RequestException as e:
         print("\n", e)
         return None
 
 
+# Most certificates sent to the keyserver in one request.
+CONST_BULK_BATCH = 500
+
+
+def postManyToServer(certs, batch=CONST_BULK_BATCH):
+    """
+    Sends many certificates to the keyserver, batch at a time (each batch is
+    stored in one go).  Secret key certificates are never sent.
+
+    @param certs: the certificates to send
+
+    @returns a list of per-certificate results ({"username", "ok", "error"}),
+             or None if the keyserver couldn't be reached
+    """
+    results = [None] * len(certs)
+    public = []
+    for i, cert in enumerate(certs):
+        if cert.isPrivate():
+            print(f"ERROR: not sending private certificate for {cert._uname} to key server!")
+            results[i] = {"username": cert._uname, "ok": False, "error": "private certificate"}
+        else:
+            public.append(i)
+
+    for start in range(0, len(public), batch):
+        sending = public[start:start+batch]
+        body = "\n".join(certs[i].asJSON() for i in sending).encode('utf-8')
+        try:
+            response = Transport.Default().keyserverPost('/v2/keys', body,
+                                                         headers={"Content-Type": "application/x-ndjson"})
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            print("\n", e)
+            return None
+        for i, r in zip(sending, response.json()["results"]):
+            results[i] = r
+    return results
+
+
 def downloadFromServer(fname):
     """
     Downloads a JSON list of certificates from the keyserver.
     """
     print(f'Downloading "{fname}"... ', end='')
-    req = urllib.request.Request(f'{CONST_KEYSERVER_URL}/KEYS')
     try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as e:
+        response = Transport.Default().keyserverGet('/KEYS')
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
         print("\n", e)
     else:
         with open(fname, 'w+') as f:
-            f.write(response.read().decode('utf-8'))
+            f.write(response.text)
         print("done.")
 
 
 if __name__ == '__main__':
     print("Welcome to the key manager.")
 
-    CMDS = ["new", "show", "import", "export", "send", "download", "exit"]
+    CMDS = ["new", "show", "import", "export", "send", "bulksend", "download", "exit"]
 
     cmd = input(f'What would you like to do ({CMDS})? ')
     pubcert = None
@@ -67,7 +111,9 @@ if __name__ == '__main__':
         if cmd == "new":
             n = input("What is your name? ")
             un = input("What is your RHIT username? ")
-            pubcert, seccert = Certificate.MakePair(name=n, uname=un)
+            bits = input(f"Key size in bits [{CONST_KEY_SIZE}]? ").strip()
+            key_size = int(bits) if bits else CONST_KEY_SIZE
+            pubcert, seccert = KeyFactory.Default().makePair(name=n, uname=un, key_size=key_size)
             print("Generation complete.  I recommend you 'export' to save your keypair!\n")
 
         elif cmd == "export":
@@ -90,6 +136,17 @@ if __name__ == '__main__':
             if res is not None:
                 print(res)
 
+        elif cmd == "bulksend":
+            # sends every pubcert.json under a directory (e.g., from keyfactory.py provision)
+            d = input("Directory of certificates [provisioned]? ").strip() or "provisioned"
+            files = sorted(glob.glob(os.path.join(d, "**", "pubcert.json"), recursive=True))
+            res = postManyToServer([Certificate.FromFile(f) for f in files])
+            if res is not None:
+                bad = [r for r in res if not r["ok"]]
+                print(f"Sent {len(res) - len(bad)} of {len(res)} certificates.")
+                for r in bad:
+                    print(f'  {r["username"]}: {r["error"]}')
+
         elif cmd == "download":
             downloadFromServer("keys-downloaded.json")
 
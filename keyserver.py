@@ -15,9 +15,29 @@
 #  - a request to get a node's status in the database (or all):
 #       -- /NODES    <-- all nodes in a list
 #       -- /NODES?un=<uname>
+#       -- /NODES?live_within=<seconds>  <-- only nodes heard from that recently
 #  - a request to set a node's status in the database:
 #       -- /ONLINE?un=<uname>
 #       -- /OFFLINE?un=<uname>
+#       -- /HEARTBEAT?un=<uname>   <-- "still here" (refreshes lastseen)
+#    /ONLINE and /HEARTBEAT may add &port=<port> for a node that isn't
+#    listening on the usual CONST_NODE_PORT (/v2/nodes lists each node's port).
+#    Nodes that haven't sent /ONLINE or /HEARTBEAT for a while (the node TTL)
+#    are expired by a background thread, a few at a time.
+#  - structured (version 2) JSON versions of /KEYS and /NODES, keyed by uname:
+#       -- /v2/keys      /v2/keys?un=<uname>
+#       -- /v2/nodes     /v2/nodes?un=<uname>     /v2/nodes?live_within=<seconds>
+#  - timings and counters for monitoring, in the Prometheus text format:
+#       -- /METRICS
+#    These send an ETag (answer If-None-Match with 304 Not Modified), and the
+#    full listings are gzipped for clients that send "Accept-Encoding: gzip".
+#
+# Many keys can be added at once by POSTing to /v2/keys: either a JSON array
+# of certificates, or one certificate per line (NDJSON).  They're all written
+# in one transaction, and the response says what happened to each one.
+#
+# Requests are logged as sampled events (sizes and hashes, never bodies);
+# see eventlog.py.
 #
 # (c) 2024 Sid Stamm <stammsl@rose-hulman.edu>
 # 
@@ -25,31 +45,84 @@
 # for databasey stuff
 import sqlite3
 
+import gzip
+import hashlib
 import json
+import threading
 import urllib.parse
 from urllib.request import pathname2url
 
 import onions
+from metrics import MetricsRegistry, CONST_COUNT_BUCKETS, CONST_METRICS_TYPE
+from eventlog import EventLog, HTTPLogMixin, digest
 
 KEYDB = "keys.sqlite3"
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+# Most certificates accepted in one bulk POST.
+CONST_MAX_BULK_CERTS = 10000
+
+# Seconds without an /ONLINE or /HEARTBEAT before a node is expired.
+CONST_NODE_TTL = 180
+
+# Most nodes expired per database transaction (see NodeReaper).
+CONST_EXPIRE_BATCH = 100
+
+# Endpoints timed separately in /METRICS (anything else counts as "other").
+CONST_ENDPOINTS = ("/v2/keys", "/v2/nodes", "/KEYS", "/NODES", "/ONLINE", "/OFFLINE",
+                   "/HEARTBEAT", "/METRICS", "/")
+
+from http.server import BaseHTTPRequestHandler
+from onionserver import BoundedThreadingHTTPServer, KeepAliveMixin, CONST_MAX_WORKERS, CONST_MAX_QUEUED, CONST_KEEPALIVE_TIMEOUT
 import logging
 
+def _event(category, name, level=logging.INFO, **fields):
+    """Shortcut: logs a (sampled) structured event (see eventlog.py).
+    """
+    return EventLog.Default().event(category, name, level, **fields)
+
 class KeyDatabase():
 
     DBFILE="keys.sqlite3"
 
+    # sqlite keeps this many prepared statements per connection, so reusing a
+    # connection means our (parameterized) queries are only compiled once.
+    CACHED_STATEMENTS = 64
+
+    # one long-lived connection per server thread (see ForThread)
+    _local = threading.local()
+
+    # the full certs listing, kept in memory until a cert is added/changed
+    _certs_cache = None
+    _certs_lock = threading.Lock()
+
     def __init__(self):
         try:
             dburl = pathname2url(KeyDatabase.DBFILE)
             dburi = f'file:{dburl}?mode=rw'
-            self._con = sqlite3.connect(dburi, uri=True)
+            self._con = sqlite3.connect(dburi, uri=True, cached_statements=KeyDatabase.CACHED_STATEMENTS)
         except sqlite3.OperationalError:
             # DB did not exist, this will create it
-            self._con = sqlite3.connect(KeyDatabase.DBFILE)
+            self._con = sqlite3.connect(KeyDatabase.DBFILE, cached_statements=KeyDatabase.CACHED_STATEMENTS)
             self.InitializeDatabase()
 
+        # WAL lets readers keep going while a writer commits, and needs far
+        # fewer fsyncs than the default rollback journal.
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self.UpgradeDatabase()
+
+    def ForThread():
+        """Returns this thread's KeyDatabase, connecting the first time it's used.
+        Don't Disconnect() it; it is reused by the thread's later requests.
+        """
+        local = KeyDatabase._local
+        db = getattr(local, "db", None)
+        if db is None or local.dbfile != KeyDatabase.DBFILE:
+            db = KeyDatabase()
+            local.db = db
+            local.dbfile = KeyDatabase.DBFILE
+        return db
+
     def Disconnect(self):
         self._con.close()
 
@@ -65,50 +138,129 @@ class KeyDatabase():
             'pubkey' is base64 encoded for integrity
 
         Connections are managed in the 'nodes' table:
-            nodes(uname, ip, lastseen)
+            nodes(uname, ip, lastseen, port)
             'uname' is the username for the owner of the Node (so the right pubkey can be used)
                     (This is the PRIMARY KEY)
             'ip' is the IP address where the node is listening to HTTP
             'lastseen' is a timestamp updated when the node was last verified online
+                       (by /ONLINE or /HEARTBEAT), indexed so old ones can be found quickly
+            'port' is the port the node listens on (NULL means CONST_NODE_PORT)
         """
         cur = self._con.cursor()
         if soft:
             cur.executescript("""
                 BEGIN;
                 CREATE TABLE if NOT EXISTS certs(uname PRIMARY KEY, name, pubkey);
-                CREATE TABLE if NOT EXISTS nodes(uname PRIMARY KEY, ip, lastseen);
+                CREATE TABLE if NOT EXISTS nodes(uname PRIMARY KEY, ip, lastseen, port);
                 COMMIT;
             """)
         else:
             cur.executescript("""
                 BEGIN;
                 CREATE TABLE certs(uname PRIMARY KEY, name, pubkey);
-                CREATE TABLE nodes(uname PRIMARY KEY, ip, lastseen);
+                CREATE TABLE nodes(uname PRIMARY KEY, ip, lastseen, port);
                 COMMIT;
             """)
 
-    def ClearNode(self, uname):
-        cur = self._con.cursor()
-        cur.execute("DELETE FROM nodes WHERE uname = ?", (uname,))
-        self._con.commit()
+    def _timed(query):
+        """Times a database query into keyserver_query_seconds{query=...}.
+        """
+        return MetricsRegistry.Default().histogram("keyserver_query_seconds",
+                                                   "Time spent in SQLite, per query", query=query).time()
 
-    def SetNode(self, uname, ip):
-        cur = self._con.cursor()
-        cur.execute("INSERT OR REPLACE INTO nodes VALUES ( ?, ?, CURRENT_TIMESTAMP )", (uname, ip,))
-        self._con.commit()
+    def _rows(query, rows):
+        """Records how many rows a query returned (and returns them).
+        """
+        MetricsRegistry.Default().histogram("keyserver_query_rows", "Rows returned, per query",
+                                            CONST_COUNT_BUCKETS, query=query).observe(len(rows))
+        return rows
+
+    def UpgradeDatabase(self):
+        """Adds columns and indexes that older databases may be missing.
+        """
+        with self._con:
+            columns = [row[1] for row in self._con.execute("PRAGMA table_info(nodes)")]
+            if "port" not in columns:
+                self._con.execute("ALTER TABLE nodes ADD COLUMN port")
+            self._con.execute("CREATE INDEX IF NOT EXISTS nodes_lastseen ON nodes(lastseen)")
 
-    def GetNodes(self, uname=None):
+    def ClearNode(self, uname):
+        with KeyDatabase._timed("ClearNode"):
+            cur = self._con.cursor()
+            cur.execute("DELETE FROM nodes WHERE uname = ?", (uname,))
+            self._con.commit()
+
+    def SetNode(self, uname, ip, port=None):
+        with KeyDatabase._timed("SetNode"):
+            cur = self._con.cursor()
+            cur.execute("INSERT OR REPLACE INTO nodes (uname, ip, lastseen, port) VALUES ( ?, ?, CURRENT_TIMESTAMP, ? )",
+                        (uname, ip, port))
+            self._con.commit()
+
+    def Heartbeat(self, uname, ip, port=None):
+        """Refreshes a node's lastseen (and address).  A node that had already
+        been expired is added back.
+        """
+        with KeyDatabase._timed("Heartbeat"), self._con:
+            cur = self._con.execute("UPDATE nodes SET ip = ?, port = ?, lastseen = CURRENT_TIMESTAMP WHERE uname = ?",
+                                    (ip, port, uname))
+            if cur.rowcount == 0:
+                self._con.execute("INSERT OR REPLACE INTO nodes (uname, ip, lastseen, port) VALUES ( ?, ?, CURRENT_TIMESTAMP, ? )",
+                                  (uname, ip, port))
+
+    def ExpireNodes(self, ttl, limit=CONST_EXPIRE_BATCH):
+        """Removes up to limit nodes not seen for ttl seconds (oldest first,
+        found with the lastseen index).
+
+        @return how many nodes were removed
+        """
+        with KeyDatabase._timed("ExpireNodes"), self._con:
+            cur = self._con.execute("""
+                DELETE FROM nodes WHERE rowid IN (
+                    SELECT rowid FROM nodes WHERE lastseen < datetime('now', ?)
+                    ORDER BY lastseen LIMIT ? )""", (f"-{int(ttl)} seconds", limit))
+        return cur.rowcount
+
+    def GetNodes(self, uname=None, live_within=None):
+        """Returns node rows, (uname, ip, lastseen, port) each (all of them, or
+        just uname's), optionally only those seen in the last live_within seconds.
+        """
         cur = self._con.cursor()
+        sql = "SELECT uname, ip, lastseen, port FROM nodes"
+        where = []
+        args = []
         if uname is not None:
-            cur.execute("SELECT * FROM nodes WHERE uname = ?", (uname,))
-        else:
-            cur.execute("SELECT * FROM nodes")
-        return cur.fetchall()
+            where.append("uname = ?")
+            args.append(uname)
+        if live_within is not None:
+            where.append("lastseen >= datetime('now', ?)")
+            args.append(f"-{int(live_within)} seconds")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with KeyDatabase._timed("GetNodes"):
+            cur.execute(sql, args)
+            rows = cur.fetchall()
+        return KeyDatabase._rows("GetNodes", rows)
 
     def SetCertWithFields(self, uname, name, key):
-        cur = self._con.cursor()
-        cur.execute("INSERT OR REPLACE INTO certs VALUES ( ?, ?, ? )", (uname, name, key))
-        self._con.commit()
+        with KeyDatabase._timed("SetCert"):
+            cur = self._con.cursor()
+            cur.execute("INSERT OR REPLACE INTO certs VALUES ( ?, ?, ? )", (uname, name, key))
+            self._con.commit()
+        KeyDatabase.InvalidateCerts()
+
+    def SetCertsWithFields(self, rows):
+        """Adds/updates many certs, (uname, name, key) each, in one transaction.
+        """
+        with KeyDatabase._timed("SetCerts"), self._con:
+            self._con.executemany("INSERT OR REPLACE INTO certs VALUES ( ?, ?, ? )", rows)
+        KeyDatabase.InvalidateCerts()
+
+    def InvalidateCerts():
+        """Forgets the in-memory certs listing (call after changing the certs table).
+        """
+        with KeyDatabase._certs_lock:
+            KeyDatabase._certs_cache = None
 
     def SetCert(self, cert : onions.Certificate):
         """Uses a Pathetic Certificate instance, and adds it to the DB.
@@ -116,22 +268,143 @@ class KeyDatabase():
         self.SetCertWithFields(cert._uname, cert._name, cert.KeyAsPEM().decode('utf-8'))
 
     def GetCerts(self, uname=None):
+        """Returns cert rows (all of them, or just uname's).  The full listing
+        is served from memory until a cert changes.
+        """
         cur = self._con.cursor()
         if uname is not None:
-            cur.execute("SELECT * FROM certs WHERE uname = ?", (uname,))
-        else:
-            cur.execute("SELECT * FROM certs")
-        return cur.fetchall()
+            with KeyDatabase._timed("GetCert"):
+                cur.execute("SELECT * FROM certs WHERE uname = ?", (uname,))
+                rows = cur.fetchall()
+            return KeyDatabase._rows("GetCert", rows)
+
+        with KeyDatabase._certs_lock:
+            if KeyDatabase._certs_cache is None:
+                with KeyDatabase._timed("GetCerts"):
+                    cur.execute("SELECT * FROM certs")
+                    KeyDatabase._certs_cache = cur.fetchall()
+                KeyDatabase._rows("GetCerts", KeyDatabase._certs_cache)
+            return list(KeyDatabase._certs_cache)
 
 
 
-class OnionKeyServer(BaseHTTPRequestHandler):
-    def _set_response(self, content_type='text/html', resp_code=200):
+class NodeReaper:
+    """Expires nodes that stopped sending heartbeats, in the background.
+
+    Every so often (a quarter of the TTL) it deletes expired nodes a batch at
+    a time, so requests never wait on a big delete, and no request has to
+    scan the table for old nodes.
+    """
+
+    def __init__(self, ttl=CONST_NODE_TTL, interval=None, batch=CONST_EXPIRE_BATCH):
+        self.ttl = ttl
+        self.interval = interval if interval is not None else max(1, ttl / 4)
+        self.batch = batch
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="node-reaper", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def expire(self):
+        """Expires every node past the TTL, one batch per transaction.
+
+        @return how many nodes were removed
+        """
+        db = KeyDatabase.ForThread()
+        total = 0
+        while not self._stop.is_set():
+            n = db.ExpireNodes(self.ttl, self.batch)
+            total += n
+            if n < self.batch:
+                break
+        if total:
+            logging.info("Expired %d nodes not seen in %d seconds", total, self.ttl)
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.expire()
+            except sqlite3.Error as e:
+                logging.warning("Could not expire nodes: %s", e)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class OnionKeyServer(KeepAliveMixin, HTTPLogMixin, BaseHTTPRequestHandler):
+    # Speak HTTP/1.1 so clients can keep their connections open between requests.
+    protocol_version = "HTTP/1.1"
+    timeout = CONST_KEEPALIVE_TIMEOUT
+    # Headers and body go out in separate writes; without TCP_NODELAY, Nagle's
+    # algorithm holds the body back until the client's delayed ACK (~40ms)
+    # on every request after the first one on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    def _set_response(self, content_type='text/html', resp_code=200, body=b'', headers=None):
+        """Sends a complete response.  (With keep-alive, every response needs
+        a Content-Length so the client knows where it ends.)
+        """
         self.send_response(resp_code)
         self.send_header('Content-type', content_type)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
+
+    def _send_v2(self, obj, compress=False):
+        """Sends a version 2 JSON response with an ETag.
+        Answers 304 if the client already has this version (If-None-Match),
+        and gzips the body if compress is set and the client accepts gzip.
+        """
+        body = json.dumps(obj, sort_keys=True).encode('utf-8')
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+        inm = self.headers.get('If-None-Match', '')
+        if etag in [t.strip() for t in inm.split(',')] or inm.strip() == '*':
+            self._set_response(content_type="application/json", resp_code=304,
+                               headers={'ETag': etag})
+            return
+
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+        if compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self._set_response(content_type="application/json", body=body, headers=headers)
+
+    def _endpoint(self):
+        """The endpoint this request is for, as a metrics label.
+        """
+        path = self.path.split('?', 1)[0]
+        for e in CONST_ENDPOINTS:
+            if path == e or (e != "/" and path.startswith(e)):
+                return e
+        return "other"
+
+    def _timeRequest(self, method, handler):
+        endpoint = self._endpoint()
+        with MetricsRegistry.Default().histogram("keyserver_request_seconds", "Time to handle a request",
+                                                 method=method, endpoint=endpoint).time():
+            handler()
+
+    def _recordRows(self, rows):
+        """Records how many rows this request's endpoint sent back.
+        """
+        MetricsRegistry.Default().histogram("keyserver_endpoint_rows", "Rows returned, per endpoint",
+                                            CONST_COUNT_BUCKETS, endpoint=self._endpoint()).observe(len(rows))
+        return rows
 
     def do_GET(self):
+        self._timeRequest("GET", self._handleGET)
+
+    def do_POST(self):
+        self._timeRequest("POST", self._handlePOST)
+
+    def _handleGET(self):
         """GET requests have multiple endpoint options:
             - a request for all the keys
                  -- /KEYS
@@ -140,70 +413,154 @@ class OnionKeyServer(BaseHTTPRequestHandler):
             - a request to get a node's status in the database (or all):
                  -- /NODES    <-- all nodes in a list
                  -- /NODES?un=<uname>
+                 -- /NODES?live_within=<seconds>
             - a request to set a node's status in the database:
-                 -- /ONLINE?un=<uname>
+                 -- /ONLINE?un=<uname>[&port=<port>]
                  -- /OFFLINE?un=<uname>
+                 -- /HEARTBEAT?un=<uname>[&port=<port>]
+            - metrics:
+                 -- /METRICS
+            - version 2 (structured JSON) directory requests:
+                 -- /v2/keys, /v2/keys?un=<uname>
+                 -- /v2/nodes, /v2/nodes?un=<uname>
         """
-        #logging.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        logging.info("GET request,\nPath: %s\n", str(self.path))
+        _event("request", "get", path=self.path)
 
         qs = urllib.parse.urlparse(self.path).query
         qs = urllib.parse.parse_qs(qs)
 
         # grab some query parameters just in case
         uname = qs['un'][0] if 'un' in qs else None
+        try:
+            live_within = int(qs['live_within'][0]) if 'live_within' in qs else None
+        except ValueError:
+            self._set_response(resp_code=400, body="live_within must be a number of seconds".encode('utf-8'))
+            return
+        try:
+            port = int(qs['port'][0]) if 'port' in qs else None
+        except ValueError:
+            self._set_response(resp_code=400, body="port must be a number".encode('utf-8'))
+            return
 
         if self.path == "/favicon.ico":
-            self._set_response(content_type="image/x-icon")
-            self.wfile.write(b'')
+            self._set_response(content_type="image/x-icon", body=b'')
+
+        elif self.path == "/METRICS":
+            body = MetricsRegistry.Default().render().encode('utf-8')
+            self._set_response(content_type=CONST_METRICS_TYPE, body=body)
+
+        elif self.path.startswith("/v2/keys"):
+            db = KeyDatabase.ForThread()
+            ks = self._recordRows(db.GetCerts(uname=uname))
+            keys = {u: {"name": n, "pubkey": k} for u, n, k in ks}
+            self._send_v2({"version": 2, "keys": keys}, compress=uname is None)
+
+        elif self.path.startswith("/v2/nodes"):
+            db = KeyDatabase.ForThread()
+            ks = self._recordRows(db.GetNodes(uname=uname, live_within=live_within))
+            nodes = {u: {"ip": ip, "lastseen": seen, "port": port or onions.CONST_NODE_PORT}
+                     for u, ip, seen, port in ks}
+            self._send_v2({"version": 2, "nodes": nodes}, compress=uname is None)
 
         elif self.path.startswith("/KEYS"):
-            db = KeyDatabase()
-            ks = db.GetCerts(uname=uname)
-            db.Disconnect()
-            self._set_response(content_type="application/json")
-            self.wfile.write(json.dumps(ks).encode('utf-8'))
+            db = KeyDatabase.ForThread()
+            ks = self._recordRows(db.GetCerts(uname=uname))
+            self._set_response(content_type="application/json", body=json.dumps(ks).encode('utf-8'))
 
         elif self.path.startswith("/NODES"):
-            db = KeyDatabase()
-            ks = db.GetNodes(uname=uname)
-            db.Disconnect()
-            self._set_response(content_type="application/json")
-            self.wfile.write(json.dumps(ks).encode('utf-8'))
+            db = KeyDatabase.ForThread()
+            ks = self._recordRows(db.GetNodes(uname=uname, live_within=live_within))
+            # the legacy listing stays (uname, ip, lastseen): use /v2/nodes for ports
+            ks = [row[:3] for row in ks]
+            self._set_response(content_type="application/json", body=json.dumps(ks).encode('utf-8'))
         elif self.path.startswith("/ONLINE"):
             if uname is None:
-                self._set_response(resp_code=500)
-                self.wfile.write("Going online requires node ID (uname)".encode('utf-8'))
+                self._set_response(resp_code=500, body="Going online requires node ID (uname)".encode('utf-8'))
             else:
-                db = KeyDatabase()
-                ks = db.SetNode(uname=uname, ip=self.client_address[0])
-                db.Disconnect()
-                self._set_response()
-                self.wfile.write("Node Online".encode('utf-8'))
+                db = KeyDatabase.ForThread()
+                ks = db.SetNode(uname=uname, ip=self.client_address[0], port=port)
+                self._set_response(body="Node Online".encode('utf-8'))
+
+        elif self.path.startswith("/HEARTBEAT"):
+            if uname is None:
+                self._set_response(resp_code=500, body="Heartbeats require node ID (uname)".encode('utf-8'))
+            else:
+                db = KeyDatabase.ForThread()
+                db.Heartbeat(uname=uname, ip=self.client_address[0], port=port)
+                self._set_response(body=b"OK")
 
         elif self.path.startswith("/OFFLINE"):
             if uname is None:
-                self._set_response(resp_code=500)
-                self.wfile.write("Going offline requires node ID (uname)".encode('utf-8'))
+                self._set_response(resp_code=500, body="Going offline requires node ID (uname)".encode('utf-8'))
             else:
-                db = KeyDatabase()
+                db = KeyDatabase.ForThread()
                 ks = db.ClearNode(uname=uname)
-                db.Disconnect()
-                self._set_response()
-                self.wfile.write("Node Removed".encode('utf-8'))
+                self._set_response(body="Node Removed".encode('utf-8'))
 
         else:
-            self._set_response()
-            self.wfile.write("Sorry, I don't respond to GET requests.".encode('utf-8'))
+            self._set_response(body="Sorry, I don't respond to GET requests.".encode('utf-8'))
 
-    def do_POST(self):
+    def _readBulkCerts(self, post_data):
+        """Splits a bulk POST body (a JSON array, or NDJSON) into certificate objects.
+        """
+        text = post_data.decode('utf-8').strip()
+        if text.startswith('['):
+            return json.loads(text)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    def _bulkPOST(self, post_data):
+        """Adds many certificates at once (see the top of this file).
+        Every entry is checked, the good ones are written in one transaction,
+        and the response lists a result for each entry, in order.
+        """
+        try:
+            entries = self._readBulkCerts(post_data)
+        except (ValueError, UnicodeDecodeError) as e:
+            self._set_response(resp_code=400, body=f"Could not read certificates: {e}".encode('utf-8'))
+            return
+        if len(entries) > CONST_MAX_BULK_CERTS:
+            self._set_response(resp_code=413,
+                               body=f"At most {CONST_MAX_BULK_CERTS} certificates per request.".encode('utf-8'))
+            return
+
+        results = []
+        rows = []
+        for entry in entries:
+            try:
+                cert = onions.Certificate.FromDict(entry)
+                if not cert.isPublic():
+                    raise ValueError("not a public key certificate")
+                rows.append((cert._uname, cert._name, cert.KeyAsPEM().decode('utf-8')))
+                results.append({"username": cert._uname, "ok": True})
+            except KeyError as e:
+                uname = entry.get("username")
+                results.append({"username": uname, "ok": False, "error": f"missing field {e}"})
+            except Exception as e:
+                uname = entry.get("username") if isinstance(entry, dict) else None
+                results.append({"username": uname, "ok": False, "error": str(e) or type(e).__name__})
+
+        try:
+            if rows:
+                KeyDatabase.ForThread().SetCertsWithFields(rows)
+        except sqlite3.Error as e:
+            logging.error("Bulk certificate write failed: %s", e)
+            self._set_response(resp_code=500, body="Could not store the certificates.".encode('utf-8'))
+            return
+
+        _event("cert", "bulk_stored", bytes=len(post_data), entries=len(entries), stored=len(rows))
+        body = json.dumps({"version": 2, "stored": len(rows), "results": results}).encode('utf-8')
+        self._set_response(content_type="application/json", body=body)
+
+    def _handlePOST(self):
         """ When a post comes in, look for a key/cert and then either update the
-        db or add it.
+        db or add it.  (POSTs to /v2/keys add many at once.)
         """
         content_length = int(self.headers['Content-Length']) # <--- Gets the size of data
         post_data = self.rfile.read(content_length) # <--- Gets the data itself
-        logging.info("POST request received,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
-                str(self.path), str(self.headers), post_data.decode('utf-8'))
+
+        if self.path.startswith("/v2/keys"):
+            self._bulkPOST(post_data)
+            return
 
         try:
             msg = urllib.parse.unquote(post_data.decode('utf-8'))
@@ -212,22 +569,25 @@ class OnionKeyServer(BaseHTTPRequestHandler):
             cert = onions.Certificate.FromJSON(msg)
 
             # Enter the cert into the database
-            db = KeyDatabase()
+            db = KeyDatabase.ForThread()
             db.SetCert(cert)
-            db.Disconnect()
 
-            self._set_response()
-            self.wfile.write("Thanks for the message.  :)".encode('utf-8'))
-            print(msg)
+            self._set_response(body="Thanks for the message.  :)".encode('utf-8'))
+            _event("cert", "stored", uname=cert._uname, bytes=len(post_data), sha256=lambda: digest(post_data))
 
         except Exception as e:
-            self.send_response(500)
-            print("ERROR decoding POST: ", e)
-
-def run(server_class=HTTPServer, handler_class=OnionKeyServer, port=onions.CONST_KEYSERVER_PORT):
-    logging.basicConfig(level=logging.INFO)
+            self._set_response(resp_code=500, body="Could not read that certificate.".encode('utf-8'))
+            _event("error", "bad_cert", logging.WARNING, bytes=len(post_data), error=str(e))
+
+def run(server_class=BoundedThreadingHTTPServer, handler_class=OnionKeyServer, port=onions.CONST_KEYSERVER_PORT,
+        max_workers=CONST_MAX_WORKERS, max_queued=CONST_MAX_QUEUED, node_ttl=CONST_NODE_TTL,
+        log_sampling=None):
+    EventLog.Start()
+    if log_sampling is not None:
+        EventLog.SetDefault(EventLog(log_sampling))
     server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
+    httpd = server_class(server_address, handler_class, max_workers=max_workers, max_queued=max_queued)
+    reaper = NodeReaper(ttl=node_ttl).start()
     logging.info('Starting RHIT Onion KEYSERVER...\n')
 
     try:
@@ -235,13 +595,35 @@ def run(server_class=HTTPServer, handler_class=OnionKeyServer, port=onions.CONST
     except KeyboardInterrupt:
         pass
 
+    reaper.stop()
+    httpd.drain()
     httpd.server_close()
     logging.info('Stopping RHIT Onion KEYSERVER...\n')
+    EventLog.Stop()
 
 if __name__ == '__main__':
     from sys import argv
 
-    if len(argv) == 2:
-        run(port=int(argv[1]))
+    # usage: keyserver.py [--node-ttl seconds] [--db file] [--log-sample category=rate,...]
+    #                     [port [max_workers]]
+    node_ttl = CONST_NODE_TTL
+    log_sampling = None
+    if "--log-sample" in argv:
+        i = argv.index("--log-sample")
+        log_sampling = EventLog.ParseRates(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    if "--db" in argv:
+        i = argv.index("--db")
+        KeyDatabase.DBFILE = argv[i + 1]
+        argv = argv[:i] + argv[i + 2:]
+    if "--node-ttl" in argv:
+        i = argv.index("--node-ttl")
+        node_ttl = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+
+    if len(argv) == 3:
+        run(port=int(argv[1]), max_workers=int(argv[2]), node_ttl=node_ttl, log_sampling=log_sampling)
+    elif len(argv) == 2:
+        run(port=int(argv[1]), node_ttl=node_ttl, log_sampling=log_sampling)
     else:
-        run(port=onions.CONST_KEYSERVER_PORT)
\ No newline at end of file
+        run(port=onions.CONST_KEYSERVER_PORT, node_ttl=node_ttl, log_sampling=log_sampling)
\ No newline at end of file
@@ -0,0 +1,438 @@
+#
+# loadtest.py
+#
+# A headless load generator for a whole onion network on one machine.
+#
+# It starts a keyserver on a temporary SQLite file and N Onion Nodes on
+# loopback ports (each in its own process and working directory, with its own
+# keypair), waits for them all to come online, and then sends multi-hop onions
+# through random paths at a target rate, for a few rates in turn.
+#
+# For each rate it reports:
+#   - circuit latency percentiles: from when an onion was due to be sent until
+#     the first hop answered (which is after the last hop got the message;
+#     onions that had to wait for a free sender count that wait too)
+#   - the throughput achieved and the error rate
+#   - a per-hop breakdown of where the time went at each node (reading the
+#     body, parsing, peeling, looking up the next hop, forwarding), taken from
+#     the nodes' /METRICS
+# and then the saturation point: the first rate the network couldn't keep up
+# with (too slow, too many errors, or too high a p99 latency).
+#
+# Command line:
+#
+#     python3 ./loadtest.py [--nodes 5] [--hops 3] [--rates 5,10,20,40,80]
+#                           [--duration 10] [--concurrency 16] [--key-size 127]
+#                           [--batch] [--keep] [--save results.json]
+#
+# --batch starts the nodes in batch forwarding mode (see onionNode.py).
+# --keep leaves the temporary directory (logs, database, keys) behind.
+#
+
+import concurrent.futures
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmark import percentile
+from directory import DirectoryCache
+from keyfactory import KeyFactory, provisionToDirectory
+from keymanager import postManyToServer
+from onions import DirectoryClient, CONST_KEY_SIZE, CONST_ONION_BINARY_TYPE, CONST_ONION_V2
+from onionSender import CircuitBuilder
+from pathselect import NodeStats, PathSelector
+from transport import Transport
+
+CONST_LOAD_NODES = 5
+CONST_LOAD_HOPS = 3
+CONST_LOAD_RATES = [5, 10, 20, 40, 80]     # onions/second, tried in order
+CONST_LOAD_DURATION = 10                    # seconds per rate
+CONST_LOAD_CONCURRENCY = 16                 # onions in flight, at most
+CONST_LOAD_MESSAGE = 256                    # bytes per message
+
+# Seconds to wait for the keyserver and nodes to come up.
+CONST_STARTUP_TIMEOUT = 30
+
+# A rate is past the saturation point if the network delivers less than this
+# fraction of it, fails more than this fraction of onions, or has a p99
+# latency over this many seconds.
+CONST_SATURATION_THROUGHPUT = 0.9
+CONST_SATURATION_ERRORS = 0.01
+CONST_SATURATION_P99 = 1.0
+
+# Node histograms in the per-hop breakdown (see onionNode.py), by stage.
+CONST_HOP_STAGES = {
+    "read": "onion_body_read_seconds",
+    "parse": "onion_parse_seconds",
+    "peel": "onion_peel_seconds",
+    "lookup": "onion_lookup_seconds",
+    "forward": "onion_forward_seconds",
+}
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _freePort():
+    """Returns a loopback port nobody is listening on (right now).
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _waitFor(check, what, timeout=CONST_STARTUP_TIMEOUT):
+    """Calls check() until it returns True.
+
+    @raise TimeoutError if it doesn't within timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"Timed out waiting for {what}")
+
+
+def scrapeMetrics(url):
+    """Reads a /METRICS page, adding up each metric over all its labels.
+
+    @return {metric name: total}, e.g. {"onion_peel_seconds_sum": 0.25, ...}
+    """
+    r = requests.get(url, timeout=5)
+    r.raise_for_status()
+    totals = {}
+    for line in r.text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        name = name.split('{', 1)[0]
+        totals[name] = totals.get(name, 0.0) + float(value)
+    return totals
+
+
+class LocalNetwork:
+    """A keyserver and some Onion Nodes, each in its own process, on loopback.
+
+    Sample usage:
+    >     with LocalNetwork(nodes=5) as net:
+    >         path = PathSelector(directory=net.directory).select(3, recipient="load0")
+    >         CircuitBuilder(directory=net.directory).send(path, b"Hi!", transport=net.transport)
+    """
+
+    def __init__(self, nodes=CONST_LOAD_NODES, key_size=CONST_KEY_SIZE, keep=False,
+                 pool_size=CONST_LOAD_CONCURRENCY, node_args=()):
+        self.nodes = nodes
+        self.node_args = list(node_args)
+        self.key_size = key_size
+        self.keep = keep
+        self.pool_size = pool_size
+        self.workdir = None
+        self.keyserver_port = None
+        self.ports = {}             # uname -> port
+        self.transport = None
+        self.directory = None
+        self._procs = []            # (name, Popen, log file), keyserver first
+
+    def _spawn(self, name, script, args, cwd):
+        log = open(os.path.join(self.workdir, name + ".log"), 'w')
+        proc = subprocess.Popen([sys.executable, os.path.join(_HERE, script)] + args,
+                                cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        self._procs.append((name, proc, log))
+        return proc
+
+    def start(self):
+        """Starts the keyserver, makes and uploads a keypair per node, starts
+        the nodes, and waits until the keyserver lists them all.
+        """
+        self.workdir = tempfile.mkdtemp(prefix="onion-load-")
+
+        self.keyserver_port = _freePort()
+        self._spawn("keyserver", "keyserver.py",
+                    ["--db", os.path.join(self.workdir, "keys.sqlite3"), str(self.keyserver_port)],
+                    self.workdir)
+        url = f"http://127.0.0.1:{self.keyserver_port}"
+        _waitFor(lambda: requests.get(url + "/METRICS", timeout=1).ok, "the keyserver")
+
+        self.transport = Transport(keyserver_url=url, pool_size=self.pool_size)
+        Transport.SetDefault(self.transport)
+        self.directory = DirectoryCache(transport=self.transport)
+
+        users = [(f"Load Node {i}", f"load{i}") for i in range(self.nodes)]
+        factory = KeyFactory(fname=os.path.join(self.workdir, "keypool.json"))
+        try:
+            certs = provisionToDirectory(users, self.key_size, self.workdir, factory)
+        finally:
+            factory.close()
+        results = postManyToServer([pub for pub, _ in certs])
+        if results is None or not all(r["ok"] for r in results):
+            raise Exception(f"Could not upload the nodes' keys: {results}")
+
+        for _, uname in users:
+            port = _freePort()
+            self.ports[uname] = port
+            self._spawn(uname, "onionNode.py", ["--port", str(port), "--keyserver", url] + self.node_args,
+                        os.path.join(self.workdir, uname))
+
+        def allOnline():
+            nodes, _ = DirectoryClient.FetchNodes(transport=self.transport)
+            return all(nodes.get(u, (None, None, None))[2] == p for u, p in self.ports.items())
+        _waitFor(allOnline, f"{self.nodes} nodes to come online")
+        self.directory.refreshKeys()
+        self.directory.refreshNodes()
+        return self
+
+    def metricsURL(self, uname):
+        return f"http://127.0.0.1:{self.ports[uname]}/METRICS"
+
+    def stop(self):
+        """Stops the nodes (so they go offline cleanly), then the keyserver,
+        and removes the temporary directory unless keep is set.
+        """
+        for name, proc, log in reversed(self._procs):
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            log.close()
+        self._procs = []
+        if self.transport is not None:
+            self.transport.close()
+        if self.workdir is not None:
+            if self.keep:
+                print(f"Logs, keys and database kept in {self.workdir}")
+            else:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        try:
+            return self.start()
+        except BaseException:
+            self.stop()
+            raise
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class LoadGenerator:
+    """Sends onions through a LocalNetwork at a fixed rate (open loop: an
+    onion's send time doesn't depend on how earlier ones went), at most
+    `concurrency` at a time.
+    """
+
+    def __init__(self, network, hops=CONST_LOAD_HOPS, concurrency=CONST_LOAD_CONCURRENCY,
+                 message_size=CONST_LOAD_MESSAGE, rng=None):
+        self.network = network
+        self.hops = hops
+        self.concurrency = concurrency
+        self.message_size = message_size
+        self._rng = rng or random.Random()
+        # fresh stats, so every node is equally likely to be picked
+        self._selector = PathSelector(directory=network.directory, stats=NodeStats(), rng=self._rng)
+        # every node here is this version, so they can all peel hybrid layers
+        self._builder = CircuitBuilder(directory=network.directory, version=CONST_ONION_V2)
+
+    def prepare(self, count):
+        """Builds count onions ahead of time (so building them isn't timed).
+
+        @return a list of (first hop's ip, port, onion bytes)
+        """
+        directory = self.network.directory
+        onions = []
+        for i in range(count):
+            recipient = self._rng.choice(sorted(self.network.ports))
+            path = self._selector.select(self.hops, recipient=recipient)
+            message = (f"load test onion {i} " * self.message_size)[:self.message_size]
+            ip, port = directory.getAddress(path[0])
+            onions.append((ip, port, self._builder.build(path, message)))
+        return onions
+
+    def _send(self, due, ip, port, onion):
+        """Sends one onion.
+
+        @return (seconds since it was due, ok)
+        """
+        try:
+            r = self.network.transport.nodePost(ip, onion, port=port,
+                                                headers={"Content-Type": CONST_ONION_BINARY_TYPE})
+            ok = r.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return time.perf_counter() - due, ok
+
+    def scrape(self):
+        """Returns {uname: metrics totals} for every node.
+        """
+        return {u: scrapeMetrics(self.network.metricsURL(u)) for u in self.network.ports}
+
+    def step(self, rate, duration=CONST_LOAD_DURATION):
+        """Sends rate onions/second for duration seconds and measures them.
+
+        @return a dict of results (see the top of this file)
+        """
+        onions = self.prepare(max(1, int(rate * duration)))
+        before = self.scrape()
+
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def done(future):
+            nonlocal errors
+            latency, ok = future.result()
+            with lock:
+                if ok:
+                    latencies.append(latency)
+                else:
+                    errors += 1
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            start = time.perf_counter()
+            for i, (ip, port, onion) in enumerate(onions):
+                due = start + i / rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self._send, due, ip, port, onion).add_done_callback(done)
+        elapsed = time.perf_counter() - start
+
+        after = self.scrape()
+        latencies.sort()
+        sent = len(onions)
+        result = {
+            "rate": rate,
+            "sent": sent,
+            "ok": len(latencies),
+            "errors": errors,
+            "error_rate": errors / sent,
+            "achieved": len(latencies) / elapsed,
+            "hops": hopBreakdown(before, after),
+        }
+        if latencies:
+            result.update({f"p{q}_s": percentile(latencies, q / 100) for q in (50, 90, 99)})
+            result["max_s"] = latencies[-1]
+        return result
+
+
+def hopBreakdown(before, after):
+    """Works out, from two scrapes of every node's metrics, the average time
+    per onion each node spent in each stage.  "self" is the time a node took
+    not counting the wait for the next hop.
+
+    @return {uname: {"onions": n, "<stage>_ms": ...}, plus "all": the same
+             over every node}
+    """
+    def delta(name, u=None):
+        names = [u] if u is not None else list(after)
+        return sum(after[n].get(name, 0.0) - before[n].get(name, 0.0) for n in names)
+
+    hops = {}
+    for u in sorted(after) + [None]:
+        n = delta("onion_request_seconds_count", u)
+        row = {"onions": int(n)}
+        for stage, metric in CONST_HOP_STAGES.items():
+            row[stage + "_ms"] = delta(metric + "_sum", u) / n * 1e3 if n else 0.0
+        total = delta("onion_request_seconds_sum", u) / n * 1e3 if n else 0.0
+        row["self_ms"] = total - row["forward_ms"]
+        hops[u if u is not None else "all"] = row
+    return hops
+
+
+def saturated(result):
+    """Says why a rate is past the saturation point (None if it isn't).
+    """
+    if result["achieved"] < CONST_SATURATION_THROUGHPUT * result["rate"]:
+        return f"only {result['achieved']:.1f}/s delivered"
+    if result["error_rate"] > CONST_SATURATION_ERRORS:
+        return f"{result['error_rate']:.1%} errors"
+    if result.get("p99_s", float("inf")) > CONST_SATURATION_P99:
+        return f"p99 {result.get('p99_s', float('inf')) * 1e3:.0f} ms"
+    return None
+
+
+def run(nodes=CONST_LOAD_NODES, hops=CONST_LOAD_HOPS, rates=CONST_LOAD_RATES, duration=CONST_LOAD_DURATION,
+        concurrency=CONST_LOAD_CONCURRENCY, key_size=CONST_KEY_SIZE, batch=False, keep=False, save=None):
+    """Starts a LocalNetwork and steps through rates until it saturates,
+    printing a table as it goes (and optionally saving the results as JSON).
+
+    @return the results document
+    """
+    if hops >= nodes:
+        raise ValueError(f"{hops} hops plus a recipient need more than {nodes} nodes")
+
+    steps = []
+    saturation = None
+    node_args = ["--batch"] if batch else []
+    with LocalNetwork(nodes, key_size, keep, pool_size=concurrency, node_args=node_args) as net:
+        gen = LoadGenerator(net, hops, concurrency)
+        print(f"{nodes} nodes, {hops} hops + recipient, {duration}s per rate, "
+              f"at most {concurrency} onions in flight" + (", batch forwarding" if batch else ""))
+        print(f'{"rate/s":>7} {"done/s":>7} {"errors":>7} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} '
+              f'{"max ms":>8}   per hop ms: {"self":>6} {"read":>6} {"parse":>6} {"peel":>6} {"lookup":>6}')
+        for rate in rates:
+            r = gen.step(rate, duration)
+            steps.append(r)
+            ms = [f'{r[k] * 1e3:>8.1f}' if k in r else f'{"-":>8}' for k in ("p50_s", "p90_s", "p99_s", "max_s")]
+            h = r["hops"]["all"]
+            print(f'{rate:>7} {r["achieved"]:>7.1f} {r["error_rate"]:>7.1%} {" ".join(ms)}   '
+                  f'{"":>11} {h["self_ms"]:>6.2f} {h["read_ms"]:>6.2f} {h["parse_ms"]:>6.2f} '
+                  f'{h["peel_ms"]:>6.2f} {h["lookup_ms"]:>6.2f}')
+            reason = saturated(r)
+            if reason is not None:
+                saturation = {"rate": rate, "reason": reason}
+                break
+
+        print()
+        print(f'{"node":<8} {"onions":>7} {"self ms":>8} {"forward ms":>11}   (last rate)')
+        for u, h in steps[-1]["hops"].items():
+            if u != "all":
+                print(f'{u:<8} {h["onions"]:>7} {h["self_ms"]:>8.2f} {h["forward_ms"]:>11.2f}')
+
+    if saturation is None:
+        print(f"Not saturated at {rates[-1]} onions/s.")
+    else:
+        ok = [s["rate"] for s in steps if saturated(s) is None]
+        last = f"; last good rate {ok[-1]}/s" if ok else ""
+        print(f"Saturated at {saturation['rate']} onions/s ({saturation['reason']}){last}.")
+
+    doc = {"nodes": nodes, "hops": hops, "duration": duration, "concurrency": concurrency,
+           "key_size": key_size, "batch": batch, "steps": steps, "saturation": saturation}
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(doc, f, indent=1)
+        print(f"Saved results to {save}")
+    return doc
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    def option(name, default, convert=int):
+        return convert(argv[argv.index(name) + 1]) if name in argv else default
+
+    run(nodes=option("--nodes", CONST_LOAD_NODES),
+        hops=option("--hops", CONST_LOAD_HOPS),
+        rates=option("--rates", CONST_LOAD_RATES, lambda s: [float(x) for x in s.split(",")]),
+        duration=option("--duration", CONST_LOAD_DURATION, float),
+        concurrency=option("--concurrency", CONST_LOAD_CONCURRENCY),
+        key_size=option("--key-size", CONST_KEY_SIZE),
+        batch="--batch" in argv,
+        keep="--keep" in argv,
+        save=option("--save", None, str))
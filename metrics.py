@@ -0,0 +1,211 @@
+#
+# metrics.py
+#
+# Cheap always-on instrumentation for the Onion Node and the keyserver.
+#
+# Histograms count observations (timings in seconds, sizes in bytes) into
+# fixed buckets, counters count events, and gauges hold a current value.
+# Recording one observation is a bisect and a few additions under a lock, so
+# it can stay on in production.
+#
+# MetricsRegistry.render() writes everything in the Prometheus text format,
+# which the servers send from GET /METRICS:
+#
+#     onion_peel_seconds_bucket{version="2",le="0.001"} 12
+#     onion_peel_seconds_sum{version="2"} 0.0153
+#     onion_peel_seconds_count{version="2"} 14
+#
+
+import bisect
+import threading
+import time
+
+# Bucket upper bounds for timings (seconds): 100us .. 30s.
+CONST_TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                      0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Bucket upper bounds for sizes (bytes): 64B .. 64MiB.
+CONST_SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(11))
+
+# Bucket upper bounds for row counts.
+CONST_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+CONST_METRICS_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(text, quotes=True):
+    """Escapes a label value (or, without quotes, HELP text) for the text format.
+    """
+    text = str(text).replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quotes else text
+
+
+def _labelText(labels, extra=None):
+    items = list(labels)
+    if extra is not None:
+        items.append(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _number(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Histogram:
+    """Counts observations into buckets (plus their sum and count).
+    """
+    def __init__(self, buckets):
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)     # last one is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self):
+        """Returns a context manager that observes how long its block took.
+        """
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+    def render(self, name, labels):
+        counts, total = self.snapshot()
+        lines = []
+        running = 0
+        for bound, n in zip(self._bounds + ("+Inf",), counts):
+            running += n
+            lines.append(f"{name}_bucket{_labelText(labels, ('le', bound))} {running}")
+        lines.append(f"{name}_sum{_labelText(labels)} {_number(total)}")
+        lines.append(f"{name}_count{_labelText(labels)} {running}")
+        return lines
+
+
+class Counter:
+    """A number that only goes up.
+    """
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def render(self, name, labels):
+        return [f"{name}{_labelText(labels)} {_number(self._value)}"]
+
+
+class Gauge:
+    """A number that is set to the current value of something.
+    """
+    def __init__(self):
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def render(self, name, labels):
+        return [f"{name}{_labelText(labels)} {_number(self._value)}"]
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class MetricsRegistry:
+    """Holds every metric of a process, by name and labels.
+
+    Sample usage:
+    >     m = MetricsRegistry.Default()
+    >     with m.histogram("onion_peel_seconds", "Time to decrypt one layer").time():
+    >         inner = onion.peel(cert)
+    >     m.histogram("onion_bytes_in", "Onion size", CONST_SIZE_BUCKETS).observe(len(body))
+    >     text = m.render()
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self._metrics = {}      # (name, labels) -> metric
+        self._meta = {}         # name -> (type, help)
+        self._lock = threading.Lock()
+
+    def Default():
+        """Returns the shared MetricsRegistry for this process (made on first use).
+        """
+        with MetricsRegistry._default_lock:
+            if MetricsRegistry._default is None:
+                MetricsRegistry._default = MetricsRegistry()
+            return MetricsRegistry._default
+
+    def SetDefault(registry):
+        """Replaces the shared MetricsRegistry.
+        """
+        with MetricsRegistry._default_lock:
+            MetricsRegistry._default = registry
+
+    def _get(self, kind, name, help, labels, make):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = make()
+                    self._metrics[key] = metric
+                    self._meta.setdefault(name, (kind, help))
+        return metric
+
+    def histogram(self, name, help="", buckets=CONST_TIME_BUCKETS, **labels):
+        """Returns the histogram called name with these labels (made on first use).
+        """
+        return self._get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def counter(self, name, help="", **labels):
+        """Returns the counter called name with these labels (made on first use).
+        """
+        return self._get("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help="", **labels):
+        """Returns the gauge called name with these labels (made on first use).
+        """
+        return self._get("gauge", name, help, labels, Gauge)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items(), key=lambda kv: kv[0])
+            meta = dict(self._meta)
+        lines = []
+        last = None
+        for (name, labels), metric in metrics:
+            if name != last:
+                kind, help = meta[name]
+                if help:
+                    lines.append(f"# HELP {name} {_escape(help, quotes=False)}")
+                lines.append(f"# TYPE {name} {kind}")
+                last = name
+            lines.extend(metric.render(name, labels))
+        return "\n".join(lines) + "\n"
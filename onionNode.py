@@ -2,13 +2,20 @@
 # onionNode.py
 #
 # A program that acts as a node in a sad little onion router project.
-# It listens on port 10101 for incoming HTTP requests, expecting an onion message.
+# It listens on port 10101 (or --port <port>) for incoming HTTP requests,
+# expecting an onion message.
 #
 # Upon receiving an onion message, it "peels" the onion and sends it to the next
 # destination -- assumming it is online.
-#   - If there is no next destination, it prints the payload and closes the connection.
+#   - If there is no next destination, it logs the payload (see eventlog.py: its size,
+#     hash and first part) and closes the connection.
 #   - If the next hop is online, it forwards the payload of the peeled onion.
 #   - If the next hop is not online, it responds to the origin with an error.
+#     (So does a failed forward: the error makes its way back along the circuit.)
+#
+# With --batch, onions going to the same next node within a few milliseconds
+# are sent on together in one request (see ForwardBatcher); every node accepts
+# such batches, and answers with a result for each onion in them.
 #
 # This is useful for CSSE 490 - Data Privacy and Protection
 # when doing the OnionRouter exercise.
@@ -16,128 +23,917 @@
 # (c) 2024 Sid Stamm <stammsl@rose-hulman.edu>
 # 
 
+import concurrent.futures
+import hashlib
 import json
+import os
+import queue
+import threading
+import time
 import urllib.parse
+
 import requests
 
-from onions import Certificate, Onion, CONST_KEYSERVER_URL, CONST_NODE_PORT
+from transport import Transport
+from directory import DirectoryCache
+from pathselect import NodeStats
+from metrics import MetricsRegistry, CONST_SIZE_BUCKETS, CONST_COUNT_BUCKETS, CONST_METRICS_TYPE
+from eventlog import EventLog, HTTPLogMixin, digest, CONST_LOG_PREVIEW, CONST_DIGEST_LENGTH
+from onions import Certificate, Onion, OnionBatch, OnionStreamPeeler, RSABatchDecryptor, CONST_NODE_PORT, \
+                   CONST_ONION_BINARY_TYPE, CONST_ONION_BATCH_TYPE
 
 KEYFILE = "keys-downloaded.json"
+SECRETFILE = "secretcert.json"
+
+# Store-and-forward settings (see ForwardQueue)
+CONST_FORWARD_QUEUE_DEPTH = 256   # inner onions waiting to be forwarded, at most
+CONST_FORWARD_WORKERS = 4         # threads sending onions downstream
+CONST_FORWARD_RETRIES = 3         # extra attempts after the first one fails
+CONST_FORWARD_BACKOFF = 0.5       # seconds before the first retry (doubles each time)
+
+# Batch forwarding settings (see ForwardBatcher)
+CONST_BATCH_WINDOW = 0.005        # seconds a batch waits for more onions
+CONST_BATCH_MAX_ONIONS = 32       # onions per batch, at most...
+CONST_BATCH_MAX_BYTES = 1 << 20   # ...and bytes per batch (roughly)
+CONST_BATCH_SENDERS = 8           # threads sending batches
+
+# Seconds between "still here" messages to the keyserver (see Heartbeat).
+# Keep it well under the keyserver's node TTL.
+CONST_HEARTBEAT_INTERVAL = 60
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+# Streaming settings (see OnionNodeHandler._streamPOST)
+CONST_STREAM_WINDOW = 65536       # bytes read (and decrypted) at a time
+CONST_STREAM_THRESHOLD = 1 << 20  # bodies at least this big are streamed
+
+from http.server import BaseHTTPRequestHandler
+from onionserver import BoundedThreadingHTTPServer, KeepAliveMixin, CONST_MAX_WORKERS, CONST_MAX_QUEUED, CONST_KEEPALIVE_TIMEOUT
 import logging
 
-class OnionNodeHandler(BaseHTTPRequestHandler):
+def _timer(name, help, **labels):
+    """Shortcut: a context manager that times its block into a histogram.
+    """
+    return MetricsRegistry.Default().histogram(name, help, **labels).time()
+
+def _bytes(name, help, n, **labels):
+    """Shortcut: records a size (bytes) in a histogram.
+    """
+    MetricsRegistry.Default().histogram(name, help, CONST_SIZE_BUCKETS, **labels).observe(n)
+
+def _event(category, name, level=logging.INFO, **fields):
+    """Shortcut: logs a (sampled) structured event (see eventlog.py).
+    """
+    return EventLog.Default().event(category, name, level, **fields)
+
+def _delivered(nbytes, sha256, preview):
+    """Shows a message that was sent to this node: its size, hash, and the
+    start of it (at most CONST_LOG_PREVIEW characters).
+    """
+    _event("message", "delivered", bytes=nbytes, sha256=sha256,
+           text=lambda: preview[:CONST_LOG_PREVIEW].decode('utf-8', errors='replace'))
+
+class _CountingChunks:
+    """Passes chunks through, adding up how many bytes went by."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.total = 0
+
+    def __iter__(self):
+        for c in self._chunks:
+            if c:
+                self.total += len(c)
+                yield c
+
+
+def _unquoted(chunks):
+    """Url-unquotes a text body as it arrives (as _open does for a whole
+    one).  A %XX cut in two by a chunk boundary is held back until the rest
+    of it comes.
+    """
+    held = b''
+    for chunk in chunks:
+        data = held + bytes(chunk)
+        cut = data.rfind(b'%', max(0, len(data) - 2))
+        held, data = (data[cut:], data[:cut]) if cut >= 0 else (b'', data)
+        if data:
+            yield urllib.parse.unquote_to_bytes(data)
+    if held:
+        yield urllib.parse.unquote_to_bytes(held)
+
+
+class NodeKeyStore:
+    """Holds this node's secret certificate so it isn't re-read on every POST.
+
+    The certificate is loaded once (when the node starts) along with its
+    precomputed decryption parameters.  It is only re-read if the file's
+    modification time changes (e.g., someone re-exported the keypair).
+    """
+
+    def __init__(self, fname=SECRETFILE):
+        self._fname = fname
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._cert = None
+        self.reload()
+
+    def reload(self):
+        """(Re-)reads the secret certificate from the file.
+        """
+        with self._lock:
+            mtime = os.stat(self._fname).st_mtime_ns
+            cert = Certificate.FromFile(self._fname)
+            # drop the old key's engine, and make (and cache) this one's now,
+            # so the first onion peeled doesn't pay for it (peeling looks it up by key)
+            RSABatchDecryptor.ClearCache()
+            RSABatchDecryptor.ForKey(cert._key)
+            self._cert = cert
+            self._mtime = mtime
+            logging.info("Loaded secret key for %s from %s", cert._uname, self._fname)
+
+    def getCert(self):
+        """Returns the secret certificate, reloading it if the file changed.
+        """
+        try:
+            changed = os.stat(self._fname).st_mtime_ns != self._mtime
+        except OSError:
+            # file went away; keep using what we have
+            changed = False
+        if changed:
+            self.reload()
+        return self._cert
+
+
+def forward_onion(onion):
+    """Looks up the next hop for an onion and POSTs the onion to it.
+    If the POST fails, the cached address is dropped and looked up again, in
+    case the next node moved (or came back) since we cached it.
+
+    @param onion: the (already peeled) Onion object to send on
+    @return the downstream node's response
+    @raise an exception if the lookup or the POST fails
+    """
+    directory = DirectoryCache.Default()
+    transport = Transport.Default()
+
+    with _timer("onion_lookup_seconds", "Time to find the next hop's address"):
+        address = directory.getAddress(onion._dest)
+    if address is None:
+        raise Exception(f"Next hop {onion._dest} is not online")
+    ip, port = address
+
+    # binary onions go on as binary, text ones as text
+    data, content_type = onion.toWire()
+    headers = {"Content-Type": content_type} if content_type else {}
+    _bytes("onion_bytes_out", "Size of onions forwarded to the next hop", len(data))
+
+    #send the onion (timing it, to help pick fast paths -- see pathselect.py)
+    stats = NodeStats.Default()
+    try:
+        with _timer("onion_forward_seconds", "Time to POST an onion to the next hop"), \
+                stats.measure(onion._dest):
+            response = transport.nodePost(ip, data, port=port, headers=headers)
+            response.raise_for_status()
+        return response
+    except Exception:
+        directory.invalidate(onion._dest)
+        new_address = directory.getAddress(onion._dest)
+        if new_address is None or new_address == address:
+            raise
+
+    with _timer("onion_forward_seconds", "Time to POST an onion to the next hop"), \
+            stats.measure(onion._dest):
+        response = transport.nodePost(new_address[0], data, port=new_address[1], headers=headers)
+        response.raise_for_status()
+    return response
+
+
+def forward_stream(dest, chunks, content_type=None):
+    """Streams an onion to the node for dest with chunked transfer encoding,
+    so the whole onion never has to be in memory.  (A stream can't be replayed,
+    so there's no retry; a failure just drops dest's cached address.)
+
+    @param dest: username of the next hop
+    @param chunks: an iterable of bytes making up the onion
+    @param content_type: the onion's content type (None for text onions)
+    @return the downstream node's response
+    """
+    directory = DirectoryCache.Default()
+    with _timer("onion_lookup_seconds", "Time to find the next hop's address"):
+        address = directory.getAddress(dest)
+    if address is None:
+        raise Exception(f"Next hop {dest} is not online")
+    ip, port = address
+
+    headers = {"Content-Type": content_type} if content_type else {}
+    sent = _CountingChunks(chunks)
+    try:
+        with _timer("onion_forward_seconds", "Time to POST an onion to the next hop", mode="stream"), \
+                NodeStats.Default().measure(dest):
+            response = Transport.Default().nodePost(ip, iter(sent), port=port, headers=headers)
+            response.raise_for_status()
+        _bytes("onion_bytes_out", "Size of onions forwarded to the next hop", sent.total)
+        return response
+    except Exception:
+        directory.invalidate(dest)
+        raise
+
+
+class ForwardQueue:
+    """Store-and-forward for peeled onions.
+
+    The node can acknowledge an onion as soon as it has peeled it, and put the
+    inner onion here.  Background threads forward queued onions to their next
+    hop, retrying with backoff if that fails.  The queue has a fixed depth, so
+    put() refuses new onions (returns False) when it is full.
+
+    Some counters are kept (see stats()), including how long onions wait in
+    the queue before a worker picks them up.
+    """
+
+    def __init__(self, depth=CONST_FORWARD_QUEUE_DEPTH, workers=CONST_FORWARD_WORKERS,
+                 retries=CONST_FORWARD_RETRIES, backoff=CONST_FORWARD_BACKOFF, send=forward_onion):
+        self._queue = queue.Queue(maxsize=depth)
+        self._retries = retries
+        self._backoff = backoff
+        self._send = send
+        self._lock = threading.Lock()
+        self._stats = {"queued": 0, "rejected": 0, "forwarded": 0, "retries": 0, "failed": 0,
+                       "wait_count": 0, "wait_total_s": 0.0, "wait_max_s": 0.0}
+        self._threads = [threading.Thread(target=self._worker, name=f"forwarder-{i}", daemon=True)
+                         for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def put(self, onion):
+        """Queues an onion for forwarding.
+
+        @return True if queued, False if the queue is full.
+        """
+        try:
+            self._queue.put_nowait((time.monotonic(), onion))
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("queued")
+        return True
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                enqueued, onion = item
+                wait = time.monotonic() - enqueued
+                with self._lock:
+                    self._stats["wait_count"] += 1
+                    self._stats["wait_total_s"] += wait
+                    self._stats["wait_max_s"] = max(self._stats["wait_max_s"], wait)
+                self._deliver(onion)
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, onion):
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            try:
+                self._send(onion)
+                self._count("forwarded")
+                return True
+            except Exception as e:
+                _event("error", "forward_retry", logging.WARNING, dest=onion._dest, attempt=attempt + 1,
+                       error=str(e))
+                if attempt < self._retries:
+                    self._count("retries")
+                    time.sleep(delay)
+                    delay *= 2
+        self._count("failed")
+        return False
+
+    def depth(self):
+        """Returns the number of onions waiting to be forwarded.
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        """Returns a copy of the forwarding counters, including the average
+        time onions spent waiting in the queue.
+        """
+        with self._lock:
+            s = dict(self._stats)
+        s["depth"] = self.depth()
+        s["wait_avg_s"] = s["wait_total_s"] / s["wait_count"] if s["wait_count"] else 0.0
+        return s
+
+    def close(self):
+        """Forwards everything still queued, then stops the worker threads.
+        """
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+
+class _PendingBatch:
+    """Onions waiting to go to one address in the same request."""
+    __slots__ = ("address", "entries", "size", "deadline")
+
+    def __init__(self, address, deadline):
+        self.address = address
+        self.entries = []       # (onion, wire bytes, content type, Future)
+        self.size = 0
+        self.deadline = deadline
+
+
+class ForwardBatcher:
+    """Coalesces onions going to the same next node into one request.
+
+    submit() adds an onion to the open batch for its next hop's address.  A
+    batch is sent when it has max_onions onions or max_bytes bytes, or
+    window seconds after its first onion came in.  The node at the other end
+    handles each onion on its own and answers with a result for each, which
+    goes to that onion's Future, so one onion failing doesn't fail the rest.
+
+    If a batch can't be delivered, its onions are sent one at a time instead
+    (with forward_onion, so each is retried on its own).  A node that rejects
+    a batch with an HTTP error (other than 503, busy), or answers it with
+    something other than batch results, doesn't understand them; onions for
+    it are always sent one at a time after that.
+    """
+
+    def __init__(self, window=CONST_BATCH_WINDOW, max_onions=CONST_BATCH_MAX_ONIONS,
+                 max_bytes=CONST_BATCH_MAX_BYTES, senders=CONST_BATCH_SENDERS):
+        self.window = window
+        self.max_onions = max_onions
+        self.max_bytes = max_bytes
+        self._open = {}                 # (ip, port) -> _PendingBatch
+        self._single = set()            # addresses that don't take batches
+        self._cond = threading.Condition()
+        self._closed = False
+        self._senders = concurrent.futures.ThreadPoolExecutor(max_workers=senders,
+                                                              thread_name_prefix="batch-sender")
+        self._thread = threading.Thread(target=self._flusher, name="batch-flusher", daemon=True)
+        self._thread.start()
+
+    def submit(self, onion):
+        """Queues an onion for its next hop.
+
+        @return a Future for its result ({"ok", "status", "message"}); it
+                raises if the onion couldn't be forwarded
+        """
+        future = concurrent.futures.Future()
+        with _timer("onion_lookup_seconds", "Time to find the next hop's address"):
+            address = DirectoryCache.Default().getAddress(onion._dest)
+        if address is None:
+            future.set_exception(Exception(f"Next hop {onion._dest} is not online"))
+            return future
+
+        data, content_type = onion.toWire()
+        full = None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("ForwardBatcher is closed")
+            batch = self._open.get(address)
+            if batch is None:
+                batch = _PendingBatch(address, time.monotonic() + self.window)
+                self._open[address] = batch
+                self._cond.notify()
+            batch.entries.append((onion, data, content_type, future))
+            batch.size += len(data)
+            if len(batch.entries) >= self.max_onions or batch.size >= self.max_bytes:
+                full = self._open.pop(address)
+        if full is not None:
+            self._senders.submit(self._send, full)
+        return future
+
+    def forward(self, onion):
+        """Like forward_onion, but batched: waits for the onion's result.
+
+        @raise an exception if the onion couldn't be forwarded
+        """
+        return self.submit(onion).result()
+
+    def _flusher(self):
+        """Sends batches whose window has run out (and, when closing, all of them).
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for address, batch in list(self._open.items()):
+                    if self._closed or batch.deadline <= now:
+                        del self._open[address]
+                        self._senders.submit(self._send, batch)
+                if self._closed:
+                    return
+                deadlines = [b.deadline for b in self._open.values()]
+                self._cond.wait(min(deadlines) - now if deadlines else None)
+
+    def _send(self, batch):
+        entries = batch.entries
+        MetricsRegistry.Default().histogram("onion_batch_onions", "Onions per batch sent to the next hop",
+                                            CONST_COUNT_BUCKETS).observe(len(entries))
+        if len(entries) == 1 or batch.address in self._single:
+            self._sendSingly(entries)
+            return
+
+        ip, port = batch.address
+        body = OnionBatch.Pack([(data, content_type) for _, data, content_type, _ in entries])
+        _bytes("onion_bytes_out", "Size of onions forwarded to the next hop", len(body))
+        try:
+            with _timer("onion_forward_seconds", "Time to POST an onion to the next hop", mode="batch"), \
+                    NodeStats.Default().measure(entries[0][0]._dest):
+                response = Transport.Default().nodePost(ip, body, port=port,
+                                                        headers={"Content-Type": CONST_ONION_BATCH_TYPE})
+                response.raise_for_status()
+            results = response.json()["results"]
+            if len(results) != len(entries):
+                raise ValueError(f"{len(results)} results for {len(entries)} onions")
+        except requests.exceptions.HTTPError as e:
+            # a node that doesn't know batches rejects the POST (404, 405,
+            # 500, ...); a busy one (503) may take the next batch
+            if e.response is None or e.response.status_code != 503:
+                _event("error", "batch_unsupported", logging.WARNING, ip=ip, port=port, error=str(e))
+                self._single.add(batch.address)
+            else:
+                _event("error", "batch_failed", logging.WARNING, ip=ip, port=port, onions=len(entries),
+                       error=str(e))
+            self._sendSingly(entries)
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            _event("error", "batch_unsupported", logging.WARNING, ip=ip, port=port, error=str(e))
+            self._single.add(batch.address)
+            self._sendSingly(entries)
+            return
+        except requests.exceptions.RequestException as e:
+            _event("error", "batch_failed", logging.WARNING, ip=ip, port=port, onions=len(entries), error=str(e))
+            self._sendSingly(entries)
+            return
+
+        for (onion, _, _, future), result in zip(entries, results):
+            if result.get("ok"):
+                future.set_result(result)
+            else:
+                future.set_exception(Exception(f"Next hop {onion._dest} answered {result.get('status')}: "
+                                               f"{result.get('message')}"))
+
+    def _sendSingly(self, entries):
+        for onion, _, _, future in entries:
+            try:
+                response = forward_onion(onion)
+                future.set_result({"ok": True, "status": response.status_code, "message": response.text})
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self):
+        """Sends every open batch, then stops the threads.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._senders.shutdown(wait=True)
+
+
+class Heartbeat:
+    """Tells the keyserver this node is still online every so often, so it
+    doesn't get expired (and so a crashed node drops out of /NODES on its own).
+    """
+
+    def __init__(self, uname, interval=CONST_HEARTBEAT_INTERVAL, port=CONST_NODE_PORT):
+        self._path = "/HEARTBEAT?" + urllib.parse.urlencode({"un": uname, "port": port})
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                Transport.Default().keyserverGet(self._path).raise_for_status()
+            except Exception as e:
+                logging.warning("Heartbeat to keyserver failed: %s", e)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class OnionNodeHandler(KeepAliveMixin, HTTPLogMixin, BaseHTTPRequestHandler):
     """This class is used to handle incoming HTTP requests.  Specifically,
     those requests will be from other OnionNodes to peel and forward an onion,
     or they might be destined for this node (a final message).
     """
 
-    def _set_response(self):
-        """Helper to prepare a response.
+    # Speak HTTP/1.1 so other nodes can keep their connections open between onions.
+    protocol_version = "HTTP/1.1"
+    timeout = CONST_KEEPALIVE_TIMEOUT
+    # Headers and body go out in separate writes; without TCP_NODELAY, Nagle's
+    # algorithm holds the body back until the client's delayed ACK (~40ms)
+    # on every request after the first one on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    def _set_response(self, resp_code=200, body=b''):
+        """Helper to send a complete response.  (With keep-alive, every
+        response needs a Content-Length so the client knows where it ends.)
         """
-        self.send_response(200)
+        self.send_response(resp_code)
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
     def do_GET(self):
-        logging.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        self._set_response()
-        self.wfile.write("Sorry, I don't respond to GET requests.".encode('utf-8'))
+        if self.path == "/METRICS":
+            self._sendMetrics()
+            return
+        _event("request", "get", path=self.path)
+        self._set_response(body="Sorry, I don't respond to GET requests.".encode('utf-8'))
+
+    def _sendMetrics(self):
+        """Sends this node's metrics (see metrics.py), including the
+        store-and-forward queue's counters if there is one, and how each
+        next hop has been doing (see NodeStats).
+        """
+        registry = MetricsRegistry.Default()
+        for hop, (rtt, fail) in NodeStats.Default().snapshot().items():
+            if rtt is not None:
+                registry.gauge("onion_next_hop_rtt_seconds", "Moving average of forward time, per next hop",
+                               hop=hop).set(rtt)
+            registry.gauge("onion_next_hop_failure_rate", "Moving average of failed forwards, per next hop",
+                           hop=hop).set(fail)
+        forwarder = self.server.forwarder
+        if forwarder is not None:
+            for k, v in forwarder.stats().items():
+                registry.gauge("onion_forward_queue_" + k, "Store-and-forward queue counters").set(v)
+        registry.gauge("onion_requests_inflight", "Requests being handled or waiting for a worker") \
+                .set(self.server.inflight())
+
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', CONST_METRICS_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _forward(self, onion):
+        """Sends a peeled onion on to its next hop (or queues it, in
+        store-and-forward mode, or adds it to a batch, in batching mode).
+
+        @return (response code, response text) for the sender
+        """
+        forwarder = self.server.forwarder
+        batcher = self.server.batcher
+
+        if forwarder is not None:
+            # store-and-forward: ack now, a background thread sends it on
+            if not forwarder.put(onion):
+                return 503, "Forward queue full, try again later."
+        else:
+            try:
+                if batcher is not None:
+                    batcher.forward(onion)
+                else:
+                    forward_onion(onion)
+            except Exception as e:
+                _event("error", "forward_failed", logging.WARNING, dest=onion._dest, error=str(e))
+                return 502, "Could not forward the onion to the next hop."
+        return 200, "Thanks for the onion.  :)"
+
+    def _open(self, post_data, binary):
+        """Parses and peels one onion sent to this node.  If what's inside is
+        the message, it's shown (see _delivered).
+        The inner onion is parsed straight from the decrypted bytes.
+
+        @return (the inner onion to forward, or None if this node was the last
+                 stop; what to thank the sender with)
+        @raise an exception if the onion is unreadable or not for this node
+        """
+        with _timer("onion_parse_seconds", "Time to parse an onion", layer="outer"):
+            # If the incoming message was quoted, must unquote it first.
+            if not binary and b'%' in post_data:
+                post_data = urllib.parse.unquote_to_bytes(post_data)
+
+            new_onion = Onion.Parse(post_data)
+        if new_onion is None:
+            # Is not an onion.  Just show it.
+            _delivered(len(post_data), lambda: digest(post_data), post_data)
+            return None, "Thanks for the message.  :)"
+
+        # load my secret key so I can use it to peel the onion
+        priv = self.server.keystore.getCert()
+
+        # is this onion message for me?  If not, this is an error!
+        if not Onion.isFor(new_onion, priv):
+            raise Exception("Wrong recipient")
+
+        # peel it.  Errors get reported to the sender.
+        with _timer("onion_peel_seconds", "Time to decrypt one onion layer", version=new_onion._version):
+            inner = Onion.peel(new_onion, priv)
+        if inner is None:
+            raise Exception("Could not peel onion")
+
+        # is the payload a message or an onion?
+        with _timer("onion_parse_seconds", "Time to parse an onion", layer="inner"):
+            inner_onion = Onion.Parse(inner)
+        if inner_onion is None:
+            # If the peeled onion contains a message, show it and then be done.
+            _delivered(len(inner), lambda: digest(inner), inner)
+        return inner_onion, "Thanks for the onion.  :)"
+
+    def _handleOne(self, post_data, binary):
+        """Peels one onion and forwards what's inside.
+
+        @return (response code, response text) for the sender
+        """
+        try:
+            inner_onion, thanks = self._open(post_data, binary)
+        except Exception as e:
+            _event("error", "bad_onion", logging.WARNING, error=str(e))
+            return 500, "Could not handle that onion."
+        if inner_onion is None:
+            return 200, thanks
+        return self._forward(inner_onion)
+
+    def _bodyChunks(self, window=CONST_STREAM_WINDOW):
+        """Yields the request body a window at a time.  Handles both a
+        Content-Length body and a chunked (Transfer-Encoding) one.
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    # skip any trailer headers
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                while size > 0:
+                    data = self.rfile.read(min(size, window))
+                    if not data:
+                        raise ConnectionError("body ended early")
+                    size -= len(data)
+                    yield data
+                self.rfile.readline()   # CRLF after each chunk
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, window))
+                if not data:
+                    raise ConnectionError("body ended early")
+                remaining -= len(data)
+                yield data
+
+    def _shouldStream(self):
+        """True if this POST should be peeled as a stream (node started with
+        streaming on, and the body is big or of unknown size).  Batches are
+        never streamed: they are read whole and split into onions.
+        """
+        if not self.server.streaming:
+            return False
+        if self.headers.get('Content-Type', '').startswith(CONST_ONION_BATCH_TYPE):
+            return False
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return True
+        return int(self.headers.get('Content-Length', 0)) >= CONST_STREAM_THRESHOLD
+
+    def _streamPOST(self):
+        """Peels an onion while it's still arriving and streams the inner onion
+        on to the next hop (chunked), so memory use stays around one window
+        per onion no matter how big it is.
+        """
+        received = _CountingChunks(self._bodyChunks())
+        chunks = iter(received)
+        if not self.headers.get('Content-Type', '').startswith(CONST_ONION_BINARY_TYPE):
+            # text onions may arrive url-quoted
+            chunks = _unquoted(chunks)
+        peeler = OnionStreamPeeler(self.server.keystore.getCert())
+        _event("onion", "stream_received", path=self.path)
+
+        try:
+            # decrypt until we can tell what's inside
+            head = bytearray()
+            info = None
+            for chunk in chunks:
+                head += peeler.feed(chunk)
+                if peeler.kind == "message":
+                    break
+                info = Onion.PeekHeader(head)
+                if info is not None:
+                    break
+            else:
+                head += peeler.finish()
+                info = Onion.PeekHeader(head) or ("message",)
+
+            if peeler.kind == "message" or info[0] == "message":
+                # not an onion (or the final message): hash it as it comes,
+                # keeping only the start of it to show
+                sha = hashlib.sha256(head)
+                preview = bytes(head[:CONST_LOG_PREVIEW])
+                nbytes = len(head)
+                def rest():
+                    for chunk in chunks:
+                        yield peeler.feed(chunk)
+                    yield peeler.finish()
+                for part in rest():
+                    sha.update(part)
+                    nbytes += len(part)
+                    if len(preview) < CONST_LOG_PREVIEW:
+                        preview += part[:CONST_LOG_PREVIEW - len(preview)]
+                _delivered(nbytes, sha.hexdigest()[:CONST_DIGEST_LENGTH], preview)
+                thanks = "Thanks for the onion.  :)" if peeler.kind != "message" else "Thanks for the message.  :)"
+                self._set_response(body=thanks.encode('utf-8'))
+                return
+
+            bad_onion = []
+            def inner_onion():
+                try:
+                    yield bytes(head)
+                    for chunk in chunks:
+                        yield peeler.feed(chunk)
+                    yield peeler.finish()
+                except Exception as e:
+                    bad_onion.append(e)
+                    raise
+
+            content_type = CONST_ONION_BINARY_TYPE if info[0] == "binary" else None
+            try:
+                forward_stream(info[1], inner_onion(), content_type)
+            except Exception as e:
+                if bad_onion:
+                    raise
+                # the onion was fine; the next hop couldn't take it
+                self.close_connection = True
+                _event("error", "forward_failed", logging.WARNING, dest=info[1], error=str(e))
+                self._set_response(502, "Could not forward the onion to the next hop.".encode('utf-8'))
+                return
+            self._set_response(body="Thanks for the onion.  :)".encode('utf-8'))
+
+        except Exception as e:
+            self.close_connection = True    # the rest of the body may be unread
+            self._set_response(500, "Could not handle that onion.".encode('utf-8'))
+            _event("error", "bad_stream", logging.WARNING, error=str(e))
+        finally:
+            _bytes("onion_bytes_in", "Size of POST bodies received", received.total, wire="stream")
 
     def do_POST(self):
         """Here's where the magic happens:
         When a post comes in, look for an Onion message and then either display
         it or forward it on.
+
+        Text onions may arrive url-quoted; binary onions (Content-Type
+        application/octet-stream) never are.  Either way the body stays bytes
+        and is parsed in one pass (see Onion.Parse).  A batch of onions
+        (Content-Type CONST_ONION_BATCH_TYPE) is handled one onion at a time.
+
+        The sender gets 200 if the onion was delivered here or passed on
+        (or queued, in store-and-forward mode), 500 if it couldn't be read or
+        peeled, 502 if the next hop couldn't be reached or refused it, and
+        503 if the store-and-forward queue is full.  A batch gets 200 with
+        one of these statuses per onion.
         """
-        content_length = int(self.headers['Content-Length']) # Need this to do the next step
-        post_data = self.rfile.read(content_length)          # grab the data from the POST
-        # print("------------------ Post Data ----------------\n")
-        # print(post_data)
+        if self._shouldStream():
+            with _timer("onion_stream_seconds", "Time to handle a streamed onion, end to end"):
+                self._streamPOST()
+            return
 
-        # NOTE: You can use this logging tool to see what came in.
-        print("------------------ Log ----------------\n")
-        logging.info("POST request received,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
-               str(self.path), str(self.headers), post_data.decode('utf-8'))
-        
-        try:
-            # Because the incoming message was quoted, must unquote it first.
-            msg = urllib.parse.unquote(post_data.decode('utf-8'))
-
-            # print("------------------ Message ----------------\n")
-            # print(msg)
-
-            # print("------------------ Onion Check ----------------\n")
-            # print(Onion.isOnion(msg))
-
-            if Onion.isOnion(msg):
-                # TODO: load my secret key so I can use it to peel the onion
-                priv = Certificate.FromFile("secretcert.json")
-                
-                #Make the onion from the message
-                new_onion = Onion.FromString(msg)
-
-                # TODO: is this onion message for me?
-                if not Onion.isFor(new_onion, priv): 
-                    raise Exception("Wrong recipient")
-                # If not, this is an error!
-                
-                # TODO: peel it.  Be sure to report any errors to the sender.
-                peeled_onion = Onion.peel(new_onion, priv)
-                print(peeled_onion)
-
-                # TODO: is the payload a message or an onion?
-                # If the peeled onion contains a message, print it out and then be done.
-                if not Onion.isOnion(peeled_onion):
-                    print(peeled_onion)
-                else:
-                    peeled_onion = Onion.FromString(peeled_onion)
-                    destResponse = requests.get(f"{CONST_KEYSERVER_URL}/NODES?un={peeled_onion._dest}")
-                    ip = destResponse.text.split()[1][1:-2]
+        with _timer("onion_request_seconds", "Time to handle an onion, end to end (including the forward)"):
+            self._bufferedPOST()
+
+    def _bufferedPOST(self):
+        """Reads the whole onion, then peels and forwards it (see do_POST).
+        """
+        with _timer("onion_body_read_seconds", "Time to read a POST body"):
+            post_data = b''.join(self._bodyChunks())             # grab the data from the POST
 
-                    #set the destination for the entire onion
-                    url = f"http://{ip}:{CONST_NODE_PORT}"
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith(CONST_ONION_BATCH_TYPE):
+            _bytes("onion_bytes_in", "Size of POST bodies received", len(post_data), wire="batch")
+            self._batchPOST(post_data)
+            return
 
-                    #send the onion
-                    try:
-                        response = requests.post(url, Onion.toString(peeled_onion))
-                    except:
-                        print("FAIL")
+        binary = content_type.startswith(CONST_ONION_BINARY_TYPE)
+        _bytes("onion_bytes_in", "Size of POST bodies received", len(post_data),
+               wire="binary" if binary else "text")
 
+        # NOTE: sizes and hashes only; bodies are never logged (see eventlog.py)
+        _event("onion", "received", wire="binary" if binary else "text", bytes=len(post_data),
+               sha256=lambda: digest(post_data))
 
-                # If we found another onion, forward to next hop!
-                # TODO: Find out how to forward
-                # - look up the next hop IP address by username (keyserver)
-                # - try connecting to that OnionNode
-                # - If it's online, forward the inner onion on to the next node
+        code, text = self._handleOne(post_data, binary)
+        self._set_response(code, text.encode('utf-8'))
 
-                self._set_response()
-                self.wfile.write("Thanks for the onion.  :)".encode('utf-8'))
+    def _batchPOST(self, post_data):
+        """Handles a batch of onions (see OnionBatch): each one is peeled on
+        its own, the inner onions are all forwarded (batched again, in
+        batching mode), and the response lists a result for each, in order.
+        """
+        try:
+            entries = OnionBatch.Unpack(post_data)
+        except ValueError as e:
+            self._set_response(400, f"Could not read that batch: {e}".encode('utf-8'))
+            return
+        MetricsRegistry.Default().histogram("onion_batch_received_onions", "Onions per batch received",
+                                            CONST_COUNT_BUCKETS).observe(len(entries))
+        _event("onion", "batch_received", onions=len(entries), bytes=len(post_data))
+
+        results = [None] * len(entries)
+        inner = []
+        for i, (data, binary) in enumerate(entries):
+            try:
+                inner_onion, thanks = self._open(data, binary)
+            except Exception as e:
+                _event("error", "bad_onion", logging.WARNING, error=str(e))
+                results[i] = (500, "Could not handle that onion.")
+                continue
+            if inner_onion is None:
+                results[i] = (200, thanks)
             else:
-                # Is not an onion.  Thank the sender and print it out.
-                self._set_response()
-                self.wfile.write("Thanks for the message.  :)".encode('utf-8'))
-                print(msg)
+                inner.append((i, inner_onion))
 
-        except Exception as e:
-            self.send_response(500)
-            print("ERROR decoding POST: ", e)
+        batcher = self.server.batcher
+        if batcher is not None and self.server.forwarder is None:
+            # queue them all before waiting, so they can share batches
+            pending = []
+            for i, onion in inner:
+                try:
+                    pending.append((i, onion, batcher.submit(onion)))
+                except Exception as e:
+                    _event("error", "forward_failed", logging.WARNING, dest=onion._dest, error=str(e))
+                    results[i] = (502, "Could not forward the onion to the next hop.")
+            for i, onion, future in pending:
+                try:
+                    future.result()
+                    results[i] = (200, "Thanks for the onion.  :)")
+                except Exception as e:
+                    _event("error", "forward_failed", logging.WARNING, dest=onion._dest, error=str(e))
+                    results[i] = (502, "Could not forward the onion to the next hop.")
+        else:
+            for i, onion in inner:
+                results[i] = self._forward(onion)
 
-def run(server_class=HTTPServer, handler_class=OnionNodeHandler, port=CONST_NODE_PORT):
+        body = json.dumps({"version": 2, "results": [{"ok": code == 200, "status": code, "message": text}
+                                                     for code, text in results]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def run(server_class=BoundedThreadingHTTPServer, handler_class=OnionNodeHandler, port=CONST_NODE_PORT,
+        max_workers=CONST_MAX_WORKERS, max_queued=CONST_MAX_QUEUED, store_and_forward=False,
+        streaming=False, log_sampling=None, batching=False):
     pub = Certificate.FromFile("pubcert.json")
-    logging.basicConfig(level=logging.INFO)
+    EventLog.Start()
+    if log_sampling is not None:
+        EventLog.SetDefault(EventLog(log_sampling))
     server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
-    response = requests.get(f"{CONST_KEYSERVER_URL}/ONLINE?un={pub._uname}")
+    httpd = server_class(server_address, handler_class, max_workers=max_workers, max_queued=max_queued)
+    httpd.keystore = NodeKeyStore(SECRETFILE)
+    DirectoryCache.Default().seedFromFile(KEYFILE)
+    httpd.batcher = ForwardBatcher() if batching else None
+    send = httpd.batcher.forward if batching else forward_onion
+    httpd.forwarder = ForwardQueue(send=send) if store_and_forward else None
+    httpd.streaming = streaming
+    online = urllib.parse.urlencode({"un": pub._uname, "port": port})
+    response = Transport.Default().keyserverGet(f"/ONLINE?{online}")
+    heartbeat = Heartbeat(pub._uname, port=port).start()
     logging.info('Starting RHIT Onion Node...\n')
 
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
-    response = requests.get(f"{CONST_KEYSERVER_URL}/OFFLINE?un={pub._uname}")
+    # let in-flight onions finish before telling the keyserver we're gone
+    httpd.drain()
+    if httpd.forwarder is not None:
+        httpd.forwarder.close()
+        logging.info("Forwarding stats: %s", httpd.forwarder.stats())
+    if httpd.batcher is not None:
+        httpd.batcher.close()
+    heartbeat.stop()
+    response = Transport.Default().keyserverGet(f"/OFFLINE?un={pub._uname}")
     httpd.server_close()
     logging.info('Stopping RHIT Onion Node...\n')
+    EventLog.Stop()
 
 if __name__ == '__main__':
-    run(port=CONST_NODE_PORT)
\ No newline at end of file
+    from sys import argv
+
+    # usage: onionNode.py [--store-and-forward] [--streaming] [--port port] [--keyserver url]
+    #                      [--log-sample category=rate,...] [--batch] [--rsa-blinding]
+    #   --rsa-blinding blinds RSA decryption (slower, but no timing side channel;
+    #   see RSABatchDecryptor)
+    port = int(argv[argv.index("--port") + 1]) if "--port" in argv else CONST_NODE_PORT
+    if "--rsa-blinding" in argv:
+        RSABatchDecryptor.blinding = True
+    if "--keyserver" in argv:
+        Transport.SetDefault(Transport(keyserver_url=argv[argv.index("--keyserver") + 1]))
+    log_sampling = EventLog.ParseRates(argv[argv.index("--log-sample") + 1]) if "--log-sample" in argv else None
+    run(port=port, store_and_forward="--store-and-forward" in argv,
+        streaming="--streaming" in argv, log_sampling=log_sampling, batching="--batch" in argv)
\ No newline at end of file
@@ -1,15 +1,48 @@
-import requests
+import collections
+import logging
+import os
 import rsa
 import json
-from onions import InsecureRSABC, Certificate, Onion, CONST_KEYSERVER_URL, CONST_NODE_PORT
+import struct
+import threading
+import time
+
+import requests
+from transport import Transport
+from directory import DirectoryCache
+from pathselect import NodeStats, PathSelector
+from onions import InsecureRSABC, Certificate, Onion, CONST_NODE_PORT, CONST_ONION_V1, CONST_ONION_V2, \
+                   CONST_ONION_BINARY_TYPE
+from onions import CONST_ONION_MAGIC, CONST_LAYER_KEY_SIZE, CONST_KEYSTREAM_CHUNK
+
+# Onion version the sender makes unless told otherwise.  Version 1, because
+# nodes that haven't been upgraded can't peel version 2 (hybrid) layers; pass
+# --v2 when every node on the path runs a node that can.
+CONST_SENDER_VERSION = CONST_ONION_V1
+
+# Bytes each layer encrypts at a time when building a circuit as a stream.
+# Keep it a multiple of CONST_KEYSTREAM_CHUNK.  (Version 1 layers round it
+# down to whole RSA segments.)
+CONST_CIRCUIT_WINDOW = CONST_KEYSTREAM_CHUNK
+
+# CircuitPool settings
+CONST_CIRCUIT_POOL_SIZE = 4       # circuits kept ready
+CONST_CIRCUIT_HOPS = 3            # hops per circuit (not counting the recipient)
+CONST_CIRCUIT_TTL = 600           # seconds a circuit is used before it's replaced
+CONST_CIRCUIT_REFRESH = 30        # seconds between checks for nodes going offline
 
 class OnionSender:
     def __init__(self):
         print("")
 
-    def makeOnionFromMessage(dest, payload, cert):
-        new_onion = Onion(dest, payload)
+    def makeOnionFromMessage(dest, payload, cert, version=CONST_SENDER_VERSION):
+        """Wraps payload in one layer for dest.  A bytes payload makes a
+        binary onion (returned as bytes), a str payload makes a text onion.
+        """
+        new_onion = Onion(dest, payload, version)
         Onion.wrap(new_onion, cert)
+        if new_onion.isBinary():
+            return new_onion.toBytes()
         return Onion.toString(new_onion)
         
     def makeCertFromResponseString(str):
@@ -20,11 +53,10 @@ class OnionSender:
         return Certificate(name, uname, testKey)
     
     def makeOnionFromMessageAndRecipient(recipient, message):
-        #get the recipient's public key from the key server
-        keyResponse = requests.get(f"{CONST_KEYSERVER_URL}/KEYS?un={recipient}")
-
-        #make a cert for the recipient's public key
-        cert = OnionSender.makeCertFromResponseString(keyResponse.text)
+        #get the recipient's public key (cached from the key server)
+        cert = DirectoryCache.Default().getCert(recipient)
+        if cert is None:
+            raise Exception(f"No public key for {recipient}")
 
         #make an onion for the recipient with a message and the cert
         return OnionSender.makeOnionFromMessage(recipient, message, cert)
@@ -32,33 +64,370 @@ class OnionSender:
         
 
 
-    
-def run(sender=OnionSender, port=CONST_NODE_PORT):
-    #currently sends an onion one time
-    #set the recipient
-    recipient = input("Recipient:")
-    message = input("Message:")
-    string_onion = sender.makeOnionFromMessageAndRecipient(recipient, message)
 
-    while True:
-        old_recipient = recipient
-        recipient = input("Recipient:")
-        if recipient == "SEND":
-            break
+class CircuitBuilder:
+    """Builds a whole multi-hop binary onion for a path in one go.
+
+    All the hops' keys come from one bulk directory lookup, and the layers
+    are built as a stream: each layer encrypts the next-inner layer a window
+    at a time as it is produced, so no layer is ever held in memory whole and
+    the outermost onion can go straight to the first hop's socket.
+
+    Sample usage:
+    >     b = CircuitBuilder()
+    >     # first hop first; the last name is the recipient
+    >     b.send(["bob", "carol", "alice"], b"Hi Alice!")
+    """
+
+    def __init__(self, directory=None, version=CONST_SENDER_VERSION, window=CONST_CIRCUIT_WINDOW):
+        self._directory = directory
+        self.version = version
+        self.window = window
+
+    def _getDirectory(self):
+        return self._directory or DirectoryCache.Default()
+
+    def resolve(self, path):
+        """Looks up the public key of every hop in path (one bulk lookup).
+
+        @return a list of Certificates, in path order
+        """
+        certs = self._getDirectory().getCerts(path)
+        unknown = [uname for uname in path if certs.get(uname) is None]
+        if unknown:
+            raise Exception(f"No public key for {', '.join(unknown)}")
+        return [certs[uname] for uname in path]
+
+    def _rechunk(self, chunks, window):
+        """Regroups chunks into pieces of exactly window bytes (except the
+        last), reusing one buffer, so every layer encrypts aligned windows.
+        """
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            while len(buf) >= window:
+                yield bytes(buf[:window])
+                del buf[:window]
+        if buf:
+            yield bytes(buf)
+
+    def _layer(self, dest, public_key, inner_len, inner):
+        """Wraps a stream of inner_len bytes in one binary onion layer for dest.
+
+        @return (length of the layer, a generator of its bytes)
+        """
+        if self.version == CONST_ONION_V2:
+            layer_key = os.urandom(CONST_LAYER_KEY_SIZE)
+            enc_key = InsecureRSABC.encrypt_layer_key(layer_key, public_key)
+            payload_len = len(enc_key) + inner_len
+            window = self.window
+        else:
+            enc_key = b''
+            payload_len = InsecureRSABC.encrypted_length(inner_len, public_key)
+            # whole RSA segments only, so no window ends in a short block
+            seg_size = InsecureRSABC.segment_size(public_key)
+            window = max(seg_size, self.window - self.window % seg_size)
+
+        dest = dest.encode('utf-8')
+        header = b''.join([CONST_ONION_MAGIC, struct.pack(">BH", self.version, len(dest)), dest,
+                           struct.pack(">I", payload_len)])
+
+        def layer():
+            yield header + enc_key
+            offset = 0
+            for chunk in self._rechunk(inner, window):
+                if self.version == CONST_ONION_V2:
+                    yield InsecureRSABC.keystream_xor(chunk, layer_key, offset)
+                else:
+                    yield InsecureRSABC.encrypt_bytes(chunk, public_key)
+                offset += len(chunk)
+
+        return len(header) + payload_len, layer()
+
+    def stream(self, path, message, certs=None):
+        """Builds the onion for path as a stream.
+
+        @param path: usernames, first hop first; the last one is the recipient
+        @param message: the bytes (or str) to deliver
+        @param certs: the hops' Certificates, if already resolved (see CircuitPool)
+        @return (first hop's username, total onion length, a generator of its bytes)
+        """
+        if not path:
+            raise ValueError("Empty path")
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+
+        if certs is None:
+            certs = self.resolve(path)
+        length, chunks = len(message), iter([message])
+        for uname, cert in reversed(list(zip(path, certs))):
+            length, chunks = self._layer(uname, cert._key, length, chunks)
+        return path[0], length, chunks
+
+    def build(self, path, message):
+        """Like stream, but returns the whole onion as bytes.
+        """
+        _, _, chunks = self.stream(path, message)
+        return b''.join(chunks)
+
+    def buildText(self, path, message):
+        """Builds a text onion for path (keys still come from one bulk lookup).
+        Text onions are Base64 all the way down, so they can't be streamed.
+
+        @return the onion as a str
+        """
+        certs = self.resolve(path)
+        onion = message
+        for uname, cert in reversed(list(zip(path, certs))):
+            onion = OnionSender.makeOnionFromMessage(uname, onion, cert, self.version)
+        return onion
+
+    def send(self, path, message, port=None, transport=None, certs=None, ip=None):
+        """Builds the onion for path and streams it to the first hop.  Its
+        length is known up front, so it goes with a Content-Length (not
+        chunked), which any node can read.
 
-        string_onion = sender.makeOnionFromMessageAndRecipient(recipient, string_onion)
+        @param port: the first hop's port (default: the port it registered)
+        @param certs, ip: the hops' Certificates and the first hop's address,
+                          if already resolved (see CircuitPool)
+        @return the first hop's response
+        """
+        first, length, chunks = self.stream(path, message, certs)
+        if ip is None:
+            address = self._getDirectory().getAddress(first)
+            if address is None:
+                raise Exception(f"First hop {first} is not online")
+            ip, port = address[0], port or address[1]
+        port = port or CONST_NODE_PORT
 
-    destResponse = requests.get(f"{CONST_KEYSERVER_URL}/NODES?un={old_recipient}")
-    ip = destResponse.text.split()[1][1:-2]
+        transport = transport or Transport.Default()
+        with NodeStats.Default().measure(first):
+            response = transport.nodePost(ip, chunks, port=port, length=length,
+                                          headers={"Content-Type": CONST_ONION_BINARY_TYPE})
+            response.raise_for_status()
+        return response
 
-    #set the destination for the entire onion
-    url = f"http://{ip}:{CONST_NODE_PORT}"
 
-    #send the onion
+class Circuit:
+    """A pre-selected path of hops, with their keys and the first hop's
+    address already looked up.  The recipient is added when sending.
+    """
+    def __init__(self, hops, certs, ip, port=CONST_NODE_PORT):
+        self.hops = hops
+        self.certs = certs
+        self.ip = ip
+        self.port = port
+        self.created = time.monotonic()
+
+    def uses(self, uname):
+        return uname in self.hops
+
+
+class CircuitPool:
+    """Keeps circuits ready in the background, so sending a message only
+    costs building the layers (no path selection or directory lookups).
+
+    A background thread keeps `size` circuits of `hops` hops each.  Circuits
+    are used round-robin and replaced after `ttl` seconds, when one of their
+    hops goes offline (the node listing is re-polled every `refresh`
+    seconds), or when a send through them fails.
+
+    Sample usage:
+    >     pool = CircuitPool(size=4, hops=3)
+    >     pool.send("alice", b"Hi Alice!")
+    >     ...
+    >     pool.close()
+    """
+
+    def __init__(self, size=CONST_CIRCUIT_POOL_SIZE, hops=CONST_CIRCUIT_HOPS, ttl=CONST_CIRCUIT_TTL,
+                 refresh=CONST_CIRCUIT_REFRESH, selector=None, directory=None, builder=None):
+        self.size = size
+        self.hops = hops
+        self.ttl = ttl
+        self.refresh = refresh
+        self._directory = directory
+        self._selector = selector or PathSelector(directory=directory)
+        self._builder = builder or CircuitBuilder(directory=directory)
+        self._circuits = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._maintain, name="circuit-pool", daemon=True)
+        self._thread.start()
+
+    def _getDirectory(self):
+        return self._directory or DirectoryCache.Default()
+
+    def _makeCircuit(self, exclude=()):
+        """Picks a path and resolves its keys and first hop's address.
+        """
+        hops = self._selector.select(self.hops, exclude=exclude)
+        certs = self._builder.resolve(hops)
+        address = self._getDirectory().getAddress(hops[0])
+        if address is None:
+            raise Exception(f"First hop {hops[0]} is not online")
+        return Circuit(hops, certs, *address)
+
+    def _prune(self):
+        """Drops circuits that are too old or go through a node that's offline.
+        """
+        online = self._getDirectory().getNodes()
+        now = time.monotonic()
+        with self._lock:
+            keep = [c for c in self._circuits
+                    if now - c.created < self.ttl and all(h in online for h in c.hops)]
+            self._circuits = collections.deque(keep)
+
+    def _fill(self):
+        while not self._closed:
+            with self._lock:
+                if len(self._circuits) >= self.size:
+                    return
+            circuit = self._makeCircuit()
+            with self._lock:
+                self._circuits.append(circuit)
+
+    def _maintain(self):
+        while not self._closed:
+            try:
+                self._getDirectory().refreshNodes()
+                self._prune()
+                self._fill()
+            except Exception as e:
+                logging.warning("Could not refill circuit pool: %s", e)
+            self._wakeup.wait(self.refresh)
+            self._wakeup.clear()
+
+    def take(self, recipient):
+        """Returns a ready circuit that doesn't go through recipient (making
+        one on the spot if none is ready).
+        """
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self._circuits)):
+                circuit = self._circuits.popleft()
+                if now - circuit.created >= self.ttl:
+                    continue
+                self._circuits.append(circuit)
+                if not circuit.uses(recipient):
+                    return circuit
+        self._wakeup.set()
+        return self._makeCircuit(exclude=(recipient,))
+
+    def evict(self, uname):
+        """Drops every circuit that goes through uname (e.g., it failed a
+        forward), and refills the pool in the background.
+        """
+        with self._lock:
+            self._circuits = collections.deque(c for c in self._circuits if not c.uses(uname))
+        self._wakeup.set()
+
+    def _evictCircuit(self, circuit):
+        with self._lock:
+            self._circuits = collections.deque(c for c in self._circuits if c is not circuit)
+        self._wakeup.set()
+
+    def send(self, recipient, message, port=None):
+        """Sends message to recipient through a pooled circuit.
+
+        @return the first hop's response
+        """
+        circuit = self.take(recipient)
+        cert = self._getDirectory().getCert(recipient)
+        if cert is None:
+            raise Exception(f"No public key for {recipient}")
+
+        try:
+            return self._builder.send(circuit.hops + [recipient], message, port=port or circuit.port,
+                                      certs=circuit.certs + [cert], ip=circuit.ip)
+        except requests.exceptions.ConnectionError:
+            # couldn't reach the first hop at all
+            self._getDirectory().invalidate(circuit.hops[0])
+            self.evict(circuit.hops[0])
+            raise
+        except Exception:
+            # some hop along the way failed; we can't tell which
+            self._evictCircuit(circuit)
+            raise
+
+    def ready(self):
+        """Returns the number of circuits ready to use.
+        """
+        with self._lock:
+            return len(self._circuits)
+
+    def close(self):
+        """Stops the background thread.
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+
+
+def run(sender=OnionSender, port=None, binary=False, hops=None, pool_size=None, version=CONST_SENDER_VERSION):
+    DirectoryCache.Default().seedFromFile("keys-downloaded.json")
+    stats = NodeStats.Default()
+    stats.seedFromFile()
+
+    if pool_size:
+        #keep pool_size circuits ready and send as many (binary) messages as
+        #the user likes, each through a pooled circuit
+        pool = CircuitPool(size=pool_size, hops=hops or CONST_CIRCUIT_HOPS,
+                           builder=CircuitBuilder(version=version))
+        try:
+            while True:
+                recipient = input("Recipient (blank to quit):")
+                if not recipient:
+                    break
+                message = input("Message:")
+                try:
+                    pool.send(recipient, message, port=port)
+                except Exception:
+                    print("FAIL")
+        finally:
+            pool.close()
+        stats.saveToFile()
+        return
+
+    #currently sends an onion one time
+    #set the recipient first, then each hop back to the first one
+    #(or, given a number of hops, pick a random path to the recipient)
+    path = [input("Recipient:")]
+    message = input("Message:")
+
+    if hops is not None:
+        path = PathSelector().select(hops, recipient=path[0])
+        print("Path:", " -> ".join(path))
+    else:
+        while True:
+            recipient = input("Recipient:")
+            if recipient == "SEND":
+                break
+            path.insert(0, recipient)
+
+    #build the onion (fetching every hop's key at once) and send it to the first hop
+    builder = CircuitBuilder(version=version)
     try:
-        response = requests.post(url, string_onion)
+        if binary:
+            builder.send(path, message, port=port)
+        else:
+            string_onion = builder.buildText(path, message)
+            ip, first_port = DirectoryCache.Default().getAddress(path[0])
+            with stats.measure(path[0]):
+                response = Transport.Default().nodePost(ip, string_onion, port=port or first_port)
+                response.raise_for_status()
     except:
         print("FAIL")
+    stats.saveToFile()
 
 if __name__ == '__main__':
-    run(port=CONST_NODE_PORT)
+    from sys import argv
+
+    # usage: onionSender.py [--binary] [--hops N] [--pool N] [--v2]
+    #   --pool N keeps N circuits ready (of --hops hops each) and sends binary
+    #   onions through them until an empty recipient is given
+    #   --v2 makes version 2 (hybrid) onions; every hop must be able to peel them
+    hops = int(argv[argv.index("--hops") + 1]) if "--hops" in argv else None
+    pool_size = int(argv[argv.index("--pool") + 1]) if "--pool" in argv else None
+    run(binary="--binary" in argv, hops=hops, pool_size=pool_size,
+        version=CONST_ONION_V2 if "--v2" in argv else CONST_SENDER_VERSION)
@@ -23,7 +23,17 @@
 
 import rsa
 import base64
+import binascii
+import hashlib
 import json 
+import os
+import struct
+import urllib.parse
+import atexit
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
 
 # Useful globals identifying where the keyserver lives.  (You might have to change this).
 CONST_KEYSERVER_URL = "http://box.rose-hulman.edu:5555"
@@ -43,6 +53,82 @@ CONST_ONION_HEADER  = "--------------- ONION MESSAGE: ---------------\n"
 #                      < ... which could be another onion ...    >\n
 CONST_ONION_TRAILER = "-------------- END ONION MESSAGE -------------\n"
 
+# Onion payload encodings.  Version 1 (legacy) RSA-encrypts the whole payload
+# two bytes at a time, so every layer is ~10x bigger than the one inside it.
+# Version 2 (hybrid) RSA-encrypts only a fresh per-layer symmetric key and
+# stream-encrypts the payload with it, so each layer only adds a constant.
+# Version 2 onions carry an extra line right after the TO line:
+#                      VERSION: 2\n
+# Legacy onions have no VERSION line, so old onions still parse as version 1.
+CONST_ONION_V1 = 1
+CONST_ONION_V2 = 2
+CONST_ONION_VERSION_TAG = "VERSION:"
+
+# Binary onions are a compact alternative to the text format above.  They are
+# sent with Content-Type CONST_ONION_BINARY_TYPE (and are NOT url-quoted):
+#                      <4 byte magic: CONST_ONION_MAGIC>
+#                      <1 byte version>
+#                      <2 byte big-endian length of dest><dest, UTF-8>
+#                      <4 byte big-endian length of payload><raw ciphertext>
+# The ciphertext is not base64-encoded, and the plaintext inside it is bytes:
+# either another binary onion, or the final UTF-8 message.
+CONST_ONION_MAGIC = b"\x89ONI"
+CONST_ONION_BINARY_TYPE = "application/octet-stream"
+
+# Several onions for the same next node can be sent in one request (see
+# OnionBatch), with Content-Type CONST_ONION_BATCH_TYPE:
+#                      <4 byte magic: CONST_ONION_BATCH_MAGIC>
+#                      <4 byte big-endian number of onions>
+#                      then, for each onion:
+#                      <1 byte: 1 if it's a binary onion, 0 if text>
+#                      <4 byte big-endian length><the onion, as it would be POSTed alone>
+# The node answers with JSON listing a result for each onion, in order:
+#     {"version": 2, "results": [{"ok": true, "status": 200, "message": "..."}, ...]}
+CONST_ONION_BATCH_MAGIC = b"\x89ONB"
+CONST_ONION_BATCH_TYPE = "application/x-onion-batch"
+CONST_MAX_BATCH_ONIONS = 1024
+
+# byte versions of the text markers, for parsing onions without decoding them
+_ONION_HEADER_BYTES = CONST_ONION_HEADER.encode('ascii')
+_ONION_TRAILER_BYTES = CONST_ONION_TRAILER.encode('ascii')
+_ONION_VERSION_BYTES = CONST_ONION_VERSION_TAG.encode('ascii')
+
+# Size (in bytes) of the per-layer symmetric key used by hybrid onions.
+CONST_LAYER_KEY_SIZE = 16
+
+# Default RSA key size (bits) for new keypairs.  Any size of at least
+# CONST_MIN_KEY_SIZE works: block sizes are worked out from each key.
+CONST_KEY_SIZE = 127
+CONST_MIN_KEY_SIZE = 96
+
+# Bytes of each RSA block taken up by PKCS#1 v1.5 padding.
+CONST_PKCS1_OVERHEAD = 11
+
+# Hybrid keystreams are generated in pieces of this many bytes.
+CONST_KEYSTREAM_CHUNK = 65536
+
+# Most bytes an onion's header (everything before the payload) may take up.
+CONST_MAX_ONION_HEADER = 65536
+
+# Payloads with at least this many RSA blocks get encrypted/decrypted on a
+# process pool (see ParallelRSABC).  Set ParallelRSABC.threshold to None to
+# keep everything on one core.
+CONST_PARALLEL_THRESHOLD = 50000
+
+# How process pools (ParallelRSABC, KeyFactory) start their worker processes,
+# see mp_context().  Not "fork": the servers are multi-threaded, and forking
+# a process with other threads running (and maybe holding locks) can hang the
+# children.  "forkserver" is used where the platform has it, "spawn" elsewhere.
+CONST_PARALLEL_START_METHODS = ("forkserver", "spawn")
+
+# Most RSABatchDecryptor engines cached (one per private key).
+CONST_ENGINE_CACHE_SIZE = 8
+
+# Whether RSABatchDecryptor blinds each block like rsa.decrypt does.  Off by
+# default: that is where all of its speedup comes from (rsa already uses CRT),
+# but it leaves a timing side channel open -- see RSABatchDecryptor.
+CONST_RSA_BLINDING = False
+
 
 class InsecureRSABC:
     """This class contains a couple somewhat insecure block cipher RSA subroutines
@@ -71,28 +157,73 @@ class InsecureRSABC:
 
     def encrypt_payload(msg, public_key): 
         """Encrypt an RSA ciphertext given a key.
-        This function assumes the key is tiny and encrypts blocks of five byte segments.
+        The message is cut into the biggest segments one RSA block can carry
+        (see segment_size), e.g. five bytes for tiny 127-bit keys.
 
         @param msg: a str message
         @public_key: an RSA public key object
         @return an encrypted message in base64 (as ASCII)
         """
-        seg_size = 2 # chunk size (max is 5 for tiny keys like default config)
+        # encode into byte array, encrypt, and return the bytes encoded with base64
+        enc_bytes = InsecureRSABC.encrypt_bytes(msg.encode('utf-8'), public_key)
+        return base64.encodebytes(enc_bytes).decode('ascii')
+
+    def block_size(key):
+        """Bytes in one RSA block (ciphertext) for key.
+        """
+        return rsa.common.byte_size(key.n)
+
+    def segment_size(key):
+        """Most plaintext bytes one RSA block can carry with key (the block
+        size less the PKCS#1 padding).
+
+        @raise ValueError if the key is too small to carry anything
+        """
+        seg_size = InsecureRSABC.block_size(key) - CONST_PKCS1_OVERHEAD
+        if seg_size < 1:
+            raise ValueError(f"RSA key is too small (needs at least {CONST_MIN_KEY_SIZE} bits)")
+        return seg_size
+
+    def encrypted_length(msg_len, public_key):
+        """How many bytes encrypt_bytes makes out of msg_len bytes.
+        """
+        seg_size = InsecureRSABC.segment_size(public_key)
+        return -(-msg_len // seg_size) * InsecureRSABC.block_size(public_key)
 
-        # encode into byte array
-        msg = msg.encode('utf-8')
+    def encrypted_layer_key_length(key):
+        """How many bytes the RSA-encrypted layer key of a hybrid payload takes.
+        """
+        seg_size = InsecureRSABC.segment_size(key)
+        return -(-CONST_LAYER_KEY_SIZE // seg_size) * InsecureRSABC.block_size(key)
+
+    def encrypt_layer_key(layer_key, public_key):
+        """RSA-encrypts a hybrid payload's layer key (as few blocks as the key allows).
+        """
+        seg_size = InsecureRSABC.segment_size(public_key)
+        return b''.join(rsa.encrypt(layer_key[i:i+seg_size], public_key)
+                        for i in range(0, len(layer_key), seg_size))
+
+    def encrypt_bytes(msg, public_key):
+        """Like encrypt_payload, but takes and returns raw bytes (no base64).
+
+        @param msg: the bytes to encrypt
+        @param public_key: an RSA public key object
+        @return the encrypted blocks, joined together
+        """
+        seg_size = InsecureRSABC.segment_size(public_key)
 
         # split into seg_size substrings
         chunks = [msg[i:i+seg_size] for i in range(0, len(msg), seg_size)]
 
+        # big payloads get spread across cores (same output layout)
+        if ParallelRSABC.shouldUse(len(chunks)):
+            return ParallelRSABC.encryptChunks(msg, public_key, seg_size)
+
         # encrypt each substring
         enc_chunks = [rsa.encrypt(c, public_key) for c in chunks]
 
         # stick the substrings together
-        enc_bytes = b''.join(list(enc_chunks))
-
-        # return the bytes encoded with base64
-        return base64.encodebytes(enc_bytes).decode('ascii')
+        return b''.join(list(enc_chunks))
         
 
     def decrypt_payload(ciphertext, private_key):
@@ -104,7 +235,7 @@ class InsecureRSABC:
         @public_key: an RSA private key object
         @return a decrypted message as str
         """
-        seg_size = 16 # chunk size (based on key - 16 in default config)
+        seg_size = InsecureRSABC.block_size(private_key) # encrypted block size
 
         # decode the message from base64
         ciphertext = base64.decodebytes(ciphertext.encode('ascii'))
@@ -118,6 +249,309 @@ class InsecureRSABC:
         # reassemble the decrypted blocks and return the message
         return (b''.join(list(dec_chunks))).decode("utf-8")
 
+    def keystream(layer_key, offset, n):
+        """Returns n bytes of the keystream for layer_key, starting at offset.
+        The keystream is made of CONST_KEYSTREAM_CHUNK-byte pieces, piece i being
+        SHAKE-256(layer_key || i), so any part of it can be made on its own
+        (which lets onions be peeled as a stream).
+        """
+        size = CONST_KEYSTREAM_CHUNK
+        if n <= 0:
+            return b''
+        first = offset // size
+        last = (offset + n - 1) // size
+        end = offset + n - last * size      # bytes needed from the last piece
+        # a shorter SHAKE output is a prefix of a longer one, so only make what's used
+        stream = b''.join(hashlib.shake_256(layer_key + i.to_bytes(8, 'big')).digest(size if i < last else end)
+                          for i in range(first, last + 1))
+        start = offset - first * size
+        return stream[start:start+n]
+
+    def keystream_xor(data, layer_key, offset=0):
+        """XORs data with a keystream derived from layer_key (SHAKE-256 used as
+        a stream cipher).  Encryption and decryption are the same operation.
+
+        @param data: bytes to encrypt/decrypt
+        @param layer_key: the symmetric key bytes (never reuse one for two payloads!)
+        @param offset: where data starts in the payload (when working piece by piece)
+        @return the transformed bytes
+        """
+        n = len(data)
+        stream = InsecureRSABC.keystream(layer_key, offset, n)
+        x = int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')
+        return x.to_bytes(n, 'big')
+
+    def encrypt_payload_hybrid(msg, public_key):
+        """Encrypt a payload with a fresh symmetric key, and RSA-encrypt only that key.
+        The output is the RSA-encrypted key blocks followed by the stream-encrypted
+        message, all base64-encoded, so it only grows by a constant per layer.
+
+        @param msg: a str message
+        @param public_key: an RSA public key object
+        @return an encrypted message in base64 (as ASCII)
+        """
+        enc_bytes = InsecureRSABC.encrypt_hybrid_bytes(msg.encode('utf-8'), public_key)
+        return base64.encodebytes(enc_bytes).decode('ascii')
+
+    def encrypt_hybrid_bytes(msg, public_key):
+        """Like encrypt_payload_hybrid, but takes and returns raw bytes (no base64).
+        """
+        layer_key = os.urandom(CONST_LAYER_KEY_SIZE)
+        enc_key = InsecureRSABC.encrypt_layer_key(layer_key, public_key)
+
+        return enc_key + InsecureRSABC.keystream_xor(msg, layer_key)
+
+    def decrypt_payload_hybrid(ciphertext, private_key):
+        """Decrypt a payload made by encrypt_payload_hybrid.
+
+        @param ciphertext: an encrypted message (base64)
+        @param private_key: an RSA private key object
+        @return a decrypted message as str
+        """
+        ciphertext = base64.decodebytes(ciphertext.encode('ascii'))
+        return InsecureRSABC.decrypt_hybrid_bytes(ciphertext, private_key).decode("utf-8")
+
+    def decrypt_hybrid_bytes(ciphertext, private_key):
+        """Like decrypt_payload_hybrid, but takes and returns raw bytes (no base64).
+        """
+        enc_key_len = InsecureRSABC.encrypted_layer_key_length(private_key)
+        if len(ciphertext) < enc_key_len:
+            raise rsa.DecryptionError("Decryption failed")
+
+        layer_key = RSABatchDecryptor.ForKey(private_key).decryptBlocks(ciphertext[:enc_key_len])
+        if len(layer_key) != CONST_LAYER_KEY_SIZE:
+            raise rsa.DecryptionError("Decryption failed")
+
+        return InsecureRSABC.keystream_xor(ciphertext[enc_key_len:], layer_key)
+
+    def decrypt_payload_batch(ciphertext, private_key):
+        """Decrypt an RSA ciphertext given a key, handling all blocks in one pass.
+        Produces exactly the same output as decrypt_payload, but uses a
+        RSABatchDecryptor (with CRT values precomputed once per key) instead of
+        calling rsa.decrypt once per block.  Big payloads are decrypted on a
+        process pool (see ParallelRSABC).
+
+        @param ciphertext: an encrypted message
+        @param private_key: an RSA private key object
+        @return a decrypted message as str
+        """
+        ciphertext = base64.decodebytes(ciphertext.encode('ascii'))
+        return InsecureRSABC.decrypt_bytes(ciphertext, private_key).decode("utf-8")
+
+    def decrypt_bytes(ciphertext, private_key):
+        """Like decrypt_payload_batch, but takes and returns raw bytes (no base64).
+        """
+        block_size = rsa.common.byte_size(private_key.n)
+        if ParallelRSABC.shouldUse(len(ciphertext) // block_size):
+            return ParallelRSABC.decryptBlocks(ciphertext, private_key)
+
+        return RSABatchDecryptor.ForKey(private_key).decryptBlocks(ciphertext)
+
+
+class RSABatchDecryptor:
+    """Decrypts a whole run of PKCS#1 v1.5 RSA blocks with one private key.
+
+    The CRT values from the key (p, q, exp1, exp2, coef) are pulled out once
+    when the engine is made, and engines are cached per key, so decrypting a
+    payload is a single tight loop over its blocks instead of one rsa.decrypt
+    call (padding checks, blinding, key attribute lookups) per block.
+
+    WARNING: unless RSABatchDecryptor.blinding is set, this skips RSA
+    blinding, and that is where nearly all of the speedup comes from (rsa
+    itself already uses CRT).  Without blinding, how long a block takes to
+    decrypt depends on the secret key and on the ciphertext, and a node
+    decrypts ciphertext that anyone can send it: someone who can time many
+    peels could learn the node's key.  Fine for this toy and its throwaway
+    keys; set blinding (onionNode.py --rsa-blinding) for anything else.
+
+    Settings:
+        RSABatchDecryptor.blinding -- blind every block, as rsa.decrypt does
+                                      (default CONST_RSA_BLINDING)
+    """
+
+    blinding = CONST_RSA_BLINDING
+
+    _engines = collections.OrderedDict()      # private key -> engine, least recently used first
+    _engines_lock = threading.Lock()
+
+    def __init__(self, private_key):
+        self._key = private_key
+        self._p = private_key.p
+        self._q = private_key.q
+        self._exp1 = private_key.exp1
+        self._exp2 = private_key.exp2
+        self._coef = private_key.coef
+        self._block_size = rsa.common.byte_size(private_key.n)
+
+    def ForKey(private_key):
+        """Returns the (cached) engine for the given private key.  At most
+        CONST_ENGINE_CACHE_SIZE engines are kept.
+        """
+        with RSABatchDecryptor._engines_lock:
+            engine = RSABatchDecryptor._engines.get(private_key)
+            if engine is None:
+                engine = RSABatchDecryptor(private_key)
+                RSABatchDecryptor._engines[private_key] = engine
+                while len(RSABatchDecryptor._engines) > CONST_ENGINE_CACHE_SIZE:
+                    RSABatchDecryptor._engines.popitem(last=False)
+            else:
+                RSABatchDecryptor._engines.move_to_end(private_key)
+            return engine
+
+    def ClearCache():
+        """Forgets every cached engine (e.g., after the node's key changed).
+        """
+        with RSABatchDecryptor._engines_lock:
+            RSABatchDecryptor._engines.clear()
+
+    def decryptBlocks(self, ciphertext):
+        """Decrypts consecutive RSA blocks and joins the cleartexts together.
+
+        @param ciphertext: bytes made of encrypted blocks (one key-size each)
+        @return the joined cleartext bytes
+        @raise rsa.DecryptionError if any block is not valid PKCS#1 v1.5
+        """
+        p, q = self._p, self._q
+        exp1, exp2, coef = self._exp1, self._exp2, self._coef
+        k = self._block_size
+        from_bytes = int.from_bytes
+        mv = memoryview(ciphertext)
+        key = self._key if RSABatchDecryptor.blinding else None
+
+        out = []
+        for i in range(0, len(ciphertext), k):
+            c = from_bytes(mv[i:i+k], 'big')
+            if key is not None:
+                c, unblind = key.blind(c)
+            s1 = pow(c, exp1, p)
+            s2 = pow(c, exp2, q)
+            m = s2 + q * (((s1 - s2) * coef) % p)
+            if key is not None:
+                m = key.unblind(m, unblind)
+            block = m.to_bytes(k, 'big')
+
+            # same padding checks as rsa.decrypt: 00 02 <8+ nonzero bytes> 00 <msg>
+            sep = block.find(b'\x00', 2)
+            if block[:2] != b'\x00\x02' or sep < 10:
+                raise rsa.DecryptionError("Decryption failed")
+            out.append(block[sep+1:])
+
+        return b''.join(out)
+
+
+def mp_context():
+    """Returns the multiprocessing context every process pool should use
+    (see CONST_PARALLEL_START_METHODS).
+    """
+    available = multiprocessing.get_all_start_methods()
+    for method in CONST_PARALLEL_START_METHODS:
+        if method in available:
+            return multiprocessing.get_context(method)
+    return multiprocessing.get_context()
+
+
+# Process pool workers for ParallelRSABC.  These have to be module-level
+# functions so they can be sent to worker processes.
+def _parallel_decrypt_shard(job):
+    shard, private_key, blinding = job
+    RSABatchDecryptor.blinding = blinding
+    return RSABatchDecryptor.ForKey(private_key).decryptBlocks(shard)
+
+def _parallel_encrypt_shard(job):
+    shard, public_key, seg_size = job
+    return b''.join(rsa.encrypt(shard[i:i+seg_size], public_key)
+                    for i in range(0, len(shard), seg_size))
+
+
+class ParallelRSABC:
+    """Spreads the RSA blocks of one big payload across a process pool.
+
+    The block list is cut into shards (on block boundaries), each shard is
+    handled by a worker, and the results are joined back together in order, so
+    the output is laid out exactly like the single-core versions.
+
+    One pool is shared by every key, for encryption and decryption: the
+    (small) key is sent along with each shard, and workers keep their
+    RSABatchDecryptor engines in the usual per-key cache.  So a node whose
+    key changes doesn't leave a pool of processes behind for the old one.
+
+    Workers are started without fork (see CONST_PARALLEL_START_METHODS), so
+    a script that uses the pool needs an `if __name__ == '__main__':` guard.
+
+    Settings:
+        ParallelRSABC.threshold -- minimum number of blocks before the pool is
+                                   used (None disables the pool entirely)
+        ParallelRSABC.workers   -- number of worker processes (None = all cores)
+    """
+
+    threshold = CONST_PARALLEL_THRESHOLD
+    workers = None
+
+    # how many shards to make per worker (more shards = better load balance)
+    SHARDS_PER_WORKER = 4
+
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    def shouldUse(nblocks):
+        """True if a payload of nblocks RSA blocks should go to the pool.
+        """
+        t = ParallelRSABC.threshold
+        return t is not None and nblocks >= t
+
+    def _workerCount():
+        return ParallelRSABC.workers or os.cpu_count() or 1
+
+    def _shards(data, unit):
+        """Cuts data into roughly equal shards whose sizes are multiples of unit.
+        """
+        nunits = -(-len(data) // unit)
+        nshards = ParallelRSABC._workerCount() * ParallelRSABC.SHARDS_PER_WORKER
+        per_shard = max(1, -(-nunits // nshards)) * unit
+        return [bytes(data[i:i+per_shard]) for i in range(0, len(data), per_shard)]
+
+    def _getPool():
+        with ParallelRSABC._pool_lock:
+            if ParallelRSABC._pool is None:
+                ParallelRSABC._pool = concurrent.futures.ProcessPoolExecutor(
+                            max_workers=ParallelRSABC._workerCount(),
+                            mp_context=mp_context())
+            return ParallelRSABC._pool
+
+    def decryptBlocks(ciphertext, private_key):
+        """Like RSABatchDecryptor.decryptBlocks, but on the process pool.
+
+        @param ciphertext: bytes made of encrypted blocks
+        @param private_key: an RSA private key object
+        @return the joined cleartext bytes
+        """
+        block_size = rsa.common.byte_size(private_key.n)
+        shards = ParallelRSABC._shards(ciphertext, block_size)
+        jobs = [(shard, private_key, RSABatchDecryptor.blinding) for shard in shards]
+        return b''.join(ParallelRSABC._getPool().map(_parallel_decrypt_shard, jobs))
+
+    def encryptChunks(msg, public_key, seg_size):
+        """Encrypts msg seg_size bytes at a time on the process pool.
+
+        @param msg: the bytes to encrypt
+        @param public_key: an RSA public key object
+        @param seg_size: plaintext bytes per RSA block
+        @return the joined encrypted blocks
+        """
+        shards = ParallelRSABC._shards(msg, seg_size)
+        jobs = [(shard, public_key, seg_size) for shard in shards]
+        return b''.join(ParallelRSABC._getPool().map(_parallel_encrypt_shard, jobs))
+
+    def Shutdown():
+        """Stops the worker processes.  (They get re-made if needed later.)
+        """
+        with ParallelRSABC._pool_lock:
+            if ParallelRSABC._pool is not None:
+                ParallelRSABC._pool.shutdown()
+                ParallelRSABC._pool = None
+
+atexit.register(ParallelRSABC.Shutdown)
+
 
 
 class Onion:
@@ -125,13 +559,213 @@ class Onion:
     Such an object contains a destination and payload.
     The destination is simply a username.
     The payload is a Base64-encoded string, which could be another onion.
+    The version selects how the payload is encrypted (CONST_ONION_V1 or CONST_ONION_V2).
+
+    Binary onions (see toBytes/FromBytes) keep their payload as raw bytes
+    instead of a Base64 string; wrap() and peel() then take and return bytes.
+    Onions parsed with Parse/ParseText also hold raw bytes, but remember that
+    they arrived as text (see toWire).
     """
-    def __init__(self, dest, payload):
+    def __init__(self, dest, payload, version=CONST_ONION_V1):
         self._dest = dest
         self._payload = payload
+        self._version = version
+        self._text_wire = not self.isBinary()
     
     def toString(self):
-        return CONST_ONION_HEADER + "TO: " + self._dest + "\n" + self._payload + CONST_ONION_TRAILER
+        vline = ""
+        if self._version != CONST_ONION_V1:
+            vline = f"{CONST_ONION_VERSION_TAG} {self._version}\n"
+        payload = self._payload
+        if self.isBinary():
+            payload = base64.encodebytes(payload).decode('ascii')
+        return CONST_ONION_HEADER + "TO: " + self._dest + "\n" + vline + payload + CONST_ONION_TRAILER
+
+    def toWire(self):
+        """Serializes this onion the way it should be sent to the next node:
+        as text if it arrived as (or was made as) a text onion, otherwise binary.
+
+        @return (bytes, content type or None for text)
+        """
+        if self._text_wire:
+            return self.toString().encode('utf-8'), None
+        return self.toBytes(), CONST_ONION_BINARY_TYPE
+
+    def isBinary(self):
+        """True if the payload is raw bytes (a binary onion) rather than Base64 text.
+        """
+        return isinstance(self._payload, (bytes, bytearray, memoryview))
+
+    def toBytes(self):
+        """Serializes this onion in the binary wire format (see CONST_ONION_MAGIC).
+        """
+        payload = self._payload
+        if not self.isBinary():
+            payload = base64.decodebytes(payload.encode('ascii'))
+        dest = self._dest.encode('utf-8')
+        return b''.join([CONST_ONION_MAGIC, struct.pack(">BH", self._version, len(dest)), dest,
+                         struct.pack(">I", len(payload)), payload])
+
+    def FromBytes(data):
+        """Parses a binary onion (the inverse of toBytes).  Another factory.
+
+        @param data: bytes (or a memoryview) holding a binary onion
+        @return an Onion whose payload is the raw ciphertext bytes, or None
+        """
+        try:
+            if not Onion.isOnionBytes(data):
+                print("ERROR parsing onion: bad magic number.")
+                return None
+            pos = len(CONST_ONION_MAGIC)
+            version, dest_len = struct.unpack_from(">BH", data, pos)
+            pos += 3
+            dest = bytes(data[pos:pos+dest_len]).decode('utf-8')
+            pos += dest_len
+            (payload_len,) = struct.unpack_from(">I", data, pos)
+            pos += 4
+            if len(data) - pos < payload_len:
+                print("ERROR parsing onion: payload is truncated.")
+                return None
+            return Onion(dest, memoryview(data)[pos:pos+payload_len], version)
+
+        except Exception as e:
+            print("ERROR parsing onion:", e)
+            return None
+
+    def isOnionBytes(b):
+        """True if b (bytes) starts like a binary onion.
+        """
+        return bytes(b[:len(CONST_ONION_MAGIC)]) == CONST_ONION_MAGIC
+
+    def isOnionText(b):
+        """True if b (bytes) starts like a text onion.  Unlike isOnion, this
+        only looks at the start; ParseText does the rest of the checking.
+        """
+        return bytes(b[:len(_ONION_HEADER_BYTES)]) == _ONION_HEADER_BYTES
+
+    def Parse(data):
+        """Parses a binary or text onion held in bytes.
+
+        @return an Onion (with raw bytes payload), or None if data isn't an onion.
+        """
+        if Onion.isOnionBytes(data):
+            return Onion.FromBytes(data)
+        if Onion.isOnionText(data):
+            return Onion.ParseText(data)
+        return None
+
+    def PeekHeader(buf):
+        """Looks at the start of a (possibly incomplete) onion and works out
+        its kind, destination and where its payload starts.
+
+        @param buf: the first bytes of an onion (or of a message)
+        @return None if more bytes are needed to tell, otherwise a tuple
+                (kind, dest, version, payload_start, payload_len) where kind is
+                "binary", "text" or "message" (not an onion at all), and
+                payload_len is only known for binary onions.
+        @raise ValueError if the header is malformed or too long
+        """
+        buf = bytes(buf[:CONST_MAX_ONION_HEADER]) if not isinstance(buf, bytes) else buf
+        n = len(buf)
+
+        for prefix in (CONST_ONION_MAGIC, _ONION_HEADER_BYTES):
+            if n < len(prefix) and prefix.startswith(buf):
+                return None
+
+        if buf.startswith(CONST_ONION_MAGIC):
+            pos = len(CONST_ONION_MAGIC)
+            if n < pos + 3:
+                return None
+            version, dest_len = struct.unpack_from(">BH", buf, pos)
+            pos += 3
+            if n < pos + dest_len + 4:
+                return None
+            dest = buf[pos:pos+dest_len].decode('utf-8')
+            pos += dest_len
+            (payload_len,) = struct.unpack_from(">I", buf, pos)
+            return ("binary", dest, version, pos + 4, payload_len)
+
+        if not buf.startswith(_ONION_HEADER_BYTES):
+            return ("message", None, None, 0, None)
+
+        pos = len(_ONION_HEADER_BYTES)
+        to = buf.find(b"TO:", pos)
+        eol = buf.find(b"\n", to) if to >= 0 else -1
+        if eol < 0:
+            if n >= CONST_MAX_ONION_HEADER:
+                raise ValueError("onion header is too long")
+            return None
+        dest = buf[to+3:eol].strip().decode('utf-8')
+        if len(dest) < 1:
+            raise ValueError("no 'TO' field")
+        pos = eol + 1
+
+        version = CONST_ONION_V1
+        while pos < n and buf[pos] in b" \t\r\n":
+            pos += 1
+        rest = buf[pos:pos+len(_ONION_VERSION_BYTES)]
+        if len(rest) < len(_ONION_VERSION_BYTES) and _ONION_VERSION_BYTES.startswith(rest):
+            return None
+        if rest == _ONION_VERSION_BYTES:
+            eol = buf.find(b"\n", pos)
+            if eol < 0:
+                return None
+            version = int(buf[pos+len(_ONION_VERSION_BYTES):eol])
+            pos = eol + 1
+        return ("text", dest, version, pos, None)
+
+    def ParseText(buf):
+        """Parses a text onion held in bytes, in one forward pass.
+
+        Unlike FromString, this never builds intermediate strings: it finds
+        the TO line, the optional VERSION line and the trailer with a few
+        forward searches, then base64-decodes the payload straight out of a
+        memoryview slice of buf.  The returned onion's payload is the raw
+        ciphertext, ready for peel() (which then returns bytes).
+
+        @param buf: bytes, bytearray or memoryview holding a text onion
+        @return an Onion, or None if buf isn't a well-formed text onion
+        """
+        if isinstance(buf, memoryview):
+            buf = buf.obj if buf.contiguous and buf.nbytes == len(buf.obj) else bytes(buf)
+        if not Onion.isOnionText(buf):
+            return None
+
+        try:
+            pos = len(_ONION_HEADER_BYTES)
+            to = buf.find(b"TO:", pos)
+            eol = buf.find(b"\n", to)
+            if to < 0 or eol < 0:
+                print("ERROR parsing onion: no 'TO' field.")
+                return None
+            dest = bytes(buf[to+3:eol]).strip().decode('utf-8')
+            if len(dest) < 1:
+                print("ERROR parsing onion: no 'TO' field.")
+                return None
+            pos = eol + 1
+
+            # Hybrid onions carry a VERSION line right after TO; legacy ones don't.
+            version = CONST_ONION_V1
+            while pos < len(buf) and buf[pos] in b" \t\r\n":
+                pos += 1
+            if buf.startswith(_ONION_VERSION_BYTES, pos):
+                eol = buf.find(b"\n", pos)
+                version = int(buf[pos+len(_ONION_VERSION_BYTES):eol])
+                pos = eol + 1
+
+            end = buf.find(_ONION_TRAILER_BYTES, pos)
+            if end < 0:
+                print("ERROR parsing onion: no trailer.")
+                return None
+
+            payload = binascii.a2b_base64(memoryview(buf)[pos:end])
+            onion = Onion(dest, payload, version)
+            onion._text_wire = True
+            return onion
+
+        except Exception as e:
+            print("ERROR parsing onion:", e)
+            return None
 
     def FromString(onionstr):
         """Attempts to parse out a string into an object representation of an onion.
@@ -152,7 +786,14 @@ class Onion:
                 print("ERROR parsing onion: no 'TO' field.")
                 return None
 
-            return Onion(dest, m)
+            # Hybrid onions carry a VERSION line right after TO; legacy ones don't.
+            version = CONST_ONION_V1
+            if m.startswith(CONST_ONION_VERSION_TAG):
+                vline, m = m.split("\n", 1)
+                version = int(vline[len(CONST_ONION_VERSION_TAG):].strip())
+                m = m.strip()
+
+            return Onion(dest, m, version)
 
         except Exception as e:
             print("ERROR parsing onion:", e)
@@ -187,7 +828,15 @@ class Onion:
         try:
             # Cannot use raw rsa.decrypt here for large payloads
             #message = rsa.decrypt(self._payload, secret_cert._key)
-            message = InsecureRSABC.decrypt_payload(self._payload, secret_cert._key)
+            if self.isBinary():
+                if self._version == CONST_ONION_V2:
+                    message = InsecureRSABC.decrypt_hybrid_bytes(self._payload, secret_cert._key)
+                else:
+                    message = InsecureRSABC.decrypt_bytes(self._payload, secret_cert._key)
+            elif self._version == CONST_ONION_V2:
+                message = InsecureRSABC.decrypt_payload_hybrid(self._payload, secret_cert._key)
+            else:
+                message = InsecureRSABC.decrypt_payload_batch(self._payload, secret_cert._key)
             # if Onion.isOnion(message):
             #     return Onion.FromString(message)
             # else:
@@ -197,18 +846,275 @@ class Onion:
 
     def wrap(self, public_cert):
         try:
-            self._payload = InsecureRSABC.encrypt_payload(self._payload, public_cert._key) 
+            if self.isBinary():
+                if self._version == CONST_ONION_V2:
+                    self._payload = InsecureRSABC.encrypt_hybrid_bytes(bytes(self._payload), public_cert._key)
+                else:
+                    self._payload = InsecureRSABC.encrypt_bytes(bytes(self._payload), public_cert._key)
+            elif self._version == CONST_ONION_V2:
+                self._payload = InsecureRSABC.encrypt_payload_hybrid(self._payload, public_cert._key)
+            else:
+                self._payload = InsecureRSABC.encrypt_payload(self._payload, public_cert._key) 
         except rsa.DecryptionError as e:
             print("Error wrapping onion: ", e)
 
 
+class OnionBatch:
+    """Packs several onions into one request body, and unpacks them again
+    (see CONST_ONION_BATCH_MAGIC for the format).
+
+    Sample usage:
+    >     body = OnionBatch.Pack([onion.toWire() for onion in onions])
+    >     for data, binary in OnionBatch.Unpack(body):
+    >         onion = Onion.Parse(data)
+    """
+
+    def Pack(entries):
+        """@param entries: a list of (onion bytes, content type), as returned
+                        by Onion.toWire (content type None for text onions)
+        @return the batch, as bytes
+        """
+        parts = [CONST_ONION_BATCH_MAGIC, struct.pack(">I", len(entries))]
+        for data, content_type in entries:
+            parts.append(struct.pack(">BI", content_type == CONST_ONION_BINARY_TYPE, len(data)))
+            parts.append(data)
+        return b''.join(parts)
+
+    def Unpack(data):
+        """@return a list of (onion bytes, True if binary)
+        @raise ValueError if data isn't a whole batch
+        """
+        if bytes(data[:len(CONST_ONION_BATCH_MAGIC)]) != CONST_ONION_BATCH_MAGIC:
+            raise ValueError("not an onion batch")
+        try:
+            pos = len(CONST_ONION_BATCH_MAGIC)
+            (count,) = struct.unpack_from(">I", data, pos)
+            pos += 4
+            if count > CONST_MAX_BATCH_ONIONS:
+                raise ValueError(f"at most {CONST_MAX_BATCH_ONIONS} onions per batch")
+            entries = []
+            for _ in range(count):
+                binary, length = struct.unpack_from(">BI", data, pos)
+                pos += 5
+                if pos + length > len(data):
+                    raise ValueError("onion batch is truncated")
+                entries.append((bytes(data[pos:pos + length]), bool(binary)))
+                pos += length
+        except struct.error:
+            raise ValueError("onion batch is truncated")
+        if pos != len(data):
+            raise ValueError("extra bytes after onion batch")
+        return entries
+
+
+class OnionStreamPeeler:
+    """Peels one layer off an onion while its bytes are still arriving.
+
+    Feed it the onion (binary or text) a piece at a time; each feed() returns
+    whatever plaintext could be decrypted so far, and finish() returns the rest
+    once the input is over.  Only a window's worth of data is ever buffered
+    (plus the header), no matter how big the onion is.
+
+    If the input turns out not to be an onion, it is passed through unchanged
+    (kind == "message").
+
+    Sample usage:
+    >     peeler = OnionStreamPeeler(seccert)
+    >     for chunk in chunks:
+    >         out.write(peeler.feed(chunk))
+    >     out.write(peeler.finish())
+    """
+
+    def __init__(self, secret_cert):
+        self._cert = secret_cert
+        self._key = secret_cert._key
+        self._block_size = rsa.common.byte_size(self._key.n)
+        self.kind = None
+        self.dest = None
+        self.version = None
+        self._head = bytearray()      # input before the payload starts
+        self._remaining = None        # binary: payload bytes still to come
+        self._b64 = b''               # text: base64 not decoded yet
+        self._ct = b''                # ciphertext not decrypted yet
+        self._layer_key = None        # hybrid: the layer's symmetric key
+        self._enc_key_len = InsecureRSABC.encrypted_layer_key_length(self._key)
+        self._offset = 0              # hybrid: keystream position
+        self._done = False
+
+    def feed(self, chunk):
+        """Adds more input.
+
+        @return the plaintext bytes that are ready (may be empty)
+        @raise rsa.DecryptionError / ValueError if the onion is bad or not for us
+        """
+        if self.kind is None:
+            self._head += chunk
+            info = Onion.PeekHeader(self._head)
+            if info is None:
+                if len(self._head) > CONST_MAX_ONION_HEADER:
+                    raise ValueError("onion header is too long")
+                return b''
+            self.kind, self.dest, self.version, start, self._remaining = info
+            if self.kind != "message" and not (self._cert.isPrivate() and self._cert.isFor(self.dest)):
+                raise ValueError("Wrong recipient")
+            chunk = bytes(self._head[start:])
+            self._head = None
+
+        if self.kind == "message":
+            return bytes(chunk)
+        if self._done:
+            return b''
+
+        if self.kind == "binary":
+            chunk = chunk[:self._remaining]
+            self._remaining -= len(chunk)
+            if self._remaining == 0:
+                self._done = True
+            return self._decrypt(bytes(chunk))
+
+        # text: base64 runs until the trailer (which starts with '-')
+        chunk = bytes(chunk)
+        end = chunk.find(b'-')
+        if end >= 0:
+            chunk = chunk[:end]
+            self._done = True
+        b64 = self._b64 + chunk.translate(None, b" \t\r\n")
+        usable = len(b64) if self._done else len(b64) - len(b64) % 4
+        self._b64 = b64[usable:]
+        return self._decrypt(binascii.a2b_base64(b64[:usable]))
+
+    def _decrypt(self, ct):
+        ct = self._ct + ct
+        if self.version == CONST_ONION_V2:
+            if self._layer_key is None:
+                if len(ct) < self._enc_key_len:
+                    self._ct = ct
+                    return b''
+                engine = RSABatchDecryptor.ForKey(self._key)
+                self._layer_key = engine.decryptBlocks(ct[:self._enc_key_len])
+                if len(self._layer_key) != CONST_LAYER_KEY_SIZE:
+                    raise rsa.DecryptionError("Decryption failed")
+                ct = ct[self._enc_key_len:]
+            self._ct = b''
+            out = InsecureRSABC.keystream_xor(ct, self._layer_key, self._offset)
+            self._offset += len(ct)
+            return out
+
+        # legacy: only whole RSA blocks can be decrypted
+        usable = len(ct) - len(ct) % self._block_size
+        self._ct = ct[usable:]
+        return RSABatchDecryptor.ForKey(self._key).decryptBlocks(ct[:usable])
+
+    def finish(self):
+        """Says the input is over.
+
+        @return any last plaintext bytes
+        @raise ValueError if the onion was cut short
+        """
+        if self.kind is None:
+            # never saw enough to tell: it's a (short) message
+            self.kind = "message"
+            return bytes(self._head)
+        if self.kind == "message":
+            return b''
+        if self.kind == "text" and not self._done:
+            raise ValueError("onion is missing its trailer")
+        if self.kind == "binary" and self._remaining:
+            raise ValueError("onion payload is truncated")
+        if self._ct or (self.version == CONST_ONION_V2 and self._layer_key is None):
+            raise ValueError("onion payload is truncated")
+        return b''
+
+
+class DirectoryClient:
+    """Client helpers for the keyserver's version 2 directory API
+    (/v2/keys and /v2/nodes), which returns JSON objects keyed by username.
+
+    The Fetch* helpers send If-None-Match when given the ETag from a previous
+    fetch, and return None instead of data if nothing changed (304).  If the
+    keyserver is too old to know about /v2 (it answers 404, or something that
+    isn't a version 2 document), they fall back to /KEYS and /NODES.
+
+    Sample usage:
+    >     certs, etag = DirectoryClient.FetchKeys()
+    >     ...
+    >     newcerts, etag = DirectoryClient.FetchKeys(etag=etag)
+    >     if newcerts is None: print("nothing changed")
+    """
+
+    def KeysFromJSON(obj):
+        """Turns a /v2/keys response object into {uname: public Certificate}.
+        """
+        certs = {}
+        for uname, k in obj["keys"].items():
+            key = rsa.PublicKey.load_pkcs1(k["pubkey"].encode('utf-8'), format='PEM')
+            certs[uname] = Certificate(k["name"], uname, key)
+        return certs
+
+    def NodesFromJSON(obj):
+        """Turns a /v2/nodes response object into {uname: (ip, lastseen, port)}.
+        (Nodes listed without a port use CONST_NODE_PORT.)
+        """
+        return {uname: (n["ip"], n["lastseen"], n.get("port") or CONST_NODE_PORT)
+                for uname, n in obj["nodes"].items()}
+
+    def _fetch(path, legacy_path, uname, etag, transport):
+        if transport is None:
+            from transport import Transport
+            transport = Transport.Default()
+
+        q = "?" + urllib.parse.urlencode({"un": uname}) if uname is not None else ""
+        headers = {"If-None-Match": etag} if etag else {}
+        r = transport.keyserverGet(path + q, headers=headers)
+        if r.status_code == 304:
+            return None, etag, False
+        if r.status_code != 404:
+            r.raise_for_status()
+            try:
+                obj = r.json()
+            except ValueError:
+                obj = None
+            if isinstance(obj, dict) and "version" in obj:
+                return obj, r.headers.get("ETag"), False
+
+        # old keyserver (404, or a 200 that isn't a version 2 document):
+        # use the legacy list-of-rows endpoint instead
+        r = transport.keyserverGet(legacy_path + q)
+        r.raise_for_status()
+        return r.json(), None, True
+
+    def FetchKeys(uname=None, etag=None, transport=None):
+        """Fetches public keys (all of them, or just uname's).
+
+        @return ({uname: Certificate} or None if unchanged since etag, new etag)
+        """
+        obj, etag, legacy = DirectoryClient._fetch("/v2/keys", "/KEYS", uname, etag, transport)
+        if obj is None:
+            return None, etag
+        if legacy:
+            obj = {"keys": {u: {"name": n, "pubkey": k} for u, n, k in obj}}
+        return DirectoryClient.KeysFromJSON(obj), etag
+
+    def FetchNodes(uname=None, etag=None, transport=None):
+        """Fetches online nodes (all of them, or just uname's).
+
+        @return ({uname: (ip, lastseen, port)} or None if unchanged since etag, new etag)
+        """
+        obj, etag, legacy = DirectoryClient._fetch("/v2/nodes", "/NODES", uname, etag, transport)
+        if obj is None:
+            return None, etag
+        if legacy:
+            obj = {"nodes": {u: {"ip": ip, "lastseen": seen} for u, ip, seen in obj}}
+        return DirectoryClient.NodesFromJSON(obj), etag
+
+
 class Certificate:
     def __init__(self, name, uname, rsakey):
         self._name = name
         self._uname = uname
         self._key = rsakey
 
-    def MakePair(name, uname, key_size=127):
+    def MakePair(name, uname, key_size=CONST_KEY_SIZE):
         pubkey, seckey = rsa.newkeys(key_size)
         p = Certificate(name, uname, pubkey)
         s = Certificate(name, uname, seckey)
@@ -238,7 +1144,11 @@ class Certificate:
         """Converts a JSON serialized representation of this cert into an object.
         Should be the inverse of Onion.asJSON()
         """
-        d = json.loads(blob)
+        return Certificate.FromDict(json.loads(blob))
+
+    def FromDict(d):
+        """Like FromJSON, but takes the already-parsed JSON object.
+        """
         k = d["key"]
 
         if d['ctype'] == "PRIVATE": k = rsa.PrivateKey.load_pkcs1(k, format='PEM')
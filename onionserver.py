@@ -0,0 +1,293 @@
+#
+# onionserver.py
+#
+# HTTP server plumbing shared by onionNode.py and keyserver.py.
+#
+# BoundedThreadingHTTPServer:
+# An HTTPServer that handles requests on a bounded pool of worker threads, so
+# one slow request (a big peel, a slow downstream node) doesn't block every
+# other client.  When all workers are busy and the waiting line is full, new
+# connections get a "503 Service Unavailable" right away instead of piling up.
+# On shutdown, drain() waits for in-flight requests to finish.
+#
+# KeepAliveMixin:
+# For the server's request handlers.  A worker handles one request at a time:
+# between requests, an idle keep-alive connection is handed back to the
+# server, which watches it (with a selector, on one thread) and only gives it
+# a worker again when the next request starts to arrive.  So idle connections
+# held open by other nodes' connection pools don't use up the workers.
+#
+
+import threading
+import concurrent.futures
+import logging
+import selectors
+import socket
+import time
+
+from http.server import HTTPServer
+
+# Default number of requests handled at the same time.
+CONST_MAX_WORKERS = 16
+
+# Default number of accepted requests allowed to wait for a free worker.
+CONST_MAX_QUEUED = 32
+
+# How long (seconds) shutdown waits for in-flight requests to finish.
+CONST_DRAIN_TIMEOUT = 30
+
+# How long (seconds) an idle keep-alive connection is kept open, and how long
+# a request may take to arrive once it has started.  Handlers should use this
+# as their socket timeout.
+CONST_KEEPALIVE_TIMEOUT = 5
+
+
+class KeepAliveMixin:
+    """For BaseHTTPRequestHandler subclasses served by BoundedThreadingHTTPServer:
+    handles one request per turn on a worker, and hands the connection back
+    to the server to wait for the next one (instead of blocking the worker
+    until it arrives or the connection times out).
+    """
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        self.wants_park = not self.close_connection
+
+    def finish(self):
+        # a parked connection stays open; the server finishes it later
+        if not getattr(self, "wants_park", False):
+            super().finish()
+
+    def resume(self):
+        """Handles the next request on a parked connection.
+        """
+        self.wants_park = False
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def hasBufferedInput(self):
+        """True if (part of) the next request was already read off the socket
+        (e.g., a pipelined request), so a selector wouldn't see it.
+        """
+        timeout = self.connection.gettimeout()
+        try:
+            self.connection.settimeout(0)
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+    def close(self):
+        """Finishes a parked connection (the server then closes the socket).
+        """
+        self.wants_park = False
+        try:
+            self.finish()
+        except OSError:
+            pass
+
+
+class BoundedThreadingHTTPServer(HTTPServer):
+    """An HTTPServer that hands requests to a bounded pool of worker threads.
+
+    Workers and slots are counted per request, not per connection: with a
+    KeepAliveMixin handler, idle keep-alive connections wait on the server's
+    selector thread (for up to keepalive_timeout seconds) without a worker.
+
+    @param max_workers: how many requests are handled concurrently
+    @param max_queued: how many more may wait for a worker before we send 503s
+    @param keepalive_timeout: seconds an idle keep-alive connection is kept open
+    """
+
+    def __init__(self, server_address, handler_class,
+                 max_workers=CONST_MAX_WORKERS, max_queued=CONST_MAX_QUEUED,
+                 keepalive_timeout=CONST_KEEPALIVE_TIMEOUT):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.keepalive_timeout = keepalive_timeout
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                           thread_name_prefix="onion-worker")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._inflight = 0
+        self._idle = threading.Condition()
+
+        # idle keep-alive connections (see _park / _watch)
+        self._selector = selectors.DefaultSelector()
+        self._to_park = []
+        self._park_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._closing = False
+        self._watcher = threading.Thread(target=self._watch, name="onion-keepalive", daemon=True)
+        self._watcher.start()
+        # (after the above: if binding fails, this calls server_close)
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        """Called by serve_forever() for each new connection.
+        Queues it for a worker, or turns it away if we're saturated.
+        """
+        self._dispatch(request, client_address)
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def _dispatch(self, request, client_address, handler=None):
+        """Queues a request (on a new connection, or on a parked handler's
+        connection) for a worker, or turns it away if we're saturated.
+        """
+        if not self._slots.acquire(blocking=False):
+            if handler is not None:
+                handler.close()
+            self.reject_request(request, client_address)
+            return
+
+        with self._idle:
+            self._inflight += 1
+        try:
+            self._pool.submit(self._work, request, client_address, handler)
+        except RuntimeError:
+            # the pool was shut down (the server or the interpreter is exiting)
+            self._slots.release()
+            with self._idle:
+                self._inflight -= 1
+                self._idle.notify_all()
+            if handler is not None:
+                handler.close()
+            self.shutdown_request(request)
+
+    def _work(self, request, client_address, handler=None):
+        try:
+            if handler is None:
+                handler = self.finish_request(request, client_address)
+            else:
+                handler.resume()
+        except Exception:
+            self.handle_error(request, client_address)
+            handler = None
+        finally:
+            self._slots.release()
+            with self._idle:
+                self._inflight -= 1
+                self._idle.notify_all()
+            if getattr(handler, "wants_park", False):
+                self._park(handler)
+            else:
+                self.shutdown_request(request)
+
+    def _park(self, handler):
+        """Hands an idle keep-alive connection to the selector thread, which
+        dispatches it again when the next request arrives.
+        """
+        if handler.hasBufferedInput():
+            self._dispatch(handler.request, handler.client_address, handler)
+            return
+        with self._park_lock:
+            if not self._closing:
+                self._to_park.append(handler)
+                handler = None
+        if handler is not None:
+            handler.close()
+            self.shutdown_request(handler.request)
+            return
+        try:
+            self._wakeup_w.send(b'x')
+        except OSError:
+            pass
+
+    def _watch(self):
+        """The selector thread: waits on every parked connection at once,
+        dispatches the ones a request arrives on, and closes the ones that
+        stay idle for longer than keepalive_timeout.
+        """
+        deadlines = {}      # handler -> when it gets closed if still idle
+        while True:
+            now = time.monotonic()
+            timeout = max(0.0, min(deadlines.values()) - now) if deadlines else None
+            events = self._selector.select(timeout)
+
+            with self._park_lock:
+                closing = self._closing
+                parked, self._to_park = self._to_park, []
+            now = time.monotonic()
+            for handler in parked:
+                self._selector.register(handler.request, selectors.EVENT_READ, handler)
+                deadlines[handler] = now + self.keepalive_timeout
+
+            ready = []
+            for key, _ in events:
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        while self._wakeup_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.data in deadlines:
+                    ready.append(key.data)
+            expired = [h for h, t in deadlines.items() if closing or (t <= now and h not in ready)]
+
+            for handler in ready + expired:
+                del deadlines[handler]
+                self._selector.unregister(handler.request)
+            for handler in ready:
+                if closing:
+                    expired.append(handler)
+                else:
+                    self._dispatch(handler.request, handler.client_address, handler)
+            for handler in expired:
+                handler.close()
+                self.shutdown_request(handler.request)
+            if closing:
+                return
+
+    def reject_request(self, request, client_address):
+        """Sends a bare 503 response and hangs up.
+        """
+        logging.warning("Server saturated, rejecting request from %s", client_address[0])
+        body = b"Server busy, try again later."
+        try:
+            request.sendall(b"HTTP/1.1 503 Service Unavailable\r\n"
+                            b"Content-type: text/html\r\n"
+                            b"Retry-After: 1\r\n"
+                            b"Connection: close\r\n"
+                            b"Content-Length: " + str(len(body)).encode('ascii') + b"\r\n"
+                            b"\r\n" + body)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def inflight(self):
+        """Returns the number of requests being handled or waiting for a worker.
+        """
+        with self._idle:
+            return self._inflight
+
+    def drain(self, timeout=CONST_DRAIN_TIMEOUT):
+        """Waits until no requests are in flight (call after serve_forever() returns).
+
+        @param timeout: seconds to wait at most (None waits forever)
+        @return True if everything finished, False if we gave up waiting.
+        """
+        with self._idle:
+            done = self._idle.wait_for(lambda: self._inflight == 0, timeout)
+        if not done:
+            logging.warning("Gave up waiting on %d in-flight requests", self._inflight)
+        return done
+
+    def server_close(self):
+        super().server_close()
+        with self._park_lock:
+            self._closing = True
+        try:
+            self._wakeup_w.send(b'x')
+        except OSError:
+            pass
+        self._watcher.join()
+        self._selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,246 @@
+#
+# pathselect.py
+#
+# Picks random paths (circuits) through the online Onion Nodes, so nobody has
+# to type in every hop by hand.
+#
+# NodeStats:
+# Passive measurements of each node, taken while onions are sent anyway (by
+# the sender to a first hop, by a node to its next hop): a moving average of
+# the round trip time, and a moving average of how often sends fail.
+#
+# PathSelector:
+# Picks N distinct nodes from the keyserver's /NODES listing, at random but
+# weighted so that fast, reliable nodes are picked more often than slow or
+# flaky ones.  Nodes that haven't checked in with the keyserver for a while
+# are left out.  Nodes we've never measured get an average weight, so they
+# still get tried.
+#
+
+import contextlib
+import datetime
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from directory import DirectoryCache
+
+# How much each new measurement moves the moving averages (0..1).
+CONST_STATS_ALPHA = 0.2
+
+# Round trip time (seconds) assumed for nodes nobody has measured yet.
+CONST_DEFAULT_RTT = 0.5
+
+# Round trip times shorter than this (seconds) all count the same, so one
+# very fast node doesn't get picked every time.
+CONST_MIN_RTT = 0.01
+
+# Nodes whose lastseen is older than this (seconds) are not picked.
+# Nodes send a heartbeat every minute or so; this allows a few to go missing.
+CONST_NODE_MAX_AGE = 300
+
+# File the sender keeps its measurements in between runs.
+STATSFILE = "node-stats.json"
+
+
+class NodeStats:
+    """Moving averages of round trip time and failure rate, per username.
+
+    Sample usage:
+    >     stats = NodeStats.Default()
+    >     with stats.measure("alice"):
+    >         transport.nodePost(ip, onion)   # a failure is recorded if this raises
+    >     print(stats.weight("alice"))
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, alpha=CONST_STATS_ALPHA):
+        self._alpha = alpha
+        self._rtt = {}          # uname -> moving average of round trip time
+        self._fail = {}         # uname -> moving average of failures (0..1)
+        self._lock = threading.Lock()
+
+    def Default():
+        """Returns the shared NodeStats for this process (made on first use).
+        """
+        with NodeStats._default_lock:
+            if NodeStats._default is None:
+                NodeStats._default = NodeStats()
+            return NodeStats._default
+
+    def SetDefault(stats):
+        """Replaces the shared NodeStats.
+        """
+        with NodeStats._default_lock:
+            NodeStats._default = stats
+
+    def _average(self, table, uname, value, prior=None):
+        old = table.get(uname, prior)
+        table[uname] = value if old is None else old + self._alpha * (value - old)
+
+    def record(self, uname, rtt, ok):
+        """Adds one measurement for uname.
+
+        @param rtt: seconds the send took (ignored if it failed)
+        @param ok: False if the send failed
+        """
+        with self._lock:
+            self._average(self._fail, uname, 0.0 if ok else 1.0, prior=0.0)
+            if ok:
+                self._average(self._rtt, uname, rtt)
+
+    @contextlib.contextmanager
+    def measure(self, uname):
+        """Times the block and records it for uname (as a failure if it raises).
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.record(uname, None, False)
+            raise
+        self.record(uname, time.monotonic() - start, True)
+
+    def rtt(self, uname):
+        """Returns the average round trip time for uname (None if never measured).
+        """
+        with self._lock:
+            return self._rtt.get(uname)
+
+    def failureRate(self, uname):
+        """Returns the recent failure rate for uname (0 if never measured).
+        """
+        with self._lock:
+            return self._fail.get(uname, 0.0)
+
+    def snapshot(self):
+        """Returns every measurement, e.g. for reporting them (see /METRICS).
+
+        @return {uname: (average round trip time or None, failure rate)}
+        """
+        with self._lock:
+            return {uname: (self._rtt.get(uname), fail) for uname, fail in self._fail.items()}
+
+    def _typicalRTT(self):
+        """Median of the measured round trip times.  Call with self._lock held.
+        """
+        rtts = sorted(self._rtt.values())
+        if not rtts:
+            return CONST_DEFAULT_RTT
+        return rtts[len(rtts) // 2]
+
+    def weight(self, uname):
+        """How likely uname should be to be picked: inversely proportional to
+        its round trip time, and falling off quickly as it fails more often.
+        """
+        with self._lock:
+            rtt = self._rtt.get(uname)
+            if rtt is None:
+                rtt = self._typicalRTT()
+            fail = self._fail.get(uname, 0.0)
+        return (1.0 - fail) ** 2 / max(rtt, CONST_MIN_RTT)
+
+    def seedFromFile(self, fname=STATSFILE):
+        """Loads measurements saved by saveToFile (missing file: nothing loaded).
+        """
+        try:
+            with open(fname, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.info("Not loading node stats from %s: %s", fname, e)
+            return
+        with self._lock:
+            self._rtt.update(saved.get("rtt", {}))
+            self._fail.update(saved.get("fail", {}))
+
+    def saveToFile(self, fname=STATSFILE):
+        """Saves the measurements, so the next run starts with them.
+        """
+        with self._lock:
+            saved = {"rtt": dict(self._rtt), "fail": dict(self._fail)}
+        with open(fname, 'w') as f:
+            json.dump(saved, f)
+
+
+class PathSelector:
+    """Picks random paths through the online nodes.
+
+    Sample usage:
+    >     path = PathSelector().select(3, recipient="alice")
+    >     # e.g. ["carol", "bob", "dave", "alice"]: three hops, then the recipient
+    >     CircuitBuilder().send(path, b"Hi Alice!")
+    """
+
+    def __init__(self, directory=None, stats=None, max_age=CONST_NODE_MAX_AGE, rng=None):
+        self._directory = directory
+        self._stats = stats
+        self._max_age = max_age
+        self._rng = rng or random.SystemRandom()
+
+    def _getDirectory(self):
+        return self._directory or DirectoryCache.Default()
+
+    def _getStats(self):
+        return self._stats or NodeStats.Default()
+
+    def _age(self, lastseen):
+        """Seconds since lastseen (a keyserver "YYYY-MM-DD HH:MM:SS" UTC
+        timestamp), or None if it can't be read.
+        """
+        try:
+            seen = datetime.datetime.strptime(str(lastseen), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (now - seen).total_seconds()
+
+    def candidates(self, exclude=()):
+        """Returns {uname: weight} for every online node that isn't stale
+        (or listed in exclude).
+        """
+        stats = self._getStats()
+        weights = {}
+        for uname, (ip, lastseen) in self._getDirectory().getNodes().items():
+            if uname in exclude:
+                continue
+            age = self._age(lastseen)
+            if age is not None and age > self._max_age:
+                continue
+            weights[uname] = stats.weight(uname)
+        return weights
+
+    def select(self, n, recipient=None, exclude=()):
+        """Picks n distinct nodes at random, favouring fast, reliable ones.
+
+        @param n: how many hops to pick
+        @param recipient: if given, it is never picked as a hop, and is added
+                          to the end of the path
+        @param exclude: usernames never to pick
+        @return the path (first hop first)
+        @raise Exception if there aren't n usable nodes online
+        """
+        exclude = set(exclude)
+        if recipient is not None:
+            exclude.add(recipient)
+        weights = self.candidates(exclude)
+        if len(weights) < n:
+            raise Exception(f"Only {len(weights)} usable nodes online, need {n}")
+
+        # weighted sampling without replacement: give each node the key
+        # u ** (1 / weight) for a uniform random u, and take the n biggest
+        keyed = []
+        for uname, w in weights.items():
+            u = self._rng.random()
+            key = math.log(u) / w if w > 0 and u > 0 else -math.inf
+            keyed.append((key, uname))
+        keyed.sort(reverse=True)
+
+        path = [uname for _, uname in keyed[:n]]
+        if recipient is not None:
+            path.append(recipient)
+        return path
@@ -0,0 +1,33 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onionserver import BoundedThreadingHTTPServer
+
+
+@pytest.fixture
+def serve():
+    """Starts an HTTP server on a loopback port in a background thread.
+
+    @return a function (handler class, server_args=None, **server attributes) -> base URL,
+            where server_args are keyword arguments for BoundedThreadingHTTPServer
+    """
+    servers = []
+
+    def start(handler_class, server_args=None, **attrs):
+        httpd = BoundedThreadingHTTPServer(("127.0.0.1", 0), handler_class, **(server_args or {}))
+        for k, v in attrs.items():
+            setattr(httpd, k, v)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
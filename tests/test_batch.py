@@ -0,0 +1,113 @@
+import struct
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import onionNode
+from directory import DirectoryCache
+from onions import Certificate, Onion, OnionBatch, CONST_ONION_V2, CONST_ONION_BINARY_TYPE, \
+                   CONST_ONION_BATCH_TYPE, CONST_MAX_BATCH_ONIONS
+
+ALICE_PUB, ALICE_SEC = Certificate.MakePair("Alice", "alice")
+BOB_PUB, _ = Certificate.MakePair("Bob", "bob")
+
+
+class FixedKeyStore:
+    def getCert(self):
+        return ALICE_SEC
+
+
+class FailingBatcher:
+    """Refuses every onion, as a closed ForwardBatcher does."""
+    def submit(self, onion):
+        raise RuntimeError("ForwardBatcher is closed")
+
+
+def _onion(message):
+    """A two-layer binary onion: alice -> bob -> message."""
+    inner = Onion("bob", message, CONST_ONION_V2)
+    Onion.wrap(inner, BOB_PUB)
+    outer = Onion("alice", inner.toBytes(), CONST_ONION_V2)
+    Onion.wrap(outer, ALICE_PUB)
+    return outer.toBytes()
+
+
+def _post(url, onions):
+    body = OnionBatch.Pack([(o, CONST_ONION_BINARY_TYPE) for o in onions])
+    r = requests.post(url, data=body, headers={"Content-Type": CONST_ONION_BATCH_TYPE})
+    r.raise_for_status()
+    return r.json()["results"]
+
+
+def test_failed_submit_gives_per_onion_status(serve):
+    url = serve(onionNode.OnionNodeHandler, keystore=FixedKeyStore(), forwarder=None,
+                batcher=FailingBatcher(), streaming=False)
+    results = _post(url, [_onion(b"one"), b"not an onion", _onion(b"two")])
+    assert [r["status"] for r in results] == [502, 200, 502]
+
+
+def test_big_batch_is_not_streamed(serve):
+    url = serve(onionNode.OnionNodeHandler, keystore=FixedKeyStore(), forwarder=None,
+                batcher=FailingBatcher(), streaming=True)
+    big = _onion(b"x" * onionNode.CONST_STREAM_THRESHOLD)
+    results = _post(url, [big, _onion(b"small")])
+    assert [r["status"] for r in results] == [502, 502]
+
+
+class LegacyNode(BaseHTTPRequestHandler):
+    """Answers like a node from before batching: 404 for a batch."""
+    protocol_version = "HTTP/1.1"
+    timeout = 1
+    batch_posts = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith(CONST_ONION_BATCH_TYPE):
+            LegacyNode.batch_posts += 1
+            code, body = 404, b"Not found"
+        else:
+            code, body = 200, b"Thanks for the onion.  :)"
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_batcher_stops_batching_to_a_node_that_rejects_batches(serve):
+    port = int(serve(LegacyNode).rsplit(":", 1)[1])
+    directory = DirectoryCache()
+    directory.addNodes({"bob": ("127.0.0.1", None, port)})
+    DirectoryCache.SetDefault(directory)
+    LegacyNode.batch_posts = 0
+    batcher = onionNode.ForwardBatcher(window=0.05, max_onions=2)
+    try:
+        for _ in range(3):
+            futures = [batcher.submit(Onion("bob", b"onion", CONST_ONION_V2)) for _ in range(2)]
+            assert [f.result(timeout=10)["status"] for f in futures] == [200, 200]
+    finally:
+        batcher.close()
+        DirectoryCache.SetDefault(None)
+    assert LegacyNode.batch_posts == 1
+
+
+def test_batch_framing():
+    text = b"-----text onion-----"
+    body = OnionBatch.Pack([(b"\x89ONIabc", CONST_ONION_BINARY_TYPE), (text, None)])
+    assert body == b"\x89ONB" + struct.pack(">I", 2) \
+                   + struct.pack(">BI", 1, 7) + b"\x89ONIabc" + struct.pack(">BI", 0, len(text)) + text
+    assert OnionBatch.Unpack(body) == [(b"\x89ONIabc", True), (text, False)]
+
+
+@pytest.mark.parametrize("body", [
+    b"\x89ONI" + struct.pack(">I", 0),                              # not a batch
+    b"\x89ONB" + struct.pack(">I", 1) + struct.pack(">BI", 1, 10) + b"short",
+    b"\x89ONB" + struct.pack(">I", 0) + b"extra",
+    b"\x89ONB" + struct.pack(">I", CONST_MAX_BATCH_ONIONS + 1),
+])
+def test_bad_batches_are_rejected(body):
+    with pytest.raises(ValueError):
+        OnionBatch.Unpack(body)
@@ -0,0 +1,37 @@
+from http.server import BaseHTTPRequestHandler
+
+import onionSender
+from onions import Certificate, Onion
+
+ALICE_PUB, ALICE_SEC = Certificate.MakePair("Alice", "alice")
+BOB_PUB, _ = Certificate.MakePair("Bob", "bob")
+
+
+class OldNode(BaseHTTPRequestHandler):
+    """Reads bodies the way the original node did: Content-Length only."""
+    timeout = 1
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        OldNode.received.append((dict(self.headers), body))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b"Thanks for the onion.  :)")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_circuit_is_sent_with_content_length(serve):
+    port = int(serve(OldNode).rsplit(":", 1)[1])
+    OldNode.received = []
+    builder = onionSender.CircuitBuilder(window=1024)
+    message = b"hello bob " * 1000
+    builder.send(["alice", "bob"], message, certs=[ALICE_PUB, BOB_PUB], ip="127.0.0.1", port=port)
+
+    (headers, body), = OldNode.received
+    assert "Transfer-Encoding" not in headers
+    assert int(headers["Content-Length"]) == len(body)
+    inner = Onion.Parse(Onion.peel(Onion.Parse(body), ALICE_SEC))
+    assert inner._dest == "bob"
@@ -0,0 +1,51 @@
+import json
+from http.server import BaseHTTPRequestHandler
+
+import rsa
+
+from directory import DirectoryCache
+from onions import Certificate, DirectoryClient, CONST_NODE_PORT
+from transport import Transport
+
+PUBKEY, _ = rsa.newkeys(128)
+
+
+class LegacyKeyServer(BaseHTTPRequestHandler):
+    """Answers like the original keyserver: /KEYS and /NODES lists of rows,
+    and 200 with a plain-text apology for anything else (including /v2/...).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/KEYS"):
+            rows = [["alice", "Alice", PUBKEY.save_pkcs1(format='PEM').decode('utf-8')]]
+            body, ctype = json.dumps(rows).encode('utf-8'), "application/json"
+        elif self.path.startswith("/NODES"):
+            body, ctype = json.dumps([["alice", "10.0.0.1", "2024-01-01 00:00:00"]]).encode('utf-8'), \
+                          "application/json"
+        else:
+            body, ctype = b"Sorry, I don't respond to GET requests.", "text/html"
+        self.send_response(200)
+        self.send_header('Content-type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fetch_falls_back_when_v2_answers_plain_text(serve):
+    transport = Transport(keyserver_url=serve(LegacyKeyServer))
+    certs, etag = DirectoryClient.FetchKeys(transport=transport)
+    assert list(certs) == ["alice"] and certs["alice"]._key == PUBKEY
+    assert etag is None
+    nodes, _ = DirectoryClient.FetchNodes(transport=transport)
+    assert nodes == {"alice": ("10.0.0.1", "2024-01-01 00:00:00", CONST_NODE_PORT)}
+
+
+def test_directory_cache_against_legacy_keyserver(serve):
+    directory = DirectoryCache(transport=Transport(keyserver_url=serve(LegacyKeyServer)))
+    assert directory.getAddress("alice") == ("10.0.0.1", CONST_NODE_PORT)
+    assert isinstance(directory.getCert("alice"), Certificate)
+    assert directory.getAddress("bob") is None
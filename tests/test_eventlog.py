@@ -0,0 +1,29 @@
+import logging
+
+import pytest
+
+from eventlog import EventLog, HTTPLogMixin
+
+
+class FakeHandler(HTTPLogMixin):
+    client_address = ("127.0.0.1", 5555)
+
+
+@pytest.fixture
+def events(caplog):
+    EventLog.SetDefault(EventLog(sampling={"access": 1.0}, logger="test-eventlog"))
+    caplog.set_level(logging.INFO, logger="test-eventlog")
+    yield caplog
+    EventLog.SetDefault(None)
+
+
+def test_timeouts_and_client_errors_go_to_access(events):
+    FakeHandler().log_error("Request timed out: %r", TimeoutError("timed out"))
+    FakeHandler().log_error("code %d, message %s", 404, "Not Found")
+    assert [(r.levelno, r.getMessage()) for r in events.records] == \
+           [(logging.INFO, "access.http"), (logging.INFO, "access.http")]
+
+
+def test_server_errors_go_to_error(events):
+    FakeHandler().log_error("code %d, message %s", 500, "Internal Server Error")
+    assert [(r.levelno, r.getMessage()) for r in events.records] == [(logging.WARNING, "error.http")]
@@ -0,0 +1,68 @@
+import socket
+import time
+
+import requests
+
+import keyserver
+import onionNode
+
+# Well under the ~40ms a Nagle / delayed-ACK stall costs each request.
+MAX_AVERAGE = 0.02
+REQUESTS = 10
+
+
+def _average(url):
+    with requests.Session() as s:
+        s.get(url).raise_for_status()       # open the connection
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            s.get(url).raise_for_status()
+        return (time.perf_counter() - start) / REQUESTS
+
+
+def test_keyserver_reused_connection_is_fast(serve, tmp_path, monkeypatch):
+    monkeypatch.setattr(keyserver.KeyDatabase, "DBFILE", str(tmp_path / "keys.sqlite3"))
+    url = serve(keyserver.OnionKeyServer)
+    assert _average(url + "/v2/keys") < MAX_AVERAGE
+
+
+def test_node_reused_connection_is_fast(serve):
+    url = serve(onionNode.OnionNodeHandler, forwarder=None, batcher=None)
+    assert _average(url + "/METRICS") < MAX_AVERAGE
+
+
+def test_idle_keepalive_connections_dont_hold_workers(serve):
+    # more kept-alive clients than workers and queue slots together
+    url = serve(onionNode.OnionNodeHandler, server_args={"max_workers": 2, "max_queued": 1},
+                forwarder=None, batcher=None)
+    sessions = [requests.Session() for _ in range(6)]
+    try:
+        for _ in range(2):
+            for s in sessions:
+                start = time.perf_counter()
+                s.get(url + "/METRICS").raise_for_status()
+                assert time.perf_counter() - start < 1.0
+    finally:
+        for s in sessions:
+            s.close()
+
+
+def test_idle_keepalive_connection_is_closed_after_timeout(serve):
+    url = serve(onionNode.OnionNodeHandler, server_args={"keepalive_timeout": 0.2},
+                forwarder=None, batcher=None)
+    host, port = url[len("http://"):].split(":")
+    with socket.create_connection((host, int(port)), timeout=5) as sock:
+        sock.sendall(b"GET /METRICS HTTP/1.1\r\nHost: x\r\n\r\n")
+        f = sock.makefile("rb")
+        assert f.readline().startswith(b"HTTP/1.1 200")
+        length = 0
+        while True:
+            line = f.readline()
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+            if line == b"\r\n":
+                break
+        f.read(length)
+        start = time.perf_counter()
+        assert f.read(1) == b""         # the server hung up on the idle connection
+        assert time.perf_counter() - start < 2
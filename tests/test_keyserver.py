@@ -0,0 +1,116 @@
+import json
+
+import pytest
+import requests
+
+import keymanager
+import keyserver
+from onions import Certificate
+from transport import Transport
+
+ALICE, ALICE_SECRET = Certificate.MakePair("Alice", "alice", key_size=512)
+BOB, _ = Certificate.MakePair("Bob", "bob", key_size=512)
+
+
+@pytest.fixture
+def url(serve, tmp_path, monkeypatch):
+    monkeypatch.setattr(keyserver.KeyDatabase, "DBFILE", str(tmp_path / "keys.sqlite3"))
+    keyserver.KeyDatabase.InvalidateCerts()     # the listing cache outlives a DBFILE change
+    return serve(keyserver.OnionKeyServer)
+
+
+def _keys(url):
+    r = requests.get(url + "/v2/keys")
+    r.raise_for_status()
+    return r.json()["keys"]
+
+
+def test_bulk_post_stores_public_and_rejects_private(url):
+    body = "\n".join(c.asJSON() for c in [ALICE, ALICE_SECRET, BOB])
+    r = requests.post(url + "/v2/keys", data=body.encode('utf-8'),
+                      headers={"Content-Type": "application/x-ndjson"})
+    r.raise_for_status()
+    reply = r.json()
+    assert reply["stored"] == 2
+    assert [(e["username"], e["ok"]) for e in reply["results"]] == \
+           [("alice", True), ("alice", False), ("bob", True)]
+    assert "public" in reply["results"][1]["error"]
+
+    keys = _keys(url)
+    assert sorted(keys) == ["alice", "bob"]
+    assert keys["alice"]["pubkey"] == ALICE.KeyAsPEM().decode('utf-8')
+
+
+def test_bulk_post_accepts_a_json_list(url):
+    body = json.dumps([json.loads(c.asJSON()) for c in [ALICE, BOB]])
+    r = requests.post(url + "/v2/keys", data=body.encode('utf-8'))
+    assert r.json()["stored"] == 2
+    assert sorted(_keys(url)) == ["alice", "bob"]
+
+
+def test_bulk_post_rejects_bad_requests(url):
+    assert requests.post(url + "/v2/keys", data=b"not json").status_code == 400
+    too_many = "\n".join([ALICE.asJSON()] * (keyserver.CONST_MAX_BULK_CERTS + 1))
+    assert requests.post(url + "/v2/keys", data=too_many.encode('utf-8')).status_code == 413
+    assert _keys(url) == {}
+
+
+def test_post_many_never_sends_private_certs(url):
+    Transport.SetDefault(Transport(keyserver_url=url))
+    try:
+        results = keymanager.postManyToServer([ALICE_SECRET, ALICE, BOB], batch=1)
+    finally:
+        Transport.SetDefault(None)
+    assert results == [{"username": "alice", "ok": False, "error": "private certificate"},
+                       {"username": "alice", "ok": True},
+                       {"username": "bob", "ok": True}]
+    assert sorted(_keys(url)) == ["alice", "bob"]
+
+
+def _age(uname, seconds):
+    db = keyserver.KeyDatabase.ForThread()
+    with db._con:
+        db._con.execute("UPDATE nodes SET lastseen = datetime('now', ?) WHERE uname = ?",
+                        (f"-{seconds} seconds", uname))
+
+
+def _nodes(url, query=""):
+    r = requests.get(url + "/v2/nodes" + query)
+    r.raise_for_status()
+    return r.json()["nodes"]
+
+
+def test_heartbeat_keeps_a_node_live(url):
+    assert requests.get(url + "/ONLINE?un=alice&port=9001").text == "Node Online"
+    assert requests.get(url + "/ONLINE?un=bob").ok
+    _age("alice", 600)
+    _age("bob", 600)
+    assert _nodes(url, "?live_within=60") == {}
+
+    assert requests.get(url + "/HEARTBEAT?un=alice&port=9002").text == "OK"
+    live = _nodes(url, "?live_within=60")
+    assert list(live) == ["alice"] and live["alice"]["port"] == 9002
+    assert sorted(_nodes(url)) == ["alice", "bob"]
+    legacy = requests.get(url + "/NODES?live_within=60").json()
+    assert [row[0] for row in legacy] == ["alice"] and len(legacy[0]) == 3
+
+
+def test_heartbeat_bad_requests(url):
+    assert requests.get(url + "/HEARTBEAT").status_code == 500
+    assert requests.get(url + "/NODES?live_within=soon").status_code == 400
+    assert requests.get(url + "/HEARTBEAT?un=alice&port=http").status_code == 400
+
+
+def test_reaper_expires_only_stale_nodes(url):
+    for uname in ["a", "b", "c", "fresh"]:
+        requests.get(url + f"/ONLINE?un={uname}").raise_for_status()
+    for uname in ["a", "b", "c"]:
+        _age(uname, 600)
+
+    reaper = keyserver.NodeReaper(ttl=60, batch=2)      # more stale nodes than one batch
+    assert reaper.expire() == 3
+    assert list(_nodes(url)) == ["fresh"]
+
+    # a node that was expired comes back with its next heartbeat
+    requests.get(url + "/HEARTBEAT?un=a&port=9003").raise_for_status()
+    assert _nodes(url, "?un=a")["a"]["port"] == 9003
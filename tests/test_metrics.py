@@ -0,0 +1,30 @@
+import requests
+
+import onionNode
+from metrics import MetricsRegistry
+from pathselect import NodeStats
+
+
+def test_node_metrics_report_next_hop_stats(serve):
+    stats = NodeStats()
+    stats.record("bob", 0.25, True)
+    stats.record("carol", None, False)
+    NodeStats.SetDefault(stats)
+    try:
+        url = serve(onionNode.OnionNodeHandler, forwarder=None, batcher=None)
+        lines = requests.get(url + "/METRICS").text.splitlines()
+    finally:
+        NodeStats.SetDefault(None)
+
+    assert 'onion_next_hop_rtt_seconds{hop="bob"} 0.25' in lines
+    assert 'onion_next_hop_failure_rate{hop="bob"} 0.0' in lines
+    assert f'onion_next_hop_failure_rate{{hop="carol"}} {stats.failureRate("carol")!r}' in lines
+    assert not any(l.startswith('onion_next_hop_rtt_seconds{hop="carol"}') for l in lines)
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    registry.counter("errors", "Errors\nby kind", error='bad "onion" \\ here\nreally').inc()
+    lines = registry.render().splitlines()
+    assert '# HELP errors Errors\\nby kind' in lines
+    assert 'errors{error="bad \\"onion\\" \\\\ here\\nreally"} 1' in lines
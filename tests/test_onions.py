@@ -0,0 +1,69 @@
+import pytest
+import rsa
+
+import onionSender
+from onions import Certificate, InsecureRSABC, Onion, RSABatchDecryptor, CONST_ONION_V1, CONST_ONION_V2, \
+                   CONST_ONION_VERSION_TAG
+
+PUB, SEC = Certificate.MakePair("Alice", "alice")
+
+
+def test_sender_makes_version_1_onions_by_default():
+    text = onionSender.OnionSender.makeOnionFromMessage("alice", "hi", PUB)
+    assert CONST_ONION_VERSION_TAG not in text
+    onion = Onion.Parse(text.encode('utf-8'))
+    assert onion._version == CONST_ONION_V1
+    assert onionSender.CircuitBuilder().version == CONST_ONION_V1
+
+
+def test_sender_makes_version_2_onions_when_asked():
+    text = onionSender.OnionSender.makeOnionFromMessage("alice", "hi", PUB, CONST_ONION_V2)
+    assert Onion.Parse(text.encode('utf-8'))._version == CONST_ONION_V2
+
+
+@pytest.mark.parametrize("blinding", [False, True])
+def test_batch_decrypt_matches_rsa_decrypt(monkeypatch, blinding):
+    monkeypatch.setattr(RSABatchDecryptor, "blinding", blinding)
+    pub, sec = rsa.newkeys(256)
+    msg = bytes(range(256)) * 4
+    ct = InsecureRSABC.encrypt_bytes(msg, pub)
+    k = rsa.common.byte_size(sec.n)
+    expected = b''.join(rsa.decrypt(ct[i:i+k], sec) for i in range(0, len(ct), k))
+    assert expected == msg
+    assert RSABatchDecryptor.ForKey(sec).decryptBlocks(ct) == expected
+
+    bad = bytearray(ct)
+    bad[5] ^= 0xff
+    with pytest.raises(rsa.DecryptionError):
+        RSABatchDecryptor.ForKey(sec).decryptBlocks(bytes(bad))
+
+
+def test_version_2_text_onion_round_trip():
+    onion = Onion("alice", "Hi Alice!", CONST_ONION_V2)
+    Onion.wrap(onion, PUB)
+    text = Onion.toString(onion)
+    assert f"{CONST_ONION_VERSION_TAG} {CONST_ONION_V2}\n" in text
+
+    parsed = Onion.FromString(text)
+    assert (parsed._dest, parsed._version) == ("alice", CONST_ONION_V2)
+    assert Onion.peel(parsed, SEC) == "Hi Alice!"
+
+    # parsed straight from bytes, it peels to bytes
+    parsed = Onion.Parse(text.encode('utf-8'))
+    assert parsed._version == CONST_ONION_V2
+    assert Onion.peel(parsed, SEC) == b"Hi Alice!"
+
+
+def test_version_2_layers_nest():
+    inner = onionSender.OnionSender.makeOnionFromMessage("alice", "deep", PUB, CONST_ONION_V2)
+    outer = onionSender.OnionSender.makeOnionFromMessage("alice", inner, PUB, CONST_ONION_V2)
+    peeled = Onion.peel(Onion.FromString(outer), SEC)
+    assert Onion.peel(Onion.FromString(peeled), SEC) == "deep"
+
+
+def test_version_2_grows_payload_by_a_constant():
+    def growth(n):
+        ct = InsecureRSABC.encrypt_hybrid_bytes(b"x" * n, PUB._key)
+        assert InsecureRSABC.decrypt_hybrid_bytes(ct, SEC._key) == b"x" * n
+        return len(ct) - n
+    assert growth(10) == growth(100000)
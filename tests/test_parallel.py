@@ -0,0 +1,31 @@
+import rsa
+
+import onions
+from onions import InsecureRSABC, ParallelRSABC, RSABatchDecryptor, CONST_ENGINE_CACHE_SIZE
+
+
+def test_engine_cache_is_bounded():
+    RSABatchDecryptor.ClearCache()
+    keys = [rsa.newkeys(128)[1] for _ in range(CONST_ENGINE_CACHE_SIZE + 2)]
+    for key in keys:
+        RSABatchDecryptor.ForKey(key)
+    assert list(RSABatchDecryptor._engines) == keys[-CONST_ENGINE_CACHE_SIZE:]
+    RSABatchDecryptor.ClearCache()
+    assert not RSABatchDecryptor._engines
+
+
+def test_one_pool_serves_every_key(monkeypatch):
+    monkeypatch.setattr(ParallelRSABC, "workers", 2)
+    try:
+        msg = bytes(range(256)) * 8
+        pools = set()
+        for _ in range(2):
+            pub, sec = rsa.newkeys(256)
+            seg = InsecureRSABC.segment_size(pub)
+            ct = ParallelRSABC.encryptChunks(msg, pub, seg)
+            assert ParallelRSABC.decryptBlocks(ct, sec) == msg
+            assert RSABatchDecryptor.ForKey(sec).decryptBlocks(ct) == msg
+            pools.add(id(onions.ParallelRSABC._pool))
+        assert len(pools) == 1
+    finally:
+        ParallelRSABC.Shutdown()
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+import requests
+
+import keyserver
+from directory import DirectoryCache
+from pathselect import NodeStats, PathSelector
+from transport import Transport
+
+
+@pytest.fixture
+def selector(serve, tmp_path, monkeypatch):
+    """A PathSelector reading a keyserver with fast, slow, flaky and
+    unmeasured nodes online, and one node that stopped checking in.
+    """
+    monkeypatch.setattr(keyserver.KeyDatabase, "DBFILE", str(tmp_path / "keys.sqlite3"))
+    url = serve(keyserver.OnionKeyServer)
+    for uname in ["fast", "slow", "flaky", "new", "stale"]:
+        requests.get(url + f"/ONLINE?un={uname}").raise_for_status()
+    db = keyserver.KeyDatabase.ForThread()
+    with db._con:
+        db._con.execute("UPDATE nodes SET lastseen = datetime('now', '-600 seconds') WHERE uname = 'stale'")
+
+    stats = NodeStats()
+    stats.record("fast", 0.01, True)
+    stats.record("slow", 1.0, True)
+    stats.record("stale", 0.2, True)
+    stats.record("flaky", 0.2, True)
+    for _ in range(50):
+        stats.record("flaky", None, False)
+
+    directory = DirectoryCache(transport=Transport(keyserver_url=url))
+    return PathSelector(directory=directory, stats=stats, max_age=60, rng=random.Random(7))
+
+
+def test_stale_nodes_are_never_picked(selector):
+    weights = selector.candidates()
+    assert sorted(weights) == ["fast", "flaky", "new", "slow"]
+    for _ in range(20):
+        assert "stale" not in selector.select(4)
+    with pytest.raises(Exception):
+        selector.select(5)
+
+
+def test_weights_favour_fast_reliable_nodes(selector):
+    weights = selector.candidates()
+    assert weights["fast"] > weights["new"] > weights["slow"] > weights["flaky"]
+    # unmeasured nodes get the weight of the typical (median) round trip time
+    assert weights["new"] == pytest.approx(1 / 0.2)
+
+    picks = {}
+    for _ in range(1000):
+        first, = selector.select(1, exclude=["new"])
+        picks[first] = picks.get(first, 0) + 1
+    assert picks["fast"] > 20 * picks.get("slow", 0)
+    assert picks.get("flaky", 0) < picks.get("slow", 0) + 5
+
+
+def test_recipient_goes_last_and_is_never_a_hop(selector):
+    for _ in range(20):
+        path = selector.select(3, recipient="fast")
+        assert path[-1] == "fast" and "fast" not in path[:-1]
+        assert len(set(path)) == 4
+    with pytest.raises(Exception):
+        selector.select(4, recipient="fast")
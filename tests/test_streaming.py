@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+import onionNode
+from directory import DirectoryCache
+from onions import Certificate, InsecureRSABC, Onion, CONST_ONION_V2, CONST_KEYSTREAM_CHUNK, \
+                   CONST_ONION_BINARY_TYPE
+from transport import Transport
+
+ALICE_PUB, ALICE_SEC = Certificate.MakePair("Alice", "alice")
+BOB_PUB, _ = Certificate.MakePair("Bob", "bob")
+
+
+class FixedKeyStore:
+    def getCert(self):
+        return ALICE_SEC
+
+
+def test_keystream_pieces_match_whole_stream():
+    key = os.urandom(16)
+    size = CONST_KEYSTREAM_CHUNK
+    whole = b''.join(hashlib.shake_256(key + i.to_bytes(8, 'big')).digest(size) for i in range(4))
+    for offset, n in [(0, 1), (5, size), (size - 1, 2), (3, 3 * size + 7), (size, size)]:
+        assert InsecureRSABC.keystream(key, offset, n) == whole[offset:offset+n]
+
+
+def test_streamed_quoted_text_onion_is_peeled(serve):
+    url = serve(onionNode.OnionNodeHandler, keystore=FixedKeyStore(), forwarder=None,
+                batcher=None, streaming=True)
+    onion = Onion("alice", "hello, world", CONST_ONION_V2)
+    Onion.wrap(onion, ALICE_PUB)
+    body = urllib.parse.quote(Onion.toString(onion)).encode('ascii')
+
+    # chunked (so it's streamed), with chunk boundaries inside the %XX escapes
+    r = requests.post(url, data=(body[i:i+7] for i in range(0, len(body), 7)))
+    assert r.status_code == 200
+    assert r.text == "Thanks for the onion.  :)"
+
+
+class BrokenNextHop(BaseHTTPRequestHandler):
+    """A keyserver that lists bob at its own port, and a bob that fails
+    every onion sent to it.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = 1
+    port = None
+
+    def _send(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        nodes = {"bob": {"ip": "127.0.0.1", "lastseen": "2024-01-01 00:00:00", "port": BrokenNextHop.port}}
+        self._send(200, json.dumps({"version": 2, "nodes": nodes}).encode('utf-8'))
+
+    def do_POST(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            self.close_connection = True
+        else:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send(500, b"Could not handle that onion.")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def broken_next_hop(serve):
+    url = serve(BrokenNextHop)
+    BrokenNextHop.port = int(url.rsplit(":", 1)[1])
+    DirectoryCache.SetDefault(DirectoryCache(transport=Transport(keyserver_url=url)))
+    yield
+    DirectoryCache.SetDefault(None)
+
+
+def _for_bob_via_alice():
+    inner = Onion("bob", b"hi bob", CONST_ONION_V2)
+    Onion.wrap(inner, BOB_PUB)
+    outer = Onion("alice", inner.toBytes(), CONST_ONION_V2)
+    Onion.wrap(outer, ALICE_PUB)
+    return outer.toBytes()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_failed_forward_answers_502(serve, broken_next_hop, streaming):
+    url = serve(onionNode.OnionNodeHandler, keystore=FixedKeyStore(), forwarder=None,
+                batcher=None, streaming=streaming)
+    onion = _for_bob_via_alice()
+    body = iter([onion]) if streaming else onion        # a generator is sent chunked
+    r = requests.post(url, data=body, headers={"Content-Type": CONST_ONION_BINARY_TYPE})
+    assert r.status_code == 502
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_onion_for_someone_else_answers_500(serve, streaming):
+    url = serve(onionNode.OnionNodeHandler, keystore=FixedKeyStore(), forwarder=None,
+                batcher=None, streaming=streaming)
+    onion = Onion("bob", b"not for alice", CONST_ONION_V2)
+    Onion.wrap(onion, BOB_PUB)
+    onion = onion.toBytes()
+    body = iter([onion]) if streaming else onion
+    r = requests.post(url, data=body, headers={"Content-Type": CONST_ONION_BINARY_TYPE})
+    assert r.status_code == 500
@@ -0,0 +1,41 @@
+import struct
+
+from onions import Certificate, Onion, CONST_ONION_MAGIC, CONST_ONION_BINARY_TYPE, CONST_ONION_V1, \
+                   CONST_ONION_V2
+
+PUB, SEC = Certificate.MakePair("Alice", "alice")
+
+
+def test_binary_onion_layout():
+    data = Onion("alice", b"\x00\x01payload", CONST_ONION_V2).toBytes()
+    assert data == CONST_ONION_MAGIC + struct.pack(">BH", CONST_ONION_V2, 5) + b"alice" \
+                   + struct.pack(">I", 9) + b"\x00\x01payload"
+
+
+def test_binary_onion_round_trip():
+    for version in (CONST_ONION_V1, CONST_ONION_V2):
+        onion = Onion("alice", b"Hi Alice!", version)
+        Onion.wrap(onion, PUB)
+        data, content_type = onion.toWire()
+        assert content_type == CONST_ONION_BINARY_TYPE
+
+        parsed = Onion.Parse(data)
+        assert (parsed._dest, parsed._version, parsed.isBinary()) == ("alice", version, True)
+        assert Onion.peel(parsed, SEC) == b"Hi Alice!"
+        # it goes on as binary, byte for byte
+        assert parsed.toWire() == (data, CONST_ONION_BINARY_TYPE)
+
+
+def test_text_onion_stays_text_on_the_wire():
+    onion = Onion("alice", "Hi Alice!", CONST_ONION_V2)
+    Onion.wrap(onion, PUB)
+    parsed = Onion.Parse(Onion.toString(onion).encode('utf-8'))
+    data, content_type = parsed.toWire()
+    assert content_type is None and data == Onion.toString(onion).encode('utf-8')
+
+
+def test_bad_binary_onions_are_not_parsed():
+    data = Onion("alice", b"payload", CONST_ONION_V2).toBytes()
+    assert Onion.FromBytes(data[:-1]) is None                 # payload cut short
+    assert Onion.FromBytes(b"\x89ONX" + data[4:]) is None     # wrong magic
+    assert Onion.Parse(b"just a message") is None
@@ -0,0 +1,120 @@
+#
+# transport.py
+#
+# Shared HTTP client plumbing for talking to the keyserver and to other
+# Onion Nodes.
+#
+# Transport:
+# Keeps persistent (keep-alive) connection pools so we don't open a brand new
+# TCP connection for every keyserver lookup and every forwarded onion.  The
+# keyserver gets its own pool so busy node-to-node traffic can't push it out.
+# Every request gets a timeout (requests has none by default!).
+#
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from onions import CONST_KEYSERVER_URL, CONST_NODE_PORT
+
+# Keep-alive connections kept open per host (keyserver or peer node).
+CONST_POOL_SIZE = 8
+
+# How many different peer nodes we keep connection pools for.
+CONST_MAX_PEERS = 32
+
+# Seconds to wait for a connection to open, and for a response to arrive.
+CONST_CONNECT_TIMEOUT = 3.05
+CONST_READ_TIMEOUT = 30
+
+
+class SizedChunks:
+    """An iterable of bytes that knows its total length, so requests sends
+    it with a Content-Length header rather than chunked.
+    """
+    def __init__(self, chunks, length):
+        self._chunks = chunks
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+class Transport:
+    """Pooled, keep-alive HTTP client for keyserver and node traffic.
+
+    Sample usage:
+    >     t = Transport.Default()
+    >     r = t.keyserverGet("/NODES?un=alice")
+    >     t.nodePost("137.112.99.100", onion.toString())
+    """
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, keyserver_url=CONST_KEYSERVER_URL, pool_size=CONST_POOL_SIZE,
+                 max_peers=CONST_MAX_PEERS, connect_timeout=CONST_CONNECT_TIMEOUT,
+                 read_timeout=CONST_READ_TIMEOUT):
+        self.keyserver_url = keyserver_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self._keyserver = Transport._makeSession(1, pool_size)
+        self._peers = Transport._makeSession(max_peers, pool_size)
+
+    def _makeSession(hosts, pool_size):
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        return s
+
+    def Default():
+        """Returns the shared Transport for this process (made on first use).
+        """
+        with Transport._default_lock:
+            if Transport._default is None:
+                Transport._default = Transport()
+            return Transport._default
+
+    def SetDefault(transport):
+        """Replaces the shared Transport (e.g., to change pool sizes or timeouts).
+        """
+        with Transport._default_lock:
+            old = Transport._default
+            Transport._default = transport
+        if old is not None and old is not transport:
+            old.close()
+
+    def keyserverGet(self, path, **kwargs):
+        """GETs path (like "/KEYS?un=alice") from the keyserver.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self._keyserver.get(self.keyserver_url + path, **kwargs)
+
+    def keyserverPost(self, path, data, **kwargs):
+        """POSTs data to path on the keyserver.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self._keyserver.post(self.keyserver_url + path, data=data, **kwargs)
+
+    def nodePost(self, ip, data, port=CONST_NODE_PORT, path="/", length=None, **kwargs):
+        """POSTs data (usually an onion) to the Onion Node at ip.
+
+        @param data: bytes/str, or an iterable of bytes (streamed)
+        @param length: the total size of an iterable data, if known; it's then
+                       sent with a Content-Length instead of chunked (which
+                       older nodes can't read)
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        if length is not None and not isinstance(data, (bytes, bytearray, str)):
+            data = SizedChunks(data, length)
+        return self._peers.post(f"http://{ip}:{port}{path}", data=data, **kwargs)
+
+    def close(self):
+        """Closes all pooled connections.
+        """
+        self._keyserver.close()
+        self._peers.close()